@@ -4,6 +4,7 @@
     - build the QE estimates from them
     - build the mean-field estimates
     - build the QE spectra, MC-N0 and RD-N0 terms
+    - calculate the QE lensing responses
     - calculate the semi-analytical N0's
     - calculate cross-spectra to FFP10 CMB lensing potential input maps
 
@@ -38,6 +39,7 @@ parser.add_argument('-dd', dest='dd', action='store_true', help='perform dd qlms
 parser.add_argument('-ds', dest='ds', action='store_true', help='perform ds qlms / qcls library QEs')
 parser.add_argument('-ss', dest='ss', action='store_true', help='perform ss qlms / qcls library QEs')
 parser.add_argument('-mfdd', dest='mfdd', action='store_true', help='perform dd qlms mean-fields for qcls keys')
+parser.add_argument('-kR', dest='kR', action='store', default=[], nargs='+', help='QE keys for the lensing responses')
 parser.add_argument('-kN', dest='kN', action='store', default=[], nargs='+', help='keys for QE semi-analytical noise spectra')
 
 
@@ -97,25 +99,24 @@ mpi.barrier()
 qlibs = [par.qcls_dd] * args.dd +  [par.qcls_ss] * args.ss + [par.qcls_ds] * args.ds
 jobs = []
 for qlib in qlibs:
-    for kA in args.kA:
-        for kB in args.kB:
-            for idx in range(args.imin, args.imax):
-                if idx not in qlib.mc_sims_mf:
-                    jobs.append((qlib, idx, kA, kB))
+    for idx in range(args.imin, args.imax):
+        if idx not in qlib.mc_sims_mf:
+            jobs.append((qlib, idx))
 
-for i, (qlib, idx, kA, kB) in enumerate(jobs[mpi.rank::mpi.size]):
+for i, (qlib, idx) in enumerate(jobs[mpi.rank::mpi.size]):
     print('rank %s doing QE spectra sim %s %s %s, qcl_lib %s, job %s in %s' % (
-    mpi.rank, idx, kA, kB, qlib.lib_dir, i, len(jobs)))
-    qlib.get_sim_qcl(kA, idx, k2=kB)
+    mpi.rank, idx, args.kA, args.kB, qlib.lib_dir, i, len(jobs)))
+    qlib.get_sim_qcls(args.kA, args.kB, [idx]) # all kA, kB pairs with a single read of each QE map
+
+# --- QE responses, all at once and split over MPI ranks
+if len(args.kR) > 0 and hasattr(par.qresp_dd, 'precompute'):
+    par.qresp_dd.precompute(args.kR, ['p'])
 
 # --- semi-analytical unnormalized N0 calculation
-jobs = []
 for k in args.kN:
-    jobs += [(idx, k) for idx in range(args.imin, args.imax + 1)]
-
-for i, (idx, k) in enumerate(jobs[mpi.rank::mpi.size]):
-    print('rank %s doing QE sim %s %s, qlm_lib %s, job %s in %s' % (mpi.rank, idx, k, par.nhl_dd.lib_dir, i, len(jobs)))
-    par.nhl_dd.get_sim_nhl(idx, k, k)
+    idxs = list(range(args.imin, args.imax + 1))[mpi.rank::mpi.size]
+    print('rank %s doing QE sims %s %s, nhl_lib %s' % (mpi.rank, idxs, k, par.nhl_dd.lib_dir))
+    par.nhl_dd.get_sim_nhls(idxs, k, k)  # all sims of this rank calculated together
 
 mpi.barrier()
 mpi.finalize()
@@ -9,6 +9,7 @@ import numpy as np
 import plancklens
 from plancklens import utils
 from plancklens import nhl
+from plancklens.helpers import mpi
 
 
 def get_blbubc(bin_type):
@@ -57,7 +58,9 @@ class ffp10_binner:
 
          In each of the methods defined here (e.g. MCN0, RDN0...),  if the relevant QE, QE spectra, etc cannot be found
          precomputed, this will be performed on the fly. Hence in a realistic configuration it is always advisable
-         to build them all previously (for example with *examples/run_qlms.py*)
+         to build them all previously (for example with *examples/run_qlms.py*). In particular, the responses
+         are best obtained all at once and split over MPI ranks with *parfile.qresp_dd.precompute([k1, k2], [ksource])*
+         (option *-kR* of *examples/run_qlms.py*) before instantiating this library.
 
 
         This library can be used to build the cross power spectra of two anisotropy estimators, calculates biases,
@@ -69,9 +72,13 @@ class ffp10_binner:
             parfile: parameter file where the relevant QE libraries are defined
             btype: bin type descriptor ('consext8' or 'arg2' were the Planck 2018 lensing analysis defaults)
             ksource: anisotropy source (defaults to 'p', lensing)
+            stacks: if set, the per-simulation spectra (dd, ds, ss and semi-analytical N0) are collected once into
+                    in-memory arrays, shared by all biases and covariances. The simulations are split across MPI ranks,
+                    each rank keeping only its own, and the means and covariances are merged across ranks
+                    (all ranks must then call the same methods).
 
     """
-    def __init__(self, k1, k2, parfile, btype, ksource='p'):
+    def __init__(self, k1, k2, parfile, btype, ksource='p', stacks=False):
 
         lmaxphi = 2048
         cls_path = os.path.join(os.path.dirname(os.path.abspath(plancklens.__file__)), 'data', 'cls')
@@ -125,6 +132,15 @@ class ffp10_binner:
         self.kswitch = kswitch
 
         self.cls_path = cls_path
+        self.stacks = stacks
+        self._stacks = {}
+        self._qc_resps = {}
+        self._clpp_fid = None
+
+        # (nbins, lmax + 1) binning matrix, built once:
+        self.bmat = np.zeros((self.nbins, self.bin_lmaxs[-1] + 1), dtype=float)
+        for i, (lmin, lmax) in enumerate(zip(self.bin_lmins, self.bin_lmaxs)):
+            self.bmat[i, lmin:lmax + 1] = self._get_bil(i, np.arange(lmin, lmax + 1))
 
     def _get_bil(self, i, L):
         ret = (self.fid_bandpowers[i] / self.vlpp_den[i]) * self.vlpp_inv[L] * self.clkk_fid[L] * self.kswitch[L]
@@ -133,9 +149,100 @@ class ffp10_binner:
 
     def _get_binnedcl(self, cl):
         assert len(cl) > self.bin_lmaxs[-1], (len(cl), self.bin_lmaxs[-1])
-        ret = np.zeros(self.nbins)
-        for i, (lmin, lmax) in enumerate(zip(self.bin_lmins, self.bin_lmaxs)):
-            ret[i] = np.sum(self._get_bil(i, np.arange(lmin, lmax + 1)) * cl[lmin:lmax + 1])
+        return np.dot(self.bmat, cl[:self.bmat.shape[1]])
+
+    def bin_many(self, cls_2d):
+        """Bins a stack of spectra at once.
+
+            Args:
+                cls_2d: (nspectra, lmax + 1) array of spectra
+
+            Returns:
+                (nspectra, nbins) array of band-powers
+
+        """
+        cls_2d = np.atleast_2d(cls_2d)
+        assert cls_2d.shape[1] > self.bin_lmaxs[-1], (cls_2d.shape, self.bin_lmaxs[-1])
+        return np.dot(cls_2d[:, :self.bmat.shape[1]], self.bmat.T)
+
+    def _get_clpp_fid(self):
+        if self._clpp_fid is None:
+            self._clpp_fid = utils.camb_clfile(os.path.join(self.cls_path, 'FFP10_wdipole_lenspotentialCls.dat'))['pp']
+        return self._clpp_fid
+
+    def _get_qc_resp(self, k1=None, k2=None):
+        k1 = self.k1 if k1 is None else k1
+        k2 = self.k2 if k2 is None else k2
+        if (k1, k2) not in self._qc_resps:
+            self._qc_resps[(k1, k2)] = self.parfile.qresp_dd.get_response(k1, self.ksource) * self.parfile.qresp_dd.get_response(k2, self.ksource)
+        return self._qc_resps[(k1, k2)]
+
+    def _get_sim_cl(self, lab, idx):
+        if lab == 'nhl':
+            return self.parfile.nhl_dd.get_sim_nhl(int(idx), self.k1, self.k2)
+        return getattr(self.parfile, 'qcls_' + lab).get_sim_qcl(self.k1, idx, k2=self.k2)
+
+    def _get_stack(self, lab, mc_sims):
+        """(nsims, lmax + 1) array of the 'dd', 'ds', 'ss' or 'nhl' spectra of a set of simulations
+
+            In stack mode this is collected once, and only holds the simulations of this MPI rank, *mc_sims[rank::size]*.
+
+        """
+        assert lab in ['dd', 'ds', 'ss', 'nhl'], lab
+        nhl_lib = self.parfile.nhl_dd if lab == 'nhl' else None
+        if not self.stacks:
+            if hasattr(nhl_lib, 'get_sim_nhls'):  # all missing ones calculated together
+                return nhl_lib.get_sim_nhls([int(idx) for idx in mc_sims], self.k1, self.k2)
+            return np.array([self._get_sim_cl(lab, idx) for i, idx in utils.enumerate_progress(mc_sims, label='collecting ' + lab)])
+        key = (lab, utils.mchash(mc_sims))
+        if key not in self._stacks:
+            mc_sims = np.array(mc_sims)
+            my_sims = mc_sims[mpi.rank::mpi.size]
+            qcl_lib = getattr(self.parfile, 'qcls_' + lab, None)
+            if lab != 'nhl' and hasattr(qcl_lib, 'get_sim_qcls'):
+                my_cls = qcl_lib.get_sim_qcls([self.k1], [self.k2], my_sims)[(self.k1, self.k2)]
+            elif hasattr(nhl_lib, 'get_sim_nhls'):
+                my_cls = nhl_lib.get_sim_nhls([int(idx) for idx in my_sims], self.k1, self.k2)
+            else:
+                my_cls = [self._get_sim_cl(lab, idx) for idx in my_sims]
+            self._stacks[key] = np.array(my_cls)
+        return self._stacks[key]
+
+    def _merge_stats(self, st):
+        """In stack mode, merges the statistics of the simulations of all MPI ranks. Returns the input otherwise. """
+        if not self.stacks:
+            return st
+        parts = mpi.allgather(st)
+        ret = utils.stats(max([part.size for part in parts]), docov=st.docov)
+        for part in parts:
+            if part.N > 0:
+                ret.merge(part)
+        return ret
+
+    def _get_mean(self, lab, mc_sims):
+        """Simulation average of the 'dd', 'ds' or 'ss' spectra """
+        if self.stacks:
+            stack = self._get_stack(lab, mc_sims)
+            mean_stats = utils.stats(stack.shape[-1], docov=False)
+            if len(stack) > 0:
+                mean_stats.add_many(stack)
+            return self._merge_stats(mean_stats).mean()
+        return getattr(self.parfile, 'qcls_' + lab).get_sim_stats_qcl(self.k1, mc_sims, k2=self.k2).mean()
+
+    def get_all(self, wn1=True):
+        """Returns all band-powers, biases, corrections and covariance matrices in a dictionary.
+
+            In stack mode the simulation spectra are collected only once for all of these.
+
+        """
+        ret = {'fid': self.get_fid_bandpowers(), 'dat': self.get_dat_bandpowers(),
+               'mcn0': self.get_mcn0(), 'rdn0': self.get_rdn0(),
+               'mcn0_cov': self.get_mcn0_cov(), 'nhl_cov': self.get_nhl_cov()}
+        if wn1:
+            ret['n1'] = self.get_n1()
+        if self.k1[0] == 'p' and self.k2[0] == 'p' and self.ksource == 'p':
+            ret['bamc'] = self.get_bamc(wn1=wn1)
+            ret['bmmc'] = self.get_bmmc(wN1=wn1)
         return ret
 
     def get_fid_bandpowers(self):
@@ -148,25 +255,22 @@ class ffp10_binner:
         """Returns data raw band-powers, prior to any biases subtraction or correction.
 
         """
-        qc_resp = self.parfile.qresp_dd.get_response(self.k1, self.ksource) * self.parfile.qresp_dd.get_response(self.k2, self.ksource)
-        return self._get_binnedcl(utils.cli(qc_resp) * self.parfile.qcls_dd.get_sim_qcl(self.k1, -1, k2=self.k2))
+        return self._get_binnedcl(utils.cli(self._get_qc_resp()) * self.parfile.qcls_dd.get_sim_qcl(self.k1, -1, k2=self.k2))
 
     def get_mcn0(self):
         """Returns Monte-Carlo N0 lensing bias.
 
         """
-        ss = self.parfile.qcls_ss.get_sim_stats_qcl(self.k1, self.parfile.mc_sims_var, k2=self.k2).mean()
-        qc_resp = self.parfile.qresp_dd.get_response(self.k1, self.ksource) * self.parfile.qresp_dd.get_response(self.k2, self.ksource)
-        return self._get_binnedcl(utils.cli(qc_resp) * (2. * ss))
+        ss = self._get_mean('ss', self.parfile.mc_sims_var)
+        return self._get_binnedcl(utils.cli(self._get_qc_resp()) * (2. * ss))
 
     def get_rdn0(self):
         """Returns realization-dependent N0 lensing bias RDN0.
 
         """
-        ds = self.parfile.qcls_ds.get_sim_stats_qcl(self.k1, self.parfile.mc_sims_var, k2=self.k2).mean()
-        ss = self.parfile.qcls_ss.get_sim_stats_qcl(self.k1, self.parfile.mc_sims_var, k2=self.k2).mean()
-        qc_resp = self.parfile.qresp_dd.get_response(self.k1, self.ksource) * self.parfile.qresp_dd.get_response(self.k2, self.ksource)
-        return self._get_binnedcl(utils.cli(qc_resp) * (4 * ds - 2. * ss))
+        ds = self._get_mean('ds', self.parfile.mc_sims_var)
+        ss = self._get_mean('ss', self.parfile.mc_sims_var)
+        return self._get_binnedcl(utils.cli(self._get_qc_resp()) * (4 * ds - 2. * ss))
 
     def get_dat_nhl(self):
         """Returns N0 lensing bias, semi-analytical version.
@@ -174,8 +278,7 @@ class ffp10_binner:
             This is not highly accurate on the cut-sky
 
         """
-        qc_resp = self.parfile.qresp_dd.get_response(self.k1, self.ksource) * self.parfile.qresp_dd.get_response(self.k2, self.ksource)
-        return self._get_binnedcl(utils.cli(qc_resp) * self.parfile.nhl_dd.get_sim_nhl(-1, self.k1, self.k2))
+        return self._get_binnedcl(utils.cli(self._get_qc_resp()) * self.parfile.nhl_dd.get_sim_nhl(-1, self.k1, self.k2))
 
     def get_n1(self, k1=None, k2=None, unnormed=False):
         """Returns analytical N1 lensing bias.
@@ -203,8 +306,8 @@ class ffp10_binner:
         ftlB = ivfsB.get_ftl()
         felB = ivfsB.get_fel()
         fblB = ivfsB.get_fbl()
-        clpp_fid =  utils.camb_clfile(os.path.join(self.cls_path, 'FFP10_wdipole_lenspotentialCls.dat'))['pp']
-        qc_resp = self.parfile.qresp_dd.get_response(k1, self.ksource) * self.parfile.qresp_dd.get_response(k2, self.ksource)
+        clpp_fid = self._get_clpp_fid()
+        qc_resp = self._get_qc_resp(k1, k2)
         n1pp = self.parfile.n1_dd.get_n1(k1, self.ksource, clpp_fid, ftlA, felA, fblA, len(qc_resp) - 1,
                                          kB=k2, ftlB=ftlB, felB=felB, fblB=fblB)
         return self._get_binnedcl(utils.cli(qc_resp) * n1pp) if not unnormed else n1pp
@@ -232,7 +335,7 @@ class ffp10_binner:
         s4_cl_check = s4_band_norm * twolpo * (dd_ptsrc - 2. * ss_ptsrc)
         s4_cl_systs = s4_band_norm * twolpo * (4. * ds_ptsrc - 4. * ss_ptsrc)
         # phi-induced PS estimator N1
-        clpp_fid =  utils.camb_clfile(os.path.join(self.cls_path, 'FFP10_wdipole_lenspotentialCls.dat'))['pp']
+        clpp_fid = self._get_clpp_fid()
         s4_cl_clpp_n1 = s4_band_norm * twolpo * self.get_n1(k1=ks4, k2=ks4, unnormed=True)[:lmax_ss_s4+1]
 
         s4_cl_clpp_prim = s4_band_norm * twolpo * self.parfile.qresp_dd.get_response(ks4, self.ksource) [ :lmax_ss_s4 + 1] ** 2 * clpp_fid[:lmax_ss_s4 + 1]
@@ -260,8 +363,7 @@ class ffp10_binner:
         print('   dat has amplitude of ' + ('%.3g +- %0.3g (stat), signif of %.3f sigma.' %
                                             (s4_band_dat, np.std(s4_band_sim_stats),
                                              s4_band_dat / np.sqrt(np.var(s4_band_sim_stats)))))
-        qc_resp =   self.parfile.qresp_dd.get_response(self.k1, self.ksource) \
-                  * self.parfile.qresp_dd.get_response(self.k2, self.ksource)
+        qc_resp = self._get_qc_resp()
         # PS spectrum response to ks4, using qe.key- source key symmetry of response functions.
         qlss = self.parfile.qresp_dd.get_response(ks4, self.k1[0]) * self.parfile.qresp_dd.get_response(ks4, self.k2[0])
         # Correction to apply to estimated spectrum :
@@ -285,15 +387,15 @@ class ffp10_binner:
 
         """
         assert self.k1[0] == 'p' and self.k2[0] == 'p' and self.ksource == 'p', (self.k1, self.k2, self.ksource)
-        ss2 = 2 * self.parfile.qcls_ss.get_sim_stats_qcl(self.k1, self.parfile.mc_sims_var, k2=self.k2).mean()
-        cl_pred = utils.camb_clfile(os.path.join(self.cls_path, 'FFP10_wdipole_lenspotentialCls.dat'))['pp'][:len(ss2)]
-        qc_norm = utils.cli(self.parfile.qresp_dd.get_response(self.k1, self.ksource)
-                              * self.parfile.qresp_dd.get_response(self.k2, self.ksource))
+        ss2 = 2 * self._get_mean('ss', self.parfile.mc_sims_var)
+        cl_pred = self._get_clpp_fid()[:len(ss2)]
+        qc_norm = utils.cli(self._get_qc_resp())
         bp_stats = utils.stats(self.nbins)
         bp_n1 = self.get_n1() if wn1 else np.zeros(self.nbins, dtype=float)
-        for i, idx in utils.enumerate_progress(self.parfile.mc_sims_var, label='collecting BP stats'):
-            dd = self.parfile.qcls_dd.get_sim_qcl(self.k1, idx, k2=self.k2)
-            bp_stats.add(self._get_binnedcl(qc_norm *(dd - ss2) - cl_pred) - bp_n1)
+        dds = self._get_stack('dd', self.parfile.mc_sims_var)
+        if len(dds) > 0:
+            bp_stats.add_many(self.bin_many(qc_norm * (dds - ss2) - cl_pred) - bp_n1)
+        bp_stats = self._merge_stats(bp_stats)
         NMF = len(self.parfile.qcls_dd.mc_sims_mf)
         if NMF == 0: NMF = np.inf
         NB = len(self.parfile.mc_sims_var)
@@ -309,11 +411,10 @@ class ffp10_binner:
         assert self.k1[0] == 'p' and self.k2[0] == 'p' and self.ksource == 'p', (self.k1, self.k2, self.ksource)
         if mc_sims_dd is None: mc_sims_dd = self.parfile.mc_sims_var
         if mc_sims_ss is None: mc_sims_ss = self.parfile.mc_sims_var
-        dd = self.parfile.qcls_dd.get_sim_stats_qcl(self.k1, mc_sims_dd, k2=self.k2).mean()
-        ss = self.parfile.qcls_ss.get_sim_stats_qcl(self.k1, mc_sims_ss, k2=self.k2).mean()
-        cl_pred =  utils.camb_clfile(os.path.join(self.cls_path, 'FFP10_wdipole_lenspotentialCls.dat'))['pp']
-        qc_resp = self.parfile.qresp_dd.get_response(self.k1, self.ksource) * self.parfile.qresp_dd.get_response(self.k2, self.ksource)
-        bps = self._get_binnedcl(utils.cli(qc_resp) * (dd - 2 * ss) - cl_pred[:len(dd)])
+        dd = self._get_mean('dd', mc_sims_dd)
+        ss = self._get_mean('ss', mc_sims_ss)
+        cl_pred = self._get_clpp_fid()
+        bps = self._get_binnedcl(utils.cli(self._get_qc_resp()) * (dd - 2 * ss) - cl_pred[:len(dd)])
         if wN1: bps -= self.get_n1()
         return 1. / (1 + bps / self.fid_bandpowers)
 
@@ -323,12 +424,12 @@ class ffp10_binner:
         """
         if mc_sims_dd is None: mc_sims_dd = self.parfile.mc_sims_var
         nhl_cov = utils.stats(self.nbins)
-        qc_norm = utils.cli(self.parfile.qresp_dd.get_response(self.k1, self.ksource)
-                              * self.parfile.qresp_dd.get_response(self.k2, self.ksource))
-        for i, idx in utils.enumerate_progress(mc_sims_dd):
-            dd = self.parfile.qcls_dd.get_sim_qcl(self.k1, idx, k2=self.k2)
-            nhl_cov.add(self._get_binnedcl(qc_norm * (dd- self.parfile.nhl_dd.get_sim_nhl(int(idx), self.k1, self.k2))))
-        return nhl_cov.cov()
+        qc_norm = utils.cli(self._get_qc_resp())
+        dds = self._get_stack('dd', mc_sims_dd)
+        nhls = self._get_stack('nhl', mc_sims_dd)
+        if len(dds) > 0:
+            nhl_cov.add_many(self.bin_many(qc_norm * (dds - nhls)))
+        return self._merge_stats(nhl_cov).cov()
 
     def get_mcn0_cov(self, mc_sims_dd=None):
         """Covariance matrix obtained from the realization-independent debiaser.
@@ -336,12 +437,11 @@ class ffp10_binner:
         """
         if mc_sims_dd is None: mc_sims_dd = self.parfile.mc_sims_var
         mcn0_cov = utils.stats(self.nbins)
-        qc_norm = utils.cli(self.parfile.qresp_dd.get_response(self.k1, self.ksource)
-                              * self.parfile.qresp_dd.get_response(self.k2, self.ksource))
-        for i, idx in utils.enumerate_progress(mc_sims_dd):
-            dd = self.parfile.qcls_dd.get_sim_qcl(self.k1, idx, k2=self.k2)
-            mcn0_cov.add(self._get_binnedcl(qc_norm * dd))
-        return mcn0_cov.cov()
+        qc_norm = utils.cli(self._get_qc_resp())
+        dds = self._get_stack('dd', mc_sims_dd)
+        if len(dds) > 0:
+            mcn0_cov.add_many(self.bin_many(qc_norm * dds))
+        return self._merge_stats(mcn0_cov).cov()
 
 
     def get_ampl_x_input(self, mc_sims=None):
@@ -354,8 +454,7 @@ class ffp10_binner:
         if mc_sims is None: mc_sims = np.unique(np.concatenate([self.parfile.mc_sims_var, self.parfile.mc_sims_bias]))
         xin = utils.stats(self.nbins)
         qnorm = utils.cli(self.parfile.qresp_dd.get_response(self.k1, self.ksource))
-        for i, idx in utils.enumerate_progress(mc_sims):
-            qi = qlmi.get_sim_qcl(self.k1, idx)
-            xin.add(self._get_binnedcl(qnorm * qi) / self.fid_bandpowers)
+        qis = np.array([qlmi.get_sim_qcl(self.k1, idx) for i, idx in utils.enumerate_progress(mc_sims)])
+        xin.add_many(self.bin_many(qnorm * qis) / self.fid_bandpowers)
         return xin
 
@@ -53,6 +53,14 @@ class library_sepTP(object):
     def _apply_ivf_p(self, pmap, soltn=None):
         assert 0, 'override this'
 
+    def _get_sim_t(self, idx):
+        """Simulation input to the temperature filtering """
+        return self.sim_lib.get_sim_tmap(idx)
+
+    def _get_sim_p(self, idx):
+        """Simulation input to the polarization filtering """
+        return self.sim_lib.get_sim_pmap(idx)
+
     def get_ftl(self):
         """Isotropic approximation to temperature inverse variance filtering.
 
@@ -93,7 +101,7 @@ class library_sepTP(object):
         """
         tfname = os.path.join(self.lib_dir, 'sim_%04d_tlm.fits'%idx if idx >= 0 else 'dat_tlm.fits')
         if not os.path.exists(tfname):
-            tlm = self._apply_ivf_t(self.sim_lib.get_sim_tmap(idx), soltn=None if self.soltn_lib is None else self.soltn_lib.get_sim_tmliklm(idx))
+            tlm = self._apply_ivf_t(self._get_sim_t(idx), soltn=None if self.soltn_lib is None else self.soltn_lib.get_sim_tmliklm(idx))
             if self.cache: hp.write_alm(tfname, tlm)
             return tlm
         return hp.read_alm(tfname)
@@ -114,7 +122,7 @@ class library_sepTP(object):
                 soltn = None
             else:
                 soltn = np.array([self.soltn_lib.get_sim_emliklm(idx), self.soltn_lib.get_sim_bmliklm(idx)])
-            elm, blm = self._apply_ivf_p(self.sim_lib.get_sim_pmap(idx), soltn=soltn)
+            elm, blm = self._apply_ivf_p(self._get_sim_p(idx), soltn=soltn)
             if self.cache:
                 hp.write_alm(tfname, elm)
                 hp.write_alm(os.path.join(self.lib_dir, 'sim_%04d_blm.fits'%idx if idx >= 0 else 'dat_blm.fits'), blm)
@@ -138,7 +146,7 @@ class library_sepTP(object):
                 soltn = None
             else:
                 soltn = np.array([self.soltn_lib.get_sim_emliklm(idx), self.soltn_lib.get_sim_bmliklm(idx)])
-            elm, blm = self._apply_ivf_p(self.sim_lib.get_sim_pmap(idx), soltn=soltn)
+            elm, blm = self._apply_ivf_p(self._get_sim_p(idx), soltn=soltn)
             if self.cache:
                 hp.write_alm(tfname, blm)
                 hp.write_alm(os.path.join(self.lib_dir, 'sim_%04d_elm.fits'%idx if idx >= 0 else 'dat_elm.fits'), elm)
@@ -357,6 +365,10 @@ class library_fullsky_sepTP(library_sepTP):
         fbl (1d-array): isotropic filtering array for B-po. (filtered blm's are fbl * blm of the data)
         cache: filtered alm's will be cached if set.
 
+    Note:
+        If *sim_lib* has *get_sim_tlm* and *get_sim_eblm* methods (CMB + noise alms, e.g. *sims.maps.cmb_maps_nlev*),
+        these are used in place of the maps, skipping the map2alm transforms.
+
     """
     def __init__(self, lib_dir, sim_lib, nside, transf:np.ndarray or dict, cl_len, ftl, fel, fbl, cache=False):
 
@@ -370,6 +382,7 @@ class library_fullsky_sepTP(library_sepTP):
         self.lmax_fl = np.max([len(ftl), len(fel), len(fbl)]) - 1
         self.nside = nside
         self.transf = transfd
+        self.alm_sims = hasattr(sim_lib, 'get_sim_tlm') and hasattr(sim_lib, 'get_sim_eblm')
 
         super(library_fullsky_sepTP, self).__init__(lib_dir, sim_lib, cl_len, cache=cache)
 
@@ -394,14 +407,30 @@ class library_fullsky_sepTP(library_sepTP):
     def get_fbl(self):
         return np.copy(self.fbl)
 
+    def _get_sim_t(self, idx):
+        if self.alm_sims:
+            return self.sim_lib.get_sim_tlm(idx, lmax=self.lmax_fl)
+        return self.sim_lib.get_sim_tmap(idx)
+
+    def _get_sim_p(self, idx):
+        if self.alm_sims:
+            return self.sim_lib.get_sim_eblm(idx, lmax=self.lmax_fl)
+        return self.sim_lib.get_sim_pmap(idx)
+
     def _apply_ivf_t(self, tmap, soltn=None):
-        assert len(tmap) == hp.nside2npix(self.nside), (hp.npix2nside(tmap.size), self.nside)
-        alm = hp.map2alm(tmap, lmax=self.lmax_fl, iter=0)
+        if np.iscomplexobj(tmap): # harmonic space input
+            alm = utils.alm_copy(tmap, lmax=self.lmax_fl)
+        else:
+            assert len(tmap) == hp.nside2npix(self.nside), (hp.npix2nside(tmap.size), self.nside)
+            alm = hp.map2alm(tmap, lmax=self.lmax_fl, iter=0)
         return hp.almxfl(alm, self.get_ftl() * utils.cli(self.transf['t'][:len(self.ftl)]))
 
     def _apply_ivf_p(self, pmap, soltn=None):
-        assert len(pmap[0]) == hp.nside2npix(self.nside) and len(pmap[0]) == len(pmap[1])
-        elm, blm = hp.map2alm_spin([m for m in pmap], 2, lmax=self.lmax_fl)
+        if np.iscomplexobj(pmap[0]): # harmonic space input
+            elm, blm = [utils.alm_copy(alm, lmax=self.lmax_fl) for alm in pmap]
+        else:
+            assert len(pmap[0]) == hp.nside2npix(self.nside) and len(pmap[0]) == len(pmap[1])
+            elm, blm = hp.map2alm_spin([m for m in pmap], 2, lmax=self.lmax_fl)
         elm = hp.almxfl(elm, self.get_fel() * utils.cli(self.transf['e'][:len(self.fel)]))
         blm = hp.almxfl(blm, self.get_fbl() * utils.cli(self.transf['b'][:len(self.fbl)]))
         return elm, blm
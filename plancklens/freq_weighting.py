@@ -8,6 +8,7 @@ import numpy as np
 from plancklens.qcinv.util import read_map
 from plancklens.wigners import wigners
 from plancklens.utils import enumerate_progress
+from plancklens.utils_spin import _get_xgwg
 
 
 def _w2wsq(wl, s1, s2, lmax_out):
@@ -16,7 +17,7 @@ def _w2wsq(wl, s1, s2, lmax_out):
     """
     lmax = len(wl) - 1
     npts = (2 * lmax + lmax_out) // 2 + 1
-    xg, wg = wigners.get_xgwg(-1., 1., npts)
+    xg, wg = _get_xgwg(npts)
     return wigners.wignercoeff(wigners.wignerpos(wl, xg, s1, s2) ** 2 * wg, xg, 0, 0, lmax_out)
 
 def vmaps2vmap_I(pix_vmaps, weights, nside):
@@ -18,15 +18,24 @@ if cond4mpi4py:
         size = MPI.COMM_WORLD.Get_size()
         barrier = MPI.COMM_WORLD.Barrier
         finalize = MPI.Finalize
+        allgather = MPI.COMM_WORLD.allgather
+        gather = MPI.COMM_WORLD.gather
+        bcast = MPI.COMM_WORLD.bcast
         if verbose: print('mpi.py : setup OK, rank %s in %s' % (rank, size))
     except:
         rank = 0
         size = 1
         barrier = lambda: -1
         finalize = lambda: -1
+        allgather = lambda obj: [obj]
+        gather = lambda obj, root=0: [obj]
+        bcast = lambda obj, root=0: obj
         if verbose: print('mpi.py: unable to import mpi4py\n')
 else:
     rank = 0
     size = 1
     barrier = lambda: -1
-    finalize = lambda: -1
\ No newline at end of file
+    finalize = lambda: -1
+    allgather = lambda obj: [obj]
+    gather = lambda obj, root=0: [obj]
+    bcast = lambda obj, root=0: obj
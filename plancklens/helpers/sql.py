@@ -21,32 +21,85 @@ def convert_array(text):
     out.seek(0)
     return np.load(out)
 
+def adapt_array_raw(arr):
+    """Raw-bytes codec: dtype and shape header followed by the array buffer (no .npy header parsing) """
+    arr = np.ascontiguousarray(arr)
+    dt = arr.dtype.str.encode()
+    hdr = np.array([len(dt), arr.ndim] + list(arr.shape), dtype=np.int64).tobytes()
+    return buffer(hdr + dt + arr.tobytes()) if six.PY2 else memoryview(hdr + dt + arr.tobytes())
+
+def convert_array_raw(text):
+    ndt, ndim = np.frombuffer(text, dtype=np.int64, count=2)
+    shape = np.frombuffer(text, dtype=np.int64, count=ndim, offset=16)
+    i0 = 16 + 8 * ndim
+    dt = np.dtype(text[i0:i0 + ndt].decode())
+    return np.frombuffer(text, dtype=dt, offset=i0 + ndt).reshape(shape)
+
 
 sqlite3.register_adapter(np.ndarray, adapt_array)
 sqlite3.register_converter("ARRAY", convert_array)
+sqlite3.register_converter("RAWARRAY", convert_array_raw)
+
+_MAX_VARS = 500 # max. number of ids per bulk SELECT statement
+
+def _connect(fname):
+    return sqlite3.connect(fname, timeout=3600., detect_types=sqlite3.PARSE_DECLTYPES)
+
+def _get_many(con, table, col, idxs):
+    ret = {}
+    idxs = list(idxs)
+    for i in range(0, len(idxs), _MAX_VARS):
+        chunk = idxs[i:i + _MAX_VARS]
+        cur = con.cursor()
+        cur.execute("SELECT id, %s FROM %s WHERE id IN (%s)" % (col, table, ','.join('?' * len(chunk))), chunk)
+        ret.update(cur.fetchall())
+        cur.close()
+    return [ret.get(idx, None) for idx in idxs]
 
 class npdb:
     """A simple wrapper class to store np arrays in an sqlite3 database.
 
+        Args:
+            fname: path to the database file
+            idtype: sqlite type of the keys
+            codec: arrays serialization of a new database, 'npy' (np.save, default) or 'raw' (dtype and shape header and data).
+                   Existing databases keep the codec they were created with.
+
      """
-    def __init__(self, fname, idtype="STRING"):
+    def __init__(self, fname, idtype="STRING", codec='npy'):
+        assert codec in ['npy', 'raw'], codec
         if not os.path.exists(fname) and mpi.rank == 0:
-            con = sqlite3.connect(fname, detect_types=sqlite3.PARSE_DECLTYPES, timeout=3600)
+            con = _connect(fname)
             cur = con.cursor()
-            cur.execute("CREATE TABLE npdb (id %s PRIMARY KEY, arr ARRAY)" % idtype)
+            cur.execute("CREATE TABLE npdb (id %s PRIMARY KEY, arr %s)" % (idtype, 'RAWARRAY' if codec == 'raw' else 'ARRAY'))
             con.commit()
+            con.close()
         mpi.barrier()
 
-        self.con = sqlite3.connect(fname, timeout=3600., detect_types=sqlite3.PARSE_DECLTYPES)
+        self.con = _connect(fname)
+        coltypes = {row[1]: row[2] for row in self.con.execute("PRAGMA table_info(npdb)")}
+        self.codec = 'raw' if coltypes['arr'].upper() == 'RAWARRAY' else 'npy'
+
+    def _adapt(self, vec):
+        return adapt_array_raw(vec) if self.codec == 'raw' else vec.reshape((1, len(vec)))
 
     def add(self, idx, vec):
-        try:
-            assert self.get(idx) is None
-            self.con.execute("INSERT INTO npdb (id,  arr) VALUES (?,?)", (idx, vec.reshape((1, len(vec)))))
-            self.con.commit()
-        except:
+        """Inserts an array. An already existing key is left untouched.
+
+        """
+        with self.con:  # commits, or rolls back and releases the write lock on errors
+            cur = self.con.execute("INSERT OR IGNORE INTO npdb (id,  arr) VALUES (?,?)", (idx, self._adapt(vec)))
+        if cur.rowcount == 0:
             print("npdb add failed!")
 
+    def add_many(self, idxs, vecs):
+        """Inserts a set of arrays in a single transaction. Already existing keys are left untouched.
+
+        """
+        with self.con:
+            self.con.executemany("INSERT OR IGNORE INTO npdb (id,  arr) VALUES (?,?)",
+                                 [(idx, self._adapt(vec)) for idx, vec in zip(idxs, vecs)])
+
     def remove(self, idx):
         try:
             assert self.get(idx) is not None
@@ -65,28 +118,48 @@ class npdb:
         else:
             return data[0].flatten()
 
+    def get_many(self, idxs):
+        """Returns the list of arrays for the input keys (None for missing keys), with one query per few hundred keys.
+
+        """
+        return [None if data is None else data.flatten() for data in _get_many(self.con, 'npdb', 'arr', idxs)]
+
 class fldb:
     """A simple wrapper class to store floats in an sqlite3 database.
 
+        Args:
+            fname: path to the database file
+            idtype: sqlite type of the keys
+
      """
     def __init__(self, fname, idtype="STRING"):
         if not os.path.exists(fname) and mpi.rank == 0:
-            con = sqlite3.connect(fname, detect_types=sqlite3.PARSE_DECLTYPES, timeout=3600)
+            con = _connect(fname)
             cur = con.cursor()
             cur.execute("CREATE TABLE fldb (id %s PRIMARY KEY, fl REAL)" % idtype)
             con.commit()
+            con.close()
         mpi.barrier()
 
-        self.con = sqlite3.connect(fname, timeout=3600., detect_types=sqlite3.PARSE_DECLTYPES)
+        self.con = _connect(fname)
 
     def add(self, idx, fl):
-        try:
-            assert self.get(idx) is None
-            self.con.execute("INSERT INTO fldb (id,  fl) VALUES (?,?)", (idx, fl))
-            self.con.commit()
-        except:
+        """Inserts a float. An already existing key is left untouched.
+
+        """
+        with self.con:  # commits, or rolls back and releases the write lock on errors
+            cur = self.con.execute("INSERT OR IGNORE INTO fldb (id,  fl) VALUES (?,?)", (idx, fl))
+        if cur.rowcount == 0:
             print("fldb add failed!")
 
+    def add_many(self, idxs, fls):
+        """Inserts a set of floats in a single transaction. Already existing keys are left untouched.
+
+        """
+        with self.con:
+            self.con.executemany("INSERT OR IGNORE INTO fldb (id,  fl) VALUES (?,?)",
+                                 [(idx, fl) for idx, fl in zip(idxs, fls)])
+
     def remove(self, idx):
         try:
             assert self.get(idx) is not None
@@ -104,3 +177,9 @@ class fldb:
             return None
         else:
             return data[0]
+
+    def get_many(self, idxs):
+        """Returns the list of floats for the input keys (None for missing keys), with one query per few hundred keys.
+
+        """
+        return _get_many(self.con, 'fldb', 'fl', idxs)
@@ -37,10 +37,12 @@
 """
 
 import os
+import hashlib
+from collections import OrderedDict
 import healpy as hp
 import numpy as np
 import plancklens
-from plancklens import utils, qresp, nhl
+from plancklens import utils, qresp, nhl, utils_spin as uspin
 from copy import deepcopy
 
 
@@ -90,6 +92,36 @@ def get_N0(beam_fwhm=1.4, nlev_t:float or np.ndarray=5., nlev_p=None, lmax_CMB:
 
     # Simple white noise model. Can feed here something more fancy if desired
     transf = hp.gauss_beam(beam_fwhm / 60. / 180. * np.pi, lmax=lmax_ivf)
+    fal_sepTP, cls_ivfs_sepTP, fal_jtTP, cls_ivfs_jtTP = _get_fals(cls_len, transf, nlev_t, nlev_p, lmaxs_CMB, lmin_ivf, lmax_ivf)
+
+    N0s = {}
+    N0_curls = {}
+    for qe_key in qe_keys:
+        # This calculates the unormalized QE gradient (G), curl (C) variances and covariances:
+        # (GC and CG is zero for most estimators)
+        NG, NC, NGC, NCG = nhl.get_nhl(qe_key, qe_key, cls_weight, cls_ivfs_sepTP, lmax_ivf, lmax_ivf,
+                                       lmax_out=lmax_qlm)
+        # Calculation of the G to G, C to C, G to C and C to G QE responses (again, cross-terms are typically zero)
+        RG, RC, RGC, RCG = qresp.get_response(qe_key, lmax_ivf, ksource, cls_weight, cls_len, fal_sepTP,
+                                              lmax_qlm=lmax_qlm)
+
+        # Gradient and curl noise terms
+        N0s[qe_key] = utils.cli(RG ** 2) * NG
+        N0_curls[qe_key] = utils.cli(RC ** 2) * NC
+
+    if joint_TP:
+        NG, NC, NGC, NCG = nhl.get_nhl(ksource, ksource, cls_weight, cls_ivfs_jtTP, lmax_ivf, lmax_ivf,
+                                       lmax_out=lmax_qlm)
+        RG, RC, RGC, RCG = qresp.get_response(ksource, lmax_ivf, ksource, cls_weight, cls_len, fal_jtTP,
+                                              lmax_qlm=lmax_qlm)
+        N0s[ksource] = utils.cli(RG ** 2) * NG
+        N0_curls[ksource] = utils.cli(RC ** 2) * NC
+
+    return N0s, N0_curls
+
+
+def _get_fals(cls_len, transf, nlev_t, nlev_p, lmaxs_CMB, lmin_ivf, lmax_ivf):
+    """Filtering and inverse-variance filtered CMB spectra for separate and joint T-P filtering """
     Noise_L_T = (nlev_t / 60. / 180. * np.pi) ** 2 / transf ** 2
     Noise_L_P = (nlev_p / 60. / 180. * np.pi) ** 2 / transf ** 2
 
@@ -117,30 +149,87 @@ def get_N0(beam_fwhm=1.4, nlev_t:float or np.ndarray=5., nlev_p=None, lmax_CMB:
     for cls in [fal_sepTP, fal_jtTP, cls_ivfs_sepTP, cls_ivfs_jtTP]:
         for cl in cls.values():
             cl[:max(1, lmin_ivf)] *= 0.
+    return fal_sepTP, cls_ivfs_sepTP, fal_jtTP, cls_ivfs_jtTP
+
+
+def get_N0_grid(beam_fwhms, nlevs_t, nlevs_p=None, lmax_CMB: dict or int=3000, lmin_CMB=100, lmax_out=None,
+                cls_len:dict or None=None, cls_weight:dict or None=None, joint_TP=True, ksource='p',
+                chunk_size=16, executor=None):
+    r"""Same as *get_N0* on a grid of beams and noise levels.
+
+        The QE plans and quadrature nodes are set up once, and the noise-dependent transforms of *chunk_size*
+        grid points are stacked together.
+
+        Args:
+            beam_fwhms: 1d array of beam fwhms in arcmin
+            nlevs_t: 1d array of T white noise levels in uK-arcmin
+            nlevs_p: 1d array of P white noise levels in uK-arcmin, same size as nlevs_t (defaults to root(2) nlevs_t)
+            chunk_size(optional): number of grid points processed together
+            executor(optional): *concurrent.futures* executor (e.g. a ProcessPoolExecutor) over which the chunks are spread
+
+            See *get_N0* for the other arguments
+
+        Returns:
+            N0s and N0_curls dictionaries, with arrays of shape (len(beam_fwhms), len(nlevs_t), lmax_out + 1)
+
+    """
+    beam_fwhms = np.atleast_1d(beam_fwhms)
+    nlevs_t = np.atleast_1d(nlevs_t)
+    nlevs_p = nlevs_t * np.sqrt(2) if nlevs_p is None else np.atleast_1d(nlevs_p)
+    assert nlevs_p.shape == nlevs_t.shape, (nlevs_p.shape, nlevs_t.shape)
+    if not isinstance(lmax_CMB, dict):
+        lmaxs_CMB = {s: lmax_CMB for s in ['t', 'e', 'b']}
+    else:
+        lmaxs_CMB = lmax_CMB
+    lmax_ivf =  np.max(list(lmaxs_CMB.values()))
+    lmax_qlm = lmax_out or lmax_ivf
+    cls_path = os.path.join(os.path.dirname(os.path.abspath(plancklens.__file__)), 'data', 'cls')
+    cls_len = cls_len or utils.camb_clfile(os.path.join(cls_path, 'FFP10_wdipole_lensedCls.dat'))
+    cls_weight = cls_weight or utils.camb_clfile(os.path.join(cls_path, 'FFP10_wdipole_lensedCls.dat'))
 
+    grid = [(beam, nlev_t, nlev_p) for beam in beam_fwhms for (nlev_t, nlev_p) in zip(nlevs_t, nlevs_p)]
+    chunks = [grid[i:i + chunk_size] for i in range(0, len(grid), chunk_size)]
+    args = (lmaxs_CMB, lmin_CMB, lmax_ivf, lmax_qlm, cls_len, cls_weight, joint_TP, ksource)
+    if executor is None:
+        qes = _get_N0_qes(cls_weight, lmax_ivf, joint_TP, ksource)
+        rets = [_get_N0_chunk(chunk, *args, qes=qes) for chunk in chunks]
+    else:  # QEs are not picklable, each chunk rebuilds its own
+        rets = list(executor.map(_get_N0_chunk, chunks, *[[arg] * len(chunks) for arg in args]))
+    shape = (len(beam_fwhms), len(nlevs_t), lmax_qlm + 1)
+    N0s = {k: np.concatenate([ret[0][k] for ret in rets]).reshape(shape) for k in rets[0][0].keys()}
+    N0_curls = {k: np.concatenate([ret[1][k] for ret in rets]).reshape(shape) for k in rets[0][1].keys()}
+    return N0s, N0_curls
+
+def _get_N0_qes(cls_weight, lmax_ivf, joint_TP, ksource):
+    qe_keys = [ksource + 'tt', ksource + '_p']
+    if not joint_TP:
+        qe_keys.append(ksource)
+    qes = {qe_key: (qresp.get_qes(qe_key, lmax_ivf, cls_weight), False) for qe_key in qe_keys}
+    if joint_TP:
+        qes[ksource] = (qresp.get_qes(ksource, lmax_ivf, cls_weight), True)
+    return qes
+
+def _get_N0_chunk(chunk, lmaxs_CMB, lmin_ivf, lmax_ivf, lmax_qlm, cls_len, cls_weight, joint_TP, ksource, qes=None):
+    if qes is None:
+        qes = _get_N0_qes(cls_weight, lmax_ivf, joint_TP, ksource)
+    fals = {False:[], True:[]}
+    ivfs = {False:[], True:[]}
+    for beam_fwhm, nlev_t, nlev_p in chunk:
+        transf = hp.gauss_beam(beam_fwhm / 60. / 180. * np.pi, lmax=lmax_ivf)
+        fal_sepTP, cls_ivfs_sepTP, fal_jtTP, cls_ivfs_jtTP = _get_fals(cls_len, transf, nlev_t, nlev_p, lmaxs_CMB, lmin_ivf, lmax_ivf)
+        fals[False].append(fal_sepTP)
+        fals[True].append(fal_jtTP)
+        ivfs[False].append(cls_ivfs_sepTP)
+        ivfs[True].append(cls_ivfs_jtTP)
     N0s = {}
     N0_curls = {}
-    for qe_key in qe_keys:
-        # This calculates the unormalized QE gradient (G), curl (C) variances and covariances:
-        # (GC and CG is zero for most estimators)
-        NG, NC, NGC, NCG = nhl.get_nhl(qe_key, qe_key, cls_weight, cls_ivfs_sepTP, lmax_ivf, lmax_ivf,
-                                       lmax_out=lmax_qlm)
-        # Calculation of the G to G, C to C, G to C and C to G QE responses (again, cross-terms are typically zero)
-        RG, RC, RGC, RCG = qresp.get_response(qe_key, lmax_ivf, ksource, cls_weight, cls_len, fal_sepTP,
-                                              lmax_qlm=lmax_qlm)
-
-        # Gradient and curl noise terms
+    for qe_key, (qes_k, jtTP) in qes.items():
+        NG, NC, NGC, NCG = nhl._get_nhl_many(qes_k, qes_k, ivfs[jtTP], lmax_qlm)
+        Rs = qresp._get_response_many(qes_k, ksource, cls_len, fals[jtTP], lmax_qlm)
+        RG = np.array([R[0] for R in Rs])
+        RC = np.array([R[1] for R in Rs])
         N0s[qe_key] = utils.cli(RG ** 2) * NG
         N0_curls[qe_key] = utils.cli(RC ** 2) * NC
-
-    if joint_TP:
-        NG, NC, NGC, NCG = nhl.get_nhl(ksource, ksource, cls_weight, cls_ivfs_jtTP, lmax_ivf, lmax_ivf,
-                                       lmax_out=lmax_qlm)
-        RG, RC, RGC, RCG = qresp.get_response(ksource, lmax_ivf, ksource, cls_weight, cls_len, fal_jtTP,
-                                              lmax_qlm=lmax_qlm)
-        N0s[ksource] = utils.cli(RG ** 2) * NG
-        N0_curls[ksource] = utils.cli(RC ** 2) * NC
-
     return N0s, N0_curls
 
 
@@ -170,8 +259,115 @@ def dls2cls(dls):
     return cls
 
 
+def lensed_cls_fullsky(dls_unl, cldd, lmax_out=None):
+    r"""Curved-sky lensed CMB spectra from the correlation-function method, without camb.
+
+        This implements the non-perturbative result of Challinor & Lewis 2005 to second order in :math:`C_{\rm gl, 2}`,
+        with Gauss-Legendre quadrature and Wigner small-d recursions. Same input and output conventions as camb *lensed_cls*.
+
+        Args:
+            dls_unl: (lmax + 1, 4) array of unlensed TT, EE, BB, TE :math:`D_\ell` spectra
+            cldd: deflection spectrum :math:`[L(L+1)]^2 C^{\phi\phi}_L / 2\pi`
+            lmax_out(optional): lensed spectra are returned up to this multipole. Defaults to lmax
+
+        Returns:
+            (lmax_out + 1, 4) array of lensed TT, EE, BB, TE :math:`D_\ell` spectra
+
+        Note:
+            Inputs should extend well beyond lmax_out (at least ~2000 multipoles for percent level BB at lmax_out ~ 2000)
+
+    """
+    from plancklens.wigners import wigners
+    lmax = dls_unl.shape[0] - 1
+    lmax_out = lmax if lmax_out is None else lmax_out
+    xg, wg = uspin._get_xgwg(lmax + 2)
+    ls = np.arange(lmax + 1, dtype=float)
+    cls = np.zeros((lmax + 1, 4), dtype=float)
+    cls[2:] = dls_unl[2:] * (2 * np.pi / (ls[2:] * (ls[2:] + 1)))[:, None]
+    Ls = np.arange(len(cldd), dtype=float)
+    cl_dd = np.zeros(len(cldd), dtype=float) # L(L+1) C^pp_L
+    cl_dd[1:] = cldd[1:] * 2 * np.pi / (Ls[1:] * (Ls[1:] + 1))
+    Cgl2 = wigners.wignerpos(cl_dd, xg, 1, -1)
+    sig2 = np.sum((2 * Ls + 1) / (4 * np.pi) * cl_dd) - wigners.wignerpos(cl_dd, xg, 1, 1)
+
+    # Wigner small-d functions needed, obtained by upwards recursion in l, seeded at l0 and l0 + 1
+    pairs = [(0, 0), (1, 1), (1, -1), (2, -2), (2, 2), (3, 1), (4, 0), (3, -3), (4, -4), (0, 2), (3, -1), (2, 0), (-2, 4)]
+    ip = {p: i for i, p in enumerate(pairs)}
+    m = np.array([p[0] for p in pairs], dtype=float)[:, None]
+    n = np.array([p[1] for p in pairs], dtype=float)[:, None]
+    l0s = np.max(np.abs([m[:, 0], n[:, 0]]), axis=0).astype(int)
+    def seed(l, s1, s2):
+        unit = np.zeros(l + 1, dtype=float)
+        unit[l] = 4 * np.pi / (2 * l + 1)
+        return wigners.wignerpos(unit, xg, s1, s2)
+    seeds = {(i, l): seed(l, s1, s2) for i, (s1, s2) in enumerate(pairs) for l in [l0s[i], l0s[i] + 1]}
+    d_lm1 = np.zeros((len(pairs), len(xg)), dtype=float)
+    d_l = np.zeros((len(pairs), len(xg)), dtype=float)
+    xiT, xip, xim, xiX = [np.zeros(len(xg), dtype=float) for i in range(4)]
+    for l in range(0, lmax + 1):
+        lp = max(l - 1, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            a = (2 * lp + 1) * (xg[None, :] - m * n / (lp * (lp + 1.)))
+            b = np.sqrt(np.maximum((lp ** 2 - m ** 2) * (lp ** 2 - n ** 2), 0.)) / lp
+            c = (lp + 1) / np.sqrt(((lp + 1) ** 2 - m ** 2) * ((lp + 1) ** 2 - n ** 2))
+            d_new = np.where(l > l0s[:, None] + 1, (a * d_l - b * d_lm1) * c, 0.)
+        for i in np.where((l == l0s) | (l == l0s + 1))[0]:
+            d_new[i] = seeds[(i, l)]
+        d_lm1, d_l = d_l, d_new
+        if l < 2:
+            continue
+        d = lambda s1, s2: d_l[ip[(s1, s2)]]
+        ll = l * (l + 1.)
+        X000 = np.exp(-ll * sig2 / 4)
+        X000p = -ll / 4 * X000
+        X220 = 0.25 * np.sqrt((l + 2) * (l - 1) * ll) * np.exp(-(ll - 2) * sig2 / 4)
+        X022 = np.exp(-(ll - 4) * sig2 / 4)
+        X022p = -(ll - 4) / 4 * X022
+        X121 = -0.5 * np.sqrt((l + 2) * (l - 1.)) * np.exp(-(ll - 8 / 3.) * sig2 / 4)
+        X132 = -0.5 * np.sqrt(max((l + 3) * (l - 2.), 0.)) * np.exp(-(ll - 20 / 3.) * sig2 / 4)
+        X242 = 0.25 * np.sqrt(max((l + 4) * (l + 3) * (l - 2.) * (l - 3), 0.)) * np.exp(-(ll - 10) * sig2 / 4)
+        cT, cE, cB, cX = cls[l] * (2 * l + 1) / (4 * np.pi)
+        xiT += cT * (X000 ** 2 * d(0, 0) + 8 / ll * Cgl2 * X000p ** 2 * d(1, -1)
+                     + Cgl2 ** 2 * (X000p ** 2 * d(0, 0) + X220 ** 2 * d(2, -2)))
+        xip += (cE + cB) * (X022 ** 2 * d(2, 2) + 2 * Cgl2 * X132 * X121 * d(3, 1)
+                            + Cgl2 ** 2 * (X022p ** 2 * d(2, 2) + X242 * X220 * d(4, 0)))
+        xim += (cE - cB) * (X022 ** 2 * d(2, -2) + Cgl2 * (X121 ** 2 * d(1, -1) + X132 ** 2 * d(3, -3))
+                            + 0.5 * Cgl2 ** 2 * (2 * X022p ** 2 * d(2, -2) + X220 ** 2 * d(0, 0) + X242 ** 2 * d(4, -4)))
+        xiX += cX * (X022 * X000 * d(0, 2) + Cgl2 * 2 * X000p / np.sqrt(ll) * (X121 * d(1, 1) + X132 * d(3, -1))
+                     + 0.5 * Cgl2 ** 2 * ((2 * X022p * X000p + X220 ** 2) * d(2, 0) + X220 * X242 * d(-2, 4)))
+    clT = wigners.wignercoeff(xiT * wg, xg, 0, 0, lmax_out)
+    clp = wigners.wignercoeff(xip * wg, xg, 2, 2, lmax_out)
+    clm = wigners.wignercoeff(xim * wg, xg, 2, -2, lmax_out)
+    clX = wigners.wignercoeff(xiX * wg, xg, 0, 2, lmax_out)
+    lo = np.arange(lmax_out + 1, dtype=float)
+    ret = np.array([clT, 0.5 * (clp + clm), 0.5 * (clp - clm), clX]).T
+    return ret * (lo * (lo + 1) / (2 * np.pi))[:, None]
+
+_lensed_cls_cache = OrderedDict()
+def _get_lensed_cls(dls_unl, cldd, kernel='camb', maxsize=64):
+    """Lensed spectra dictionary from unlensed and residual deflection spectra, memoized by their hashes
+
+    """
+    assert kernel in ['camb', 'fullsky'], kernel
+    key = (hashlib.sha1(np.ascontiguousarray(dls_unl)).hexdigest(), hashlib.sha1(np.ascontiguousarray(cldd)).hexdigest(), kernel)
+    if key in _lensed_cls_cache:
+        _lensed_cls_cache.move_to_end(key)
+    else:
+        if kernel == 'camb':
+            try:
+                from camb.correlations import lensed_cls
+            except ImportError:
+                assert 0, "could not import camb.correlations.lensed_cls (kernel='fullsky' does not need camb)"
+            _lensed_cls_cache[key] = lensed_cls(dls_unl, cldd)
+        else:
+            _lensed_cls_cache[key] = lensed_cls_fullsky(dls_unl, cldd)
+        while len(_lensed_cls_cache) > maxsize:
+            _lensed_cls_cache.popitem(last=False)
+    return dls2cls(_lensed_cls_cache[key])
+
+
 def get_N0_iter(qe_key:str, nlev_t:float or np.ndarray, nlev_p:float or np.ndarray, beam_fwhm:float, cls_unl_fid:dict, lmin_cmb, lmax_cmb, itermax, cls_unl_dat=None,
-                lmax_qlm=None, ret_delcls=False, datnoise_cls:dict or None=None):
+                lmax_qlm=None, ret_delcls=False, datnoise_cls:dict or None=None, lensing_kernel='camb'):
     r"""Iterative lensing-N0 estimate
 
         Calculates iteratively partially lensed spectra and lensing noise levels.
@@ -191,20 +387,18 @@ def get_N0_iter(qe_key:str, nlev_t:float or np.ndarray, nlev_p:float or np.ndarr
             lmax_qlm(optional): maximum lensing multipole to consider. Defaults to 2 lmax_ivf
             ret_delcls(optional): returns the partially delensed CMB cls as well if set
             datnoise_cls(optional): feeds in custom noise spectra to the data. The nlevs and beam only apply to the filtering in this case
+            lensing_kernel(optional): 'camb' (default) to use camb *lensed_cls*, or 'fullsky' for *lensed_cls_fullsky* (no camb needed)
 
         Returns
             Array of shape (itermax + 1, lmax_qlm + 1) with all iterated N0s. First entry is standard N0.
 
 
         Note:
-            this is requiring camb python package for the lensed spectra calc.
+            The default kernel is requiring camb python package for the lensed spectra calc.
+            Lensed spectra are memoized, hence computed only once for identical fiducial and true inputs.
 
      """
     assert qe_key in ['p_p', 'p', 'ptt'], qe_key
-    try:
-        from camb.correlations import lensed_cls
-    except ImportError:
-        assert 0, "could not import camb.correlations.lensed_cls"
 
     if isinstance(lmax_cmb, dict):
         lmaxs_ivf = lmax_cmb
@@ -237,9 +431,11 @@ def get_N0_iter(qe_key:str, nlev_t:float or np.ndarray, nlev_p:float or np.ndarr
     if cls_unl_dat is None:
         cls_unl_dat = cls_unl_fid
 
+    dls_unl_true, cldd_unl_true = cls2dls(cls_unl_dat)
+    dls_unl_fid, cldd_unl_fid = cls2dls(cls_unl_fid)
     for irr, it in utils.enumerate_progress(range(itermax + 1)):
-        dls_unl_true, cldd_true = cls2dls(cls_unl_dat)
-        dls_unl_fid, cldd_fid = cls2dls(cls_unl_fid)
+        cldd_true = np.copy(cldd_unl_true)
+        cldd_fid = np.copy(cldd_unl_fid)
         if it == 0:
             rho_sqd_phi = 0.
         else:
@@ -249,8 +445,8 @@ def get_N0_iter(qe_key:str, nlev_t:float or np.ndarray, nlev_p:float or np.ndarr
 
         cldd_true *= (1. - rho_sqd_phi)  # The true residual lensing spec.
         cldd_fid *= (1. - rho_sqd_phi)  # What I think the residual lensing spec is
-        cls_plen_fid  = dls2cls(lensed_cls(dls_unl_fid, cldd_fid))
-        cls_plen_true = dls2cls(lensed_cls(dls_unl_true, cldd_true))
+        cls_plen_fid  = _get_lensed_cls(dls_unl_fid, cldd_fid, kernel=lensing_kernel)
+        cls_plen_true = _get_lensed_cls(dls_unl_true, cldd_true, kernel=lensing_kernel)
 
         cls_filt = cls_plen_fid
         cls_f = cls_plen_true
@@ -48,6 +48,14 @@ def _calc_n1L_sTP(L, cl_kind, kA, kB, k_ind, cltt, clte, clee, clttw, cltew, cle
     return n1f.n1l(L, cl_kind, kA, kB, k_ind,  cltt, clte, clee, clttw, cltew, cleew,
                    ftlA, felA, fblA, ftlB, felB, fblB, lminA, lminB, dL, lps)
 
+def _calc_n1L_jtp(L, cl_kind, kA, kB, Xp, Yp, Ip, Jp, k_ind, cltt, clte, clee, clttfid, cltefid, cleefid,
+                  FXXp, FYYp, FIIp, FJJp, lminA, lminB, dL, lps):
+    """Direct call to f90 code for joint T-P fitlering
+
+    """
+    return n1f.n1l_jtp(L, cl_kind, kA, kB, Xp, Yp, Ip, Jp, k_ind, cltt, clte, clee, clttfid, cltefid, cleefid,
+                       FXXp, FYYp, FIIp, FJJp, lminA, lminB, dL, lps)
+
 def _get_est_derived(k, lmax):
     r""" Estimator combinations with some weighting.
 
@@ -81,6 +89,39 @@ def _get_est_derived(k, lmax):
     return ret
 
 
+def _sample_adaptive(get_n1s, Lmax, rtol, n1_flat, Lstep=100, dLmin=2):
+    """Adaptive multipole sampling of a N1 curve for its cubic spline interpolation
+
+        Starting from a coarse grid, the intervals are bisected until the spline of the current samples predicts
+        the N1 at their midpoints to within rtol times the maximal (flattened) N1 amplitude.
+
+        Args:
+            get_n1s: function returning the N1 values for an array of multipoles
+            Lmax: maximal multipole
+            rtol: tolerance on the spline interpolation error, relative to the maximum of abs(n1 * n1_flat)
+            n1_flat: function used to flatten the N1 before splining
+            Lstep(optional): initial sampling step (on top of L = 1 to 10, and at least L = 1 to 4 for the cubic spline)
+            dLmin(optional): intervals are not bisected below this length
+
+        Returns:
+            sampled multipoles and N1 values
+
+    """
+    Ls = np.unique(np.concatenate([np.arange(1, max(min(10, Lmax), 4) + 1), np.arange(1, Lmax + 1)[::Lstep], [Lmax]]))
+    n1L = np.array(get_n1s(Ls))
+    intervals = [(L1, L2) for L1, L2 in zip(Ls[:-1], Ls[1:]) if L2 - L1 >= 2 * dLmin]
+    while len(intervals) > 0:
+        Ls_mid = np.array([(L1 + L2) // 2 for (L1, L2) in intervals])
+        n1L_mid = np.array(get_n1s(Ls_mid))
+        n1L_spl = spline(Ls, n1L * n1_flat(Ls), s=0., ext='raise', k=3)(Ls_mid * 1.)
+        Ls, n1L = np.concatenate([Ls, Ls_mid]), np.concatenate([n1L, n1L_mid])
+        Ls, n1L = Ls[np.argsort(Ls)], n1L[np.argsort(Ls)]
+        atol = rtol * np.max(np.abs(n1L * n1_flat(Ls)))
+        refine = np.abs(n1L_spl - n1L_mid * n1_flat(Ls_mid)) > atol
+        intervals = [(La, Lb) for (L1, L2), Lm, ref in zip(intervals, Ls_mid, refine) if ref
+                     for (La, Lb) in [(L1, Lm), (Lm, L2)] if Lb - La >= 2 * dLmin]
+    return Ls, n1L
+
 if not HASN1F:
     print("*** n1f.so fortran shared object did not load properly")
     print('*** try f2py -c -m n1f ./n1f.f90 --f90flags="-fopenmp" -lgomp from the command line in n1 directory ?')
@@ -125,12 +166,13 @@ class library_n1:
         self.lmaxphi = lps[-1]
 
         self.n1 = {}
+        self.nevals = 0  # number of N1 integrals evaluated by this instance
         if not os.path.exists(lib_dir):
             os.makedirs(lib_dir)
         if not os.path.exists(os.path.join(lib_dir, 'n1_hash.pk')):
             pk.dump(self.hashdict(), open(os.path.join(lib_dir, 'n1_hash.pk'), 'wb'), protocol=2)
         hash_check(self.hashdict(), pk.load(open(os.path.join(lib_dir, 'n1_hash.pk'), 'rb')))
-        self.npdb = sql.npdb(os.path.join(lib_dir, 'npdb.db'))
+        self.npdb = sql.npdb(os.path.join(lib_dir, 'npdb.db'), codec='raw')
         self.fldb = sql.fldb(os.path.join(lib_dir, 'fldb.db'))
 
         self.lib_dir = lib_dir
@@ -141,7 +183,7 @@ class library_n1:
 
     def get_n1(self, kA, k_ind, cl_kind, ftlA, felA, fblA, Lmax, kB=None, ftlB=None, felB=None, fblB=None,
                clttfid=None, cltefid=None, cleefid=None, n1_flat=lambda ell: np.ones(len(ell), dtype=float),
-               recache=False, remove_only=False, sglLmode=True):
+               recache=False, remove_only=False, sglLmode=True, executor=None, adaptive_rtol=None):
         r"""Calls a N1 bias
 
             Args:
@@ -163,6 +205,14 @@ class library_n1:
                 cltefid(optional): CMB TE spectrum used in QE weights (if different from instance clte for map-level CMB spectrum)
                 cleefid(optional): CMB EE spectrum used in QE weights (if different from instance clee for map-level CMB spectrum)
                 n1_flat(optional): function used to flatten the discretized output before returning splined entire array
+                executor(optional): *concurrent.futures* executor over which the calculations for each multipole are spread,
+                                    instead of MPI. Each f90 integral already runs its own OpenMP loop, so the intended use
+                                    is a ProcessPoolExecutor with OMP_NUM_THREADS tuned down accordingly
+                                    (a ThreadPoolExecutor is no faster than the serial path)
+                adaptive_rtol(optional): if set, the multipoles are sampled adaptively until the spline interpolation error
+                                         is below this tolerance relative to the maximal N1 (see *_sample_adaptive*).
+                                         With *remove_only*, all single multipole results up to Lmax are then removed.
+                                         Defaults to the fixed sampling L = 1 to 10, every 20th L and Lmax
 
             Returns:
                 N1 bias in the form of a numpy array of size Lmax + 1
@@ -187,7 +237,8 @@ class library_n1:
         if kA in estimator_keys and kB in estimator_keys:
             if kA < kB:
                 return self.get_n1(kB, k_ind, cl_kind, ftlB, felB, fblB, Lmax, ftlB=ftlA, felB=felA, fblB=fblA, kB=kA,
-                                   clttfid=clttfid, cltefid=cltefid, cleefid=cleefid, n1_flat=n1_flat, sglLmode=sglLmode)
+                                   clttfid=clttfid, cltefid=cltefid, cleefid=cleefid, n1_flat=n1_flat, sglLmode=sglLmode,
+                                   executor=executor, adaptive_rtol=adaptive_rtol)
 
             idx = 'splined_kA' + kA + '_kB' + kB + '_ind' + k_ind
             idx += '_clpp' + clhash(cl_kind)
@@ -201,6 +252,8 @@ class library_n1:
             idx += '_cltefid' + clhash(cltefid)
             idx += '_cleefid' + clhash(cleefid)
             idx += '_Lmax%s' % Lmax
+            if adaptive_rtol is not None:
+                idx += '_artol%s' % adaptive_rtol
 
             ret = self.npdb.get(idx)
             if ret is not None:
@@ -208,12 +261,25 @@ class library_n1:
                     return ret
                 else:
                     self.npdb.remove(idx)
-                    if remove_only:
+                    if remove_only and adaptive_rtol is None:
                         return np.zeros_like(ret)
                     ret = None
             if ret is None:
+                if remove_only and adaptive_rtol is not None:  # adaptively sampled multipoles unknown, removing all of them
+                    for L in range(1, Lmax + 1):
+                        self._get_n1_L(L, kA, kB, k_ind, cl_kind, ftlA, felA, fblA, ftlB, felB, fblB, clttfid, cltefid, cleefid, remove_only=True)
+                    return np.zeros(Lmax + 1)
                 Ls = np.unique(np.concatenate([[1, 2, 3, 4, 5, 6, 7, 8, 9, 10], np.arange(1, Lmax + 1)[::20], [Lmax]]))
-                if sglLmode:
+                if adaptive_rtol is not None and not remove_only:
+                    nevals = self.nevals
+                    n1s = lambda Ls: self._get_n1_Ls([self._get_n1_L_args(L, kA, kB, k_ind, cl_kind, ftlA, felA, fblA, ftlB, felB, fblB,
+                                                                          clttfid, cltefid, cleefid) for L in Ls], _calc_n1L_sTP, executor)
+                    Ls, n1L = _sample_adaptive(n1s, Lmax, adaptive_rtol, n1_flat)
+                    print("n1: %s multipoles sampled for kA %s kB %s kind %s (%s new N1 integrals)" % (len(Ls), kA, kB, k_ind, self.nevals - nevals))
+                elif executor is not None and not remove_only:
+                    n1L = self._get_n1_Ls([self._get_n1_L_args(L, kA, kB, k_ind, cl_kind, ftlA, felA, fblA, ftlB, felB, fblB,
+                                                               clttfid, cltefid, cleefid) for L in Ls], _calc_n1L_sTP, executor)
+                elif sglLmode:
                     n1L = np.zeros(len(Ls), dtype=float)
                     for i, L in enumerate(Ls[mpi.rank::mpi.size]):
                         print("n1: doing L %s kA %s kB %s kind %s" % (L, kA, kB, k_ind))
@@ -244,7 +310,8 @@ class library_n1:
                 for (tk2, cl2) in _get_est_derived(kB, Lmax):
                     tret = self.get_n1(tk1, k_ind, cl_kind, ftlA, felA, fblA, Lmax, ftlB=ftlB, felB=felB, fblB=fblB,
                                        clttfid=clttfid, cltefid=cltefid, cleefid=cleefid,
-                                       kB=tk2, n1_flat=n1_flat, sglLmode=sglLmode)
+                                       kB=tk2, n1_flat=n1_flat, sglLmode=sglLmode,
+                                       executor=executor, adaptive_rtol=adaptive_rtol)
                     tret *= cl1[:Lmax + 1]
                     tret *= cl2[:Lmax + 1]
                     ret += tret
@@ -254,7 +321,8 @@ class library_n1:
             for (tk1, cl1) in _get_est_derived(kA, Lmax):
                 tret = self.get_n1(tk1, k_ind, cl_kind, ftlA, felA, fblA, Lmax, ftlB=ftlB, felB=felB, fblB=fblB, kB=kB,
                                    clttfid=clttfid, cltefid=cltefid, cleefid=cleefid,
-                                   n1_flat=n1_flat, sglLmode=sglLmode)
+                                   n1_flat=n1_flat, sglLmode=sglLmode,
+                                       executor=executor, adaptive_rtol=adaptive_rtol)
                 tret *= cl1[:Lmax + 1]
                 ret += tret
             return ret
@@ -263,59 +331,97 @@ class library_n1:
             for (tk2, cl2) in _get_est_derived(kB, Lmax):
                 tret = self.get_n1(kA, k_ind, cl_kind, ftlA, felA, fblA, Lmax, ftlB=ftlB, felB=felB, fblB=fblB, kB=tk2,
                                    clttfid=clttfid, cltefid=cltefid, cleefid=cleefid,
-                                   n1_flat=n1_flat, sglLmode=sglLmode)
+                                   n1_flat=n1_flat, sglLmode=sglLmode,
+                                       executor=executor, adaptive_rtol=adaptive_rtol)
                 tret *= cl2[:Lmax + 1]
                 ret += tret
             return ret
         assert 0
 
-    def _get_n1_L(self, L, kA, kB, k_ind, cl_kind, ftlA, felA, fblA, ftlB, felB, fblB, clttfid, cltefid, cleefid, remove_only=False):
-        if kB is None: kB = kA
+    def _get_n1_L_args(self, L, kA, kB, k_ind, cl_kind, ftlA, felA, fblA, ftlB, felB, fblB, clttfid, cltefid, cleefid):
+        """Database key and f90 arguments of a single multipole N1 calculation
+
+        """
         assert kA in estimator_keys and kB in estimator_keys
         assert len(cl_kind) > self.lmaxphi
-        if kA in estimator_keys and kB in estimator_keys:
-            if kA < kB:
-                return self._get_n1_L(L, kB, kA, k_ind, cl_kind, ftlB, felB, fblB, ftlA, felA, fblA, clttfid, cltefid, cleefid)
+        if kA < kB:
+            return self._get_n1_L_args(L, kB, kA, k_ind, cl_kind, ftlB, felB, fblB, ftlA, felA, fblA, clttfid, cltefid, cleefid)
+        lmin_ftlA = np.min([np.where(np.abs(fal) > 0.)[0] for fal in [ftlA, felA, fblA]])
+        lmin_ftlB = np.min([np.where(np.abs(fal) > 0.)[0] for fal in [ftlB, felB, fblB]])
+        lmax_ftl = np.max([len(fal) for fal in [ftlA, felA, fblA, ftlB, felB, fblB]]) - 1
+        assert len(clttfid) > lmax_ftl and len(self.cltt) > lmax_ftl
+        assert len(cltefid) > lmax_ftl and len(self.clte) > lmax_ftl
+        assert len(cleefid) > lmax_ftl and len(self.clee) > lmax_ftl
+
+        idx = str(L) + 'kA' + kA + '_kB' + kB + '_ind' + k_ind
+        idx += '_clpp' + clhash(cl_kind)
+        idx += '_ftlA' + clhash(ftlA)
+        idx += '_felA' + clhash(felA)
+        idx += '_fblA' + clhash(fblA)
+        idx += '_ftlB' + clhash(ftlB)
+        idx += '_felB' + clhash(felB)
+        idx += '_fblB' + clhash(fblB)
+        idx += '_clttfid' + clhash(clttfid)
+        idx += '_cltefid' + clhash(cltefid)
+        idx += '_cleefid' + clhash(cleefid)
+        args = (L, cl_kind, kA, kB, k_ind, self.cltt, self.clte, self.clee, clttfid, cltefid, cleefid,
+                ftlA, felA, fblA, ftlB, felB, fblB, lmin_ftlA, lmin_ftlB, self.dL, self.lps)
+        return idx, args
+
+    def _get_n1_L(self, L, kA, kB, k_ind, cl_kind, ftlA, felA, fblA, ftlB, felB, fblB, clttfid, cltefid, cleefid, remove_only=False):
+        if kB is None: kB = kA
+        idx, args = self._get_n1_L_args(L, kA, kB, k_ind, cl_kind, ftlA, felA, fblA, ftlB, felB, fblB, clttfid, cltefid, cleefid)
+        n1_L = self.fldb.get(idx)
+        if n1_L is None:
+            if remove_only:
+                return 0.
+            n1_L = _calc_n1L_sTP(*args)
+            self.nevals += 1
+            self.fldb.add(idx, n1_L)
+            return n1_L
+        else:
+            if remove_only:
+                self.fldb.remove(idx)
+                return 0.
+            return n1_L
+
+    def _get_n1_Ls(self, idxs_args, calc, executor):
+        """Collects single multipole N1 calculations, spreading the ones not yet in the database over the executor
+
+            Args:
+                idxs_args: list of (database key, *calc* arguments) tuples, or None for vanishing terms
+                calc: module-level function performing the f90 call
+                executor: *concurrent.futures* executor. If None, the calculations are spread over the MPI ranks
+
+        """
+        idxs = [idx_args[0] for idx_args in idxs_args if idx_args is not None]
+        cached = dict(zip(idxs, self.fldb.get_many(idxs)))
+        todo = {idx: args for (idx, args) in [idx_args for idx_args in idxs_args if idx_args is not None] if cached[idx] is None}
+        if len(todo) > 0:
+            args = list(todo.values())
+            if executor is not None:
+                n1Ls = list(executor.map(calc, *zip(*args)))
             else:
-                lmin_ftlA = np.min([np.where(np.abs(fal) > 0.)[0] for fal in [ftlA, felA, fblA]])
-                lmin_ftlB = np.min([np.where(np.abs(fal) > 0.)[0] for fal in [ftlB, felB, fblB]])
-                lmax_ftl = np.max([len(fal) for fal in [ftlA, felA, fblA, ftlB, felB, fblB]]) - 1
-                assert len(clttfid) > lmax_ftl and len(self.cltt) > lmax_ftl
-                assert len(cltefid) > lmax_ftl and len(self.clte) > lmax_ftl
-                assert len(cleefid) > lmax_ftl and len(self.clee) > lmax_ftl
-
-                idx = str(L) + 'kA' + kA + '_kB' + kB + '_ind' + k_ind
-                idx += '_clpp' + clhash(cl_kind)
-                idx += '_ftlA' + clhash(ftlA)
-                idx += '_felA' + clhash(felA)
-                idx += '_fblA' + clhash(fblA)
-                idx += '_ftlB' + clhash(ftlB)
-                idx += '_felB' + clhash(felB)
-                idx += '_fblB' + clhash(fblB)
-                idx += '_clttfid' + clhash(clttfid)
-                idx += '_cltefid' + clhash(cltefid)
-                idx += '_cleefid' + clhash(cleefid)
-
-                n1_L = self.fldb.get(idx)
-
-                if n1_L is None:
-                    if remove_only:
-                        return 0.
-                    n1_L = n1f.n1l(L, cl_kind, kA, kB, k_ind,
-                                  self.cltt, self.clte, self.clee, clttfid, cltefid, cleefid,
-                                  ftlA, felA, fblA, ftlB, felB, fblB,
-                                  lmin_ftlA, lmin_ftlB,  self.dL, self.lps)
-                    self.fldb.add(idx, n1_L)
-                    return n1_L
-                else:
-                    if remove_only:
-                        self.fldb.remove(idx)
-                        return 0.
-                    return n1_L
-        assert 0
+                n1Ls = {i: calc(*args[i]) for i in range(mpi.rank, len(args), mpi.size)}
+                if mpi.size > 1:
+                    for n1Ls_rank in mpi.allgather(n1Ls):
+                        n1Ls.update(n1Ls_rank)
+                n1Ls = [n1Ls[i] for i in range(len(args))]
+            self.nevals += len(todo)
+            if mpi.rank == 0:
+                self.fldb.add_many(list(todo.keys()), n1Ls)
+            mpi.barrier()
+            cached.update(zip(todo.keys(), n1Ls))
+        return np.array([0. if idx_args is None else cached[idx_args[0]] for idx_args in idxs_args], dtype=float)
 
     def get_n1_jtp(self, kA, k_ind, cl_kind, fAlmat, Lmax, kB=None, fBlmat=None,
-            clttfid=None, cltefid=None, cleefid=None, n1_flat=lambda ell: np.ones(len(ell), dtype=float)):
+            clttfid=None, cltefid=None, cleefid=None, n1_flat=lambda ell: np.ones(len(ell), dtype=float), executor=None,
+            adaptive_rtol=None):
+        r"""Calls a N1 bias for jointly filtered temperature and polarization
+
+            Same as *get_n1*, with the filtering given by the dictionaries of matrix elements *fAlmat* and *fBlmat*.
+
+        """
 
         if kB is None: kB = kA
         # FIXME:
@@ -331,7 +437,8 @@ class library_n1:
         if kA in estimator_keys and kB in estimator_keys:
             if kA < kB:
                 return self.get_n1_jtp(kB, k_ind, cl_kind, fBlmat, Lmax, fBlmat=fAlmat, kB=kA,
-                                   clttfid=clttfid, cltefid=cltefid, cleefid=cleefid, n1_flat=n1_flat)
+                                   clttfid=clttfid, cltefid=cltefid, cleefid=cleefid, n1_flat=n1_flat,
+                                   executor=executor, adaptive_rtol=adaptive_rtol)
 
 
             X, Y = kA[1:]
@@ -360,17 +467,29 @@ class library_n1:
                                             idx += '_cltefid' + clhash(cltefid)
                                             idx += '_cleefid' + clhash(cleefid)
                                             idx += '_Lmax%s' % Lmax
+                                            if adaptive_rtol is not None:
+                                                idx += '_artol%s' % adaptive_rtol
 
                                             if self.npdb.get(idx) is None:
                                                 Ls = np.unique(np.concatenate([[1, 2, 3, 4, 5, 6, 7, 8, 9, 10], np.arange(1, Lmax + 1)[::20], [Lmax]]))
-                                                n1L = np.zeros(len(Ls), dtype=float)
-                                                for i, L in enumerate(Ls):
-                                                    print("n1: doing L %s kA %s kB %s kind %s " % (L, kA, kB, k_ind)  + Xp + Yp + Ip + Jp)
-                                                    n1L[i] = (self._get_n1_L_jtp(L, kA, kB, k_ind, cl_kind, Xp, Yp, Ip, Jp, fAlmat, fBlmat, clttfid, cltefid, cleefid))
-                                                ret = np.zeros(Lmax + 1)
-                                                ret[1:] =  spline(Ls, np.array(n1L) * n1_flat(Ls), s=0., ext='raise', k=3)(np.arange(1, Lmax + 1) * 1.)
-                                                ret[1:] *= cli(n1_flat(np.arange(1, Lmax + 1) * 1.))
-                                                self.npdb.add(idx, ret)
+                                                if adaptive_rtol is not None:
+                                                    nevals = self.nevals
+                                                    n1s = lambda Ls: self._get_n1_Ls([self._get_n1_L_jtp_args(L, kA, kB, k_ind, cl_kind, Xp, Yp, Ip, Jp, fAlmat, fBlmat,
+                                                                                                              clttfid, cltefid, cleefid) for L in Ls], _calc_n1L_jtp, executor)
+                                                    Ls, n1L = _sample_adaptive(n1s, Lmax, adaptive_rtol, n1_flat)
+                                                    print("n1: %s multipoles sampled for kA %s kB %s kind %s %s (%s new N1 integrals)" % (len(Ls), kA, kB, k_ind, Xp + Yp + Ip + Jp, self.nevals - nevals))
+                                                elif executor is not None:
+                                                    n1L = self._get_n1_Ls([self._get_n1_L_jtp_args(L, kA, kB, k_ind, cl_kind, Xp, Yp, Ip, Jp, fAlmat, fBlmat,
+                                                                                                   clttfid, cltefid, cleefid) for L in Ls], _calc_n1L_jtp, executor)
+                                                else:
+                                                    n1L = np.zeros(len(Ls), dtype=float)
+                                                    for i, L in enumerate(Ls):
+                                                        print("n1: doing L %s kA %s kB %s kind %s " % (L, kA, kB, k_ind)  + Xp + Yp + Ip + Jp)
+                                                        n1L[i] = (self._get_n1_L_jtp(L, kA, kB, k_ind, cl_kind, Xp, Yp, Ip, Jp, fAlmat, fBlmat, clttfid, cltefid, cleefid))
+                                                n1_spl = np.zeros(Lmax + 1)
+                                                n1_spl[1:] =  spline(Ls, np.array(n1L) * n1_flat(Ls), s=0., ext='raise', k=3)(np.arange(1, Lmax + 1) * 1.)
+                                                n1_spl[1:] *= cli(n1_flat(np.arange(1, Lmax + 1) * 1.))
+                                                self.npdb.add(idx, n1_spl)
                                             ret = ret +  self.npdb.get(idx)
             return ret
         if (kA in estimator_keys_derived) or (kB in estimator_keys_derived):
@@ -378,59 +497,67 @@ class library_n1:
             for (tk1, cl1) in _get_est_derived(kA, Lmax):
                 for (tk2, cl2) in _get_est_derived(kB, Lmax):
                     tret = self.get_n1_jtp(tk1, k_ind, cl_kind, fAlmat, Lmax, kB=tk2, fBlmat=fBlmat,
-                                    clttfid=clttfid, cltefid=cltefid, cleefid=cleefid, n1_flat=n1_flat)
+                                    clttfid=clttfid, cltefid=cltefid, cleefid=cleefid, n1_flat=n1_flat,
+                                   executor=executor, adaptive_rtol=adaptive_rtol)
                     ret = ret + tret * cl1[:Lmax + 1] * cl2[:Lmax + 1]
             return ret
         assert 0
 
+    def _get_n1_L_jtp_args(self, L, kA, kB, k_ind, cl_kind, Xp, Yp, Ip, Jp, fAlmat, fBlmat, clttfid, cltefid, cleefid):
+        """Database key and f90 arguments of a single multipole N1 calculation (None if one of the filters vanishes)
+
+        """
+        assert kA in estimator_keys and kB in estimator_keys
+        assert kA >= kB, 'fix this'
+        X, Y = kA[1:]
+        I, J = kB[1:]
+        FXXp = fAlmat.get(X + Xp, fAlmat.get(Xp + X, None))
+        if FXXp is None: return None
+
+        FYYp = fAlmat.get(Y + Yp, fAlmat.get(Yp + Y, None))
+        if FYYp is None: return None
+
+        FIIp = fBlmat.get(I + Ip, fBlmat.get(Ip + I, None))
+        if FIIp is None: return None
+
+        FJJp = fBlmat.get(J + Jp, fBlmat.get(Jp + J, None))
+        if FJJp is None: return None
+
+        lmax_ftl = np.max([FXXp.size, FYYp.size, FIIp.size, FJJp.size]) - 1
+        lmin_ftlA = np.min([np.where(np.abs(fal) > 0.)[0] for fal in [FXXp, FYYp]])
+        lmin_ftlB = np.min([np.where(np.abs(fal) > 0.)[0] for fal in [FIIp, FJJp]])
+        assert len(clttfid) > lmax_ftl and len(self.cltt) > lmax_ftl
+        assert len(cltefid) > lmax_ftl and len(self.clte) > lmax_ftl
+        assert len(cleefid) > lmax_ftl and len(self.clee) > lmax_ftl
+        assert (FXXp.size == FYYp.size) and (FIIp.size == FJJp.size)
+        assert len(cl_kind) > self.lmaxphi
+
+        idx = str(L)  + X + Xp + Y + Yp + I + Ip + J + Jp
+        idx += '_clpp' + clhash(cl_kind)
+        idx += '_fXXp' + clhash(FXXp)
+        idx += '_fYYp' + clhash(FYYp)
+        idx += '_fIIp' + clhash(FIIp)
+        idx += '_fJJp' + clhash(FJJp)
+        idx += '_clttfid' + clhash(clttfid)
+        idx += '_cltefid' + clhash(cltefid)
+        idx += '_cleefid' + clhash(cleefid)
+        # n1L_jtp(L, cl_kI, kA, kB, XpIp, YpJp, kI, cltt, clte, clee, clttfid, cltefid,
+        #        cleefid, &
+        # fXXp, fYYp, fIIp, fJJp, lminA, lmaxA, lminB, lmaxB, lmaxI, &
+        # lmaxtt, lmaxte, lmaxee, lmaxttfid, lmaxtefid, lmaxeefid, dL, lps, nlps)
+        args = (L, cl_kind, kA, kB, Xp, Yp, Ip, Jp, k_ind, self.cltt, self.clte, self.clee, clttfid, cltefid, cleefid,
+                FXXp, FYYp, FIIp, FJJp, lmin_ftlA, lmin_ftlB, self.dL, self.lps)
+        return idx, args
+
     def _get_n1_L_jtp(self, L, kA, kB, k_ind, cl_kind, Xp, Yp, Ip, Jp, fAlmat, fBlmat, clttfid, cltefid, cleefid):
-            if kB is None: kB = kA
-            if kA in estimator_keys and kB in estimator_keys:
-                if kA < kB:
-                    assert 0, 'fix this'
-                else:
-                    X, Y = kA[1:]
-                    I, J = kB[1:]
-                    FXXp = fAlmat.get(X + Xp, fAlmat.get(Xp + X, None))
-                    if FXXp is None: return 0.
-
-                    FYYp = fAlmat.get(Y + Yp, fAlmat.get(Yp + Y, None))
-                    if FYYp is None: return 0.
-
-                    FIIp = fBlmat.get(I + Ip, fBlmat.get(Ip + I, None))
-                    if FIIp is None: return 0.
-
-                    FJJp = fBlmat.get(J + Jp, fBlmat.get(Jp + J, None))
-                    if FJJp is None: return 0.
-
-                    lmax_ftl = np.max([FXXp.size, FYYp.size, FIIp.size, FJJp.size]) - 1
-                    lmin_ftlA = np.min([np.where(np.abs(fal) > 0.)[0] for fal in [FXXp, FYYp]])
-                    lmin_ftlB = np.min([np.where(np.abs(fal) > 0.)[0] for fal in [FIIp, FJJp]])
-                    assert len(clttfid) > lmax_ftl and len(self.cltt) > lmax_ftl
-                    assert len(cltefid) > lmax_ftl and len(self.clte) > lmax_ftl
-                    assert len(cleefid) > lmax_ftl and len(self.clee) > lmax_ftl
-                    assert (FXXp.size == FYYp.size) and (FIIp.size == FJJp.size)
-                    assert len(cl_kind) > self.lmaxphi
-
-                    idx = str(L)  + X + Xp + Y + Yp + I + Ip + J + Jp
-                    idx += '_clpp' + clhash(cl_kind)
-                    idx += '_fXXp' + clhash(FXXp)
-                    idx += '_fYYp' + clhash(FYYp)
-                    idx += '_fIIp' + clhash(FIIp)
-                    idx += '_fJJp' + clhash(FJJp)
-                    idx += '_clttfid' + clhash(clttfid)
-                    idx += '_cltefid' + clhash(cltefid)
-                    idx += '_cleefid' + clhash(cleefid)
-                    # n1L_jtp(L, cl_kI, kA, kB, XpIp, YpJp, kI, cltt, clte, clee, clttfid, cltefid,
-                    #        cleefid, &
-                    # fXXp, fYYp, fIIp, fJJp, lminA, lmaxA, lminB, lmaxB, lmaxI, &
-                    # lmaxtt, lmaxte, lmaxee, lmaxttfid, lmaxtefid, lmaxeefid, dL, lps, nlps)
-                    if self.fldb.get(idx) is None:
-                        n1_L = n1f.n1l_jtp(L, cl_kind, kA, kB, Xp, Yp, Ip, Jp, k_ind,
-                                       self.cltt, self.clte, self.clee, clttfid, cltefid, cleefid,
-                                       FXXp, FYYp, FIIp, FJJp,
-                                       lmin_ftlA, lmin_ftlB, self.dL, self.lps)
-                        self.fldb.add(idx, n1_L)
-                        return n1_L
-                    return self.fldb.get(idx)
-            assert 0
+        if kB is None: kB = kA
+        idx_args = self._get_n1_L_jtp_args(L, kA, kB, k_ind, cl_kind, Xp, Yp, Ip, Jp, fAlmat, fBlmat, clttfid, cltefid, cleefid)
+        if idx_args is None:
+            return 0.
+        idx, args = idx_args
+        n1_L = self.fldb.get(idx)
+        if n1_L is None:
+            n1_L = _calc_n1L_jtp(*args)
+            self.nevals += 1
+            self.fldb.add(idx, n1_L)
+        return n1_L
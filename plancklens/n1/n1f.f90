@@ -129,6 +129,7 @@ end
 double precision function n1L(L, cl_kI, kA, kB, kI, cltt, clte, clee, clttfid, cltefid, cleefid, &
                     ftlA, felA, fblA, ftlB, felB, fblB, lminA, lmaxA, lminB, lmaxB, lmaxI, &
                     lmaxtt, lmaxte, lmaxee, lmaxttfid, lmaxtefid, lmaxeefid, dL, lps, nlps)
+    !f2py threadsafe
     implicit None
     integer, intent(in) :: L, lmaxA, lmaxB, lmaxI, lminA, lminB, dL
     integer, intent(in) :: lmaxtt, lmaxte, lmaxee, lmaxttfid, lmaxtefid, lmaxeefid
@@ -280,6 +281,7 @@ end
 double precision function n1L_jtp(L, cl_kI, kA, kB, Xp, Yp, Ip, Jp, kI, cltt, clte, clee, clttfid, cltefid, cleefid, &
                     fXXp, fYYp, fIIp, fJJp, lminA, lmaxA, lminB, lmaxB, lmaxI, &
                     lmaxtt, lmaxte, lmaxee, lmaxttfid, lmaxtefid, lmaxeefid, dL, lps, nlps)
+    !f2py threadsafe
     implicit None
     integer, intent(in) :: L, lmaxA, lmaxB, lmaxI, lminA, lminB, dL
     integer, intent(in) :: lmaxtt, lmaxte, lmaxee, lmaxttfid, lmaxtefid, lmaxeefid
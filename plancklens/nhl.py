@@ -42,43 +42,61 @@ def get_nhl(qe_key1, qe_key2, cls_weights, cls_ivfs, lmax_ivf1, lmax_ivf2,
     return  _get_nhl(qes1, qes2, cls_ivfs, lmax_out, cls_ivfs_bb=cls_ivfs_bb, cls_ivfs_ab=cls_ivfs_ab)
 
 def _get_nhl(qes1, qes2, cls_ivfs, lmax_out, cls_ivfs_bb=None, cls_ivfs_ab=None, ret_terms=False):
-    GG_N0 = np.zeros(lmax_out + 1, dtype=float)
-    CC_N0 = np.zeros(lmax_out + 1, dtype=float)
-    GC_N0 = np.zeros(lmax_out + 1, dtype=float)
-    CG_N0 = np.zeros(lmax_out + 1, dtype=float)
-
     cls_ivfs_aa = cls_ivfs
     cls_ivfs_bb = cls_ivfs if cls_ivfs_bb is None else cls_ivfs_bb
     cls_ivfs_ab = cls_ivfs if cls_ivfs_ab is None else cls_ivfs_ab
+    # collects all Wigner transforms first, to evaluate them grouped by spins
+    jobs = _get_nhl_jobs(qes1, qes2, cls_ivfs_aa, cls_ivfs_bb, cls_ivfs_ab)
+    Rs = uspin.wignerc_grouped(jobs, lmax_out=lmax_out)
+    return _sum_nhl_terms(qes1, qes2, Rs, lmax_out, (lmax_out + 1,), ret_terms=ret_terms)
+
+def _get_nhl_jobs(qes1, qes2, cls_ivfs_aa, cls_ivfs_bb, cls_ivfs_ab):
     cls_ivfs_ba = cls_ivfs_ab
-    if ret_terms:
-        terms = []
+    jobs = []
     for qe1 in qes1:
-        cL1 = qe1.cL(np.arange(lmax_out + 1))
         for qe2 in qes2:
-            cL2 = qe2.cL(np.arange(lmax_out + 1))
             si, ti, ui, vi = (qe1.leg_a.spin_in, qe1.leg_b.spin_in, qe2.leg_a.spin_in, qe2.leg_b.spin_in)
             so, to, uo, vo = (qe1.leg_a.spin_ou, qe1.leg_b.spin_ou, qe2.leg_a.spin_ou, qe2.leg_b.spin_ou)
             assert so + to >= 0 and uo + vo >= 0, (so, to, uo, vo)
 
             clsu = utils.joincls([qe1.leg_a.cl, qe2.leg_a.cl.conj(), uspin.spin_cls(si, ui, cls_ivfs_aa)])
             cltv = utils.joincls([qe1.leg_b.cl, qe2.leg_b.cl.conj(), uspin.spin_cls(ti, vi, cls_ivfs_bb)])
-            R_sutv = utils.joincls([uspin.wignerc(clsu, cltv, so, uo, to, vo, lmax_out=lmax_out), cL1, cL2])
+            jobs.append((clsu, cltv, so, uo, to, vo))
 
             clsv = utils.joincls([qe1.leg_a.cl, qe2.leg_b.cl.conj(), uspin.spin_cls(si, vi, cls_ivfs_ab)])
             cltu = utils.joincls([qe1.leg_b.cl, qe2.leg_a.cl.conj(), uspin.spin_cls(ti, ui, cls_ivfs_ba)])
-            R_sutv = R_sutv + utils.joincls([uspin.wignerc(clsv, cltu, so, vo, to, uo, lmax_out=lmax_out), cL1, cL2])
+            jobs.append((clsv, cltu, so, vo, to, uo))
 
             # we now need -s-t uv
             sgnms = (-1) ** (si + so)
             sgnmt = (-1) ** (ti + to)
             clsu = utils.joincls([sgnms * qe1.leg_a.cl.conj(), qe2.leg_a.cl.conj(), uspin.spin_cls(-si, ui, cls_ivfs_aa)])
             cltv = utils.joincls([sgnmt * qe1.leg_b.cl.conj(), qe2.leg_b.cl.conj(), uspin.spin_cls(-ti, vi, cls_ivfs_bb)])
-            R_msmtuv = utils.joincls([uspin.wignerc(clsu, cltv, -so, uo, -to, vo, lmax_out=lmax_out), cL1, cL2])
+            jobs.append((clsu, cltv, -so, uo, -to, vo))
 
             clsv = utils.joincls([sgnms * qe1.leg_a.cl.conj(), qe2.leg_b.cl.conj(), uspin.spin_cls(-si, vi, cls_ivfs_ab)])
             cltu = utils.joincls([sgnmt * qe1.leg_b.cl.conj(), qe2.leg_a.cl.conj(), uspin.spin_cls(-ti, ui, cls_ivfs_ba)])
-            R_msmtuv = R_msmtuv + utils.joincls([uspin.wignerc(clsv, cltu, -so, vo, -to, uo, lmax_out=lmax_out), cL1, cL2])
+            jobs.append((clsv, cltu, -so, vo, -to, uo))
+    return jobs
+
+def _sum_nhl_terms(qes1, qes2, Rs, lmax_out, shape, ret_terms=False):
+    GG_N0 = np.zeros(shape, dtype=float)
+    CC_N0 = np.zeros(shape, dtype=float)
+    GC_N0 = np.zeros(shape, dtype=float)
+    CG_N0 = np.zeros(shape, dtype=float)
+    if ret_terms:
+        terms = []
+    Rs = iter(Rs)
+    for qe1 in qes1:
+        cL1 = qe1.cL(np.arange(lmax_out + 1))
+        for qe2 in qes2:
+            cL2 = qe2.cL(np.arange(lmax_out + 1))
+            so, to = (qe1.leg_a.spin_ou, qe1.leg_b.spin_ou)
+            cL12 = utils.joincls([cL1, cL2])
+            R_sutv = next(Rs) * cL12
+            R_sutv = R_sutv + next(Rs) * cL12
+            R_msmtuv = next(Rs) * cL12
+            R_msmtuv = R_msmtuv + next(Rs) * cL12
 
             GG_N0 +=  0.5 * R_sutv.real
             GG_N0 +=  0.5 * (-1) ** (to + so) * R_msmtuv.real
@@ -95,6 +113,22 @@ def _get_nhl(qes1, qes2, cls_ivfs, lmax_out, cls_ivfs_bb=None, cls_ivfs_ab=None,
                 terms += [0.5 * R_sutv, 0.5 * (-1) ** (to + so) * R_msmtuv]
     return (GG_N0, CC_N0, GC_N0, CG_N0) if not ret_terms else (GG_N0, CC_N0, GC_N0, CG_N0, terms)
 
+def _get_nhl_many(qes1, qes2, cls_ivfs_list, lmax_out):
+    """Same as *_get_nhl* for a list of inverse-variance filtered spectra dictionaries (e.g. one per simulation).
+
+        The QE weights and quadrature setup are shared, and the position-space transforms are performed on 2d stacks.
+
+        Returns:
+            4-tuple of (len(cls_ivfs_list), lmax_out + 1) arrays GG, CC, GC, CG
+
+    """
+    jobs = [_get_nhl_jobs(qes1, qes2, cls_ivfs, cls_ivfs, cls_ivfs) for cls_ivfs in cls_ivfs_list]
+    Rs = uspin.wignerc_grouped([job for jobs_i in jobs for job in jobs_i], lmax_out=lmax_out)
+    njobs = len(jobs[0]) if len(jobs) > 0 else 0
+    # stacks the outputs of all spectra, job by job
+    Rs = [np.array(Rs[j::njobs]) for j in range(njobs)]
+    return _sum_nhl_terms(qes1, qes2, Rs, lmax_out, (len(cls_ivfs_list), lmax_out + 1))
+
 class nhl_lib_simple:
     """Semi-analytical unnormalized N0 library.
 
@@ -122,9 +156,18 @@ class nhl_lib_simple:
         utils.hash_check(pk.load(open(fn_hash, 'rb')), self.hashdict())
 
         self.lib_dir = lib_dir
-        self.npdb = sql.npdb(os.path.join(lib_dir, 'npdb.db'))
-        self.fsky = np.mean(self.ivfs.get_fmask())
+        self.npdb = sql.npdb(os.path.join(lib_dir, 'npdb.db'), codec='raw')
         self.resplib = resplib
+        self._fsky = None
+
+    @property
+    def fsky(self):
+        # The mask is only read once, the first time this is ever needed
+        if self._fsky is None:
+            if self.npdb.get('fsky') is None:
+                self.npdb.add('fsky', np.array([np.mean(self.ivfs.get_fmask())]))
+            self._fsky = self.npdb.get('fsky')[0]
+        return self._fsky
 
     def hashdict(self):
         ret = {k: utils.clhash(self.cls_weight[k]) for k in self.cls_weight.keys()}
@@ -171,18 +214,70 @@ class nhl_lib_simple:
                 ret += w1 * w2 * self.npdb.get(fn + suf)
         return ret
 
+    def get_sim_nhls(self, idxs, k1, k2):
+        """Same as *get_sim_nhl* for a set of simulations, calculating all missing ones together.
+
+            Args:
+                idxs: simulation indices
+                k1: QE key 1
+                k2: QE key 2
+
+            Returns:
+                (len(idxs), lmax_qlm + 1) array
+
+        """
+        for idx in idxs:
+            assert idx == -1 or idx >= 0, idx
+        sufs = [('sim%04d'%idx) * (int(idx) >= 0) +  'dat' * (idx == -1) for idx in idxs]
+        ret = np.zeros((len(idxs), self.lmax_qlm + 1))
+        for k1, w1 in self._get_qe_derived(k1):
+            for k2, w2 in self._get_qe_derived(k2):
+                s1, GC1, s1ins, ksp1 = qresp.qe_spin_data(k1)
+                s2, GC2, s2ins, ksp2 = qresp.qe_spin_data(k2)
+                fn = 'anhl_qe_' + ksp1 + k1[1:] + '_qe_' + ksp2 +  k2[1:]
+                N0s = self.npdb.get_many([fn + GC1 + GC2 + suf for suf in sufs])
+                todo = [i for i, N0 in enumerate(N0s) if N0 is None]
+                if len(todo) > 0:
+                    assert s1 >= 0 and s2 >= 0, (s1, s2)
+                    spins = np.unique(np.concatenate([s1ins, s2ins]))
+                    cls_ivfs_list, lmax_ivfs = zip(*[self._get_cls(idxs[i], spins) for i in todo])
+                    assert len(np.unique(lmax_ivfs)) == 1, lmax_ivfs
+                    lmax_ivf = lmax_ivfs[0]
+                    qes1 = qresp.get_qes(k1, lmax_ivf, self.cls_weight, lmax2=lmax_ivf)
+                    qes2 = qresp.get_qes(k2, lmax_ivf, self.cls_weight, lmax2=lmax_ivf)
+                    GG, CC, GC, CG = _get_nhl_many(qes1, qes2, cls_ivfs_list, self.lmax_qlm)
+                    fns = [('G', 'G', GG) ] + [('C', 'G', CG)] * (s1 > 0) + [('G', 'C', GC)] * (s2 > 0) + [('C', 'C', CC)] * (s1 > 0) * (s2 > 0)
+                    for _GC1, _GC2, N0 in fns:
+                        self.npdb.add_many([fn + _GC1 + _GC2 + sufs[i] for i in todo], [N0[j] for j in range(len(todo))])
+                    N0s = self.npdb.get_many([fn + GC1 + GC2 + suf for suf in sufs])
+                ret += w1 * w2 * np.array(N0s)
+        return ret
+
     def _get_cls(self, idx, spins):
+        """Empirical spectra of the filtered maps of a simulation
+
+            These are stored in the library npdb the first time they are needed, each filtered alm being read once.
+
+        """
         assert np.all(spins >= 0), spins
-        ret = {}
-        if 0 in spins:
-            ret['tt'] = hp.alm2cl(self.ivfs.get_sim_tlm(idx)) / self.fsky
-        if 2 in spins:
-            ret['ee'] = hp.alm2cl(self.ivfs.get_sim_elm(idx)) / self.fsky
-            ret['bb'] = hp.alm2cl(self.ivfs.get_sim_blm(idx)) / self.fsky
-            ret['eb'] = hp.alm2cl(self.ivfs.get_sim_elm(idx), alms2=self.ivfs.get_sim_blm(idx)) / self.fsky
-        if 0 in spins and 2 in spins:
-            ret['te'] = hp.alm2cl(self.ivfs.get_sim_tlm(idx), alms2=self.ivfs.get_sim_elm(idx)) / self.fsky
-            ret['tb'] = hp.alm2cl(self.ivfs.get_sim_tlm(idx), alms2=self.ivfs.get_sim_blm(idx)) / self.fsky
+        labs = ['tt'] * (0 in spins) + ['ee', 'bb', 'eb'] * (2 in spins) + ['te', 'tb'] * (0 in spins and 2 in spins)
+        suf = ('sim%04d'%idx) * (int(idx) >= 0) +  'dat' * (idx == -1)
+        fns = ['ivfcl_' + lab + '_' + suf for lab in labs]
+        cls = dict(zip(labs, self.npdb.get_many(fns)))
+        missing = [lab for lab in labs if cls[lab] is None]
+        if len(missing) > 0:
+            alms = {}
+            if 't' in ''.join(missing):
+                alms['t'] = self.ivfs.get_sim_tlm(idx)
+            if 'e' in ''.join(missing):
+                alms['e'] = self.ivfs.get_sim_elm(idx)
+            if 'b' in ''.join(missing):
+                alms['b'] = self.ivfs.get_sim_blm(idx)
+            for lab in missing:
+                cls[lab] = hp.alm2cl(alms[lab[0]], alms2=alms[lab[1]])
+            del alms
+            self.npdb.add_many(['ivfcl_' + lab + '_' + suf for lab in missing], [cls[lab] for lab in missing])
+        ret = {lab: cls[lab] / self.fsky for lab in labs}
         lmaxs = [len(cl) for cl in ret.values()]
         assert len(np.unique(lmaxs)) == 1, lmaxs
         return ret, lmaxs[0]
@@ -214,7 +309,7 @@ def dls2cls(dls):
 
 
 def get_N0_iter(qe_key:str, nlev_t:float, nlev_p:float, beam_fwhm:float, cls_unl_fid:dict, lmin_ivf, lmax_ivf, itermax, cls_unl_dat=None,
-                lmax_qlm=None, ret_delcls=False, datnoise_cls:dict or None=None, unlQE=False, version='1'):
+                lmax_qlm=None, ret_delcls=False, datnoise_cls:dict or None=None, unlQE=False, version='1', lensing_kernel='camb'):
     """Iterative lensing-N0 estimate
 
         Calculates iteratively partially lensed spectra and lensing noise levels.
@@ -234,6 +329,7 @@ def get_N0_iter(qe_key:str, nlev_t:float, nlev_p:float, beam_fwhm:float, cls_unl
             lmax_qlm(optional): maximum lensing multipole to consider. Defaults to :math:`2 lmax_ivf`
             ret_delcls(optional): returns the partially delensed CMB cls as well if set
             datnoise_cls(optional): feeds in custom noise spectra to the data. The nlevs and beam only apply to the filtering in this case
+            lensing_kernel(optional): 'camb' (default) or 'fullsky' (see *n0s.lensed_cls_fullsky*, no camb needed)
 
         Returns
             Array of shape (itermax + 1, lmax_qlm + 1) with all iterated N0s. First entry is standard N0.
@@ -241,15 +337,12 @@ def get_N0_iter(qe_key:str, nlev_t:float, nlev_p:float, beam_fwhm:float, cls_unl
 
         Note: This assumes the unlensed spectra are known
 
-    #FIXME: this is requiring the full camb python package for the lensed spectra calc.
+        Note: Lensed spectra are memoized, and computed only once if the fiducial and true inputs are identical.
 
      """
+    from plancklens.n0s import _get_lensed_cls  # n0s imports this module
     assert qe_key in ['p_p', 'p', 'ptt'], qe_key
-    try:
-        from camb.correlations import lensed_cls
-    except ImportError:
-        assert 0, "could not import camb.correlations.lensed_cls"
-
+    lensed_cls = lambda dls, cldd: _get_lensed_cls(dls, cldd, kernel=lensing_kernel)
 
     if lmax_qlm is None:
         lmax_qlm = 2 * lmax_ivf
@@ -273,18 +366,19 @@ def get_N0_iter(qe_key:str, nlev_t:float, nlev_p:float, beam_fwhm:float, cls_unl
 
     N0_unbiased = np.inf
     N1_unbiased = np.inf
-    dls_unl_fid, cldd_fid = cls2dls(cls_unl_fid)
-    cls_len_fid= dls2cls(lensed_cls(dls_unl_fid, cldd_fid))
+    dls_unl_fid0, cldd_unl_fid = cls2dls(cls_unl_fid)
+    cls_len_fid = lensed_cls(dls_unl_fid0, cldd_unl_fid)
     if cls_unl_dat is None:
         cls_unl_dat = cls_unl_fid
+        dls_unl_true0, cldd_unl_true = dls_unl_fid0, cldd_unl_fid
         cls_len_true= cls_len_fid
     else:
-        dls_unl_true, cldd_true = cls2dls(cls_unl_dat)
-        cls_len_true= dls2cls(lensed_cls(dls_unl_true, cldd_true))
+        dls_unl_true0, cldd_unl_true = cls2dls(cls_unl_dat)
+        cls_len_true= lensed_cls(dls_unl_true0, cldd_unl_true)
     cls_plen_true = cls_len_true
     for irr, it in utils.enumerate_progress(range(itermax + 1)):
-        dls_unl_true, cldd_true = cls2dls(cls_unl_dat)
-        dls_unl_fid, cldd_fid = cls2dls(cls_unl_fid)
+        dls_unl_true, cldd_true = np.copy(dls_unl_true0), np.copy(cldd_unl_true)
+        dls_unl_fid, cldd_fid = np.copy(dls_unl_fid0), np.copy(cldd_unl_fid)
         if it == 0:
             rho_sqd_phi = 0.
         else:
@@ -304,16 +398,19 @@ def get_N0_iter(qe_key:str, nlev_t:float, nlev_p:float, beam_fwhm:float, cls_unl
             cldd_fid *= rho_sqd_phi
             cldd_true *= rho_sqd_phi
 
-            cls_plen_fid_resolved = dls2cls(lensed_cls(dls_unl_fid, cldd_fid))
-            cls_plen_true_resolved = dls2cls(lensed_cls(dls_unl_true, cldd_true))
+            cls_plen_fid_resolved = lensed_cls(dls_unl_fid, cldd_fid)
+            cls_plen_true_resolved = lensed_cls(dls_unl_true, cldd_true)
             cls_plen_fid =  {ck: cls_len_fid[ck] - (cls_plen_fid_resolved[ck] - cls_unl_fid[ck][:len(cls_len_fid[ck])]) for ck in cls_len_fid.keys()}
             cls_plen_true = {ck: cls_len_true[ck] -(cls_plen_true_resolved[ck] - cls_unl_dat[ck][:len(cls_len_true[ck])]) for ck in cls_len_true.keys()}
 
         else:
             cldd_true *= (1. - rho_sqd_phi)  # The true residual lensing spec.
             cldd_fid *= (1. - rho_sqd_phi)  # What I think the residual lensing spec is
-            cls_plen_fid  = dls2cls(lensed_cls(dls_unl_fid, cldd_fid))
-            cls_plen_true = dls2cls(lensed_cls(dls_unl_true, cldd_true))
+            cls_plen_fid  = lensed_cls(dls_unl_fid, cldd_fid)
+            if np.array_equal(dls_unl_true, dls_unl_fid) and np.array_equal(cldd_true, cldd_fid):
+                cls_plen_true = cls_plen_fid # also saves the second response calculation below
+            else:
+                cls_plen_true = lensed_cls(dls_unl_true, cldd_true)
 
         cls_filt = cls_plen_fid if not unlQE else cls_unl_fid
         cls_w = cls_plen_fid if not unlQE else cls_unl_fid
@@ -1,20 +1,54 @@
 """This module contain methods for QE-related analytical predictions on data or filtering with inhomogeneous noise
 
 """
+import os
 import healpy as hp
 import numpy as np
 from plancklens import utils, nhl, qresp
-from plancklens.helpers import cachers
+from plancklens.helpers import cachers, mpi
 
 def _read_map(m):
     if isinstance(m, str):
         return hp.read_map(m)
     return m
 
+def _default_cacher():
+    """Disk cacher used if none is provided, in $PLENS/temp/patchy (or ~/.plancklens/temp/patchy if PLENS is not defined)
+
+    """
+    lib_dir = os.path.join(os.environ.get('PLENS', os.path.join(os.path.expanduser('~'), '.plancklens')), 'temp', 'patchy')
+    os.makedirs(lib_dir, exist_ok=True)
+    return cachers.cacher_npy(lib_dir)
+
+def _cls_hash(cls_cmb_dat, cls_cmb_filt, cls_weight, lmin, lmax, lmax_qlm, transf):
+    """Hash of the noise-independent inputs, to differentiate cached results with different spectra or multipole ranges
+
+    """
+    arrs = [np.array([lmin, lmax, lmax_qlm], dtype=float), np.asarray(transf[:lmax + 1], dtype=float)]
+    for cls in [cls_cmb_dat, cls_cmb_filt, cls_weight]:
+        arrs += [np.asarray(cls[k][:lmax + 1], dtype=float) for k in sorted(cls.keys())]
+    return utils.clhash(np.concatenate(arrs), dtype=float)
+
+def _run_chunks(func, chunks, args, executor=None, use_mpi=False):
+    """Evaluates func(chunk, *args) for all chunks, through the executor if set, or else spread over the MPI ranks if use_mpi is set
+
+        If use_mpi is set, this must be called by all ranks.
+
+    """
+    if executor is not None:
+        return list(executor.map(func, chunks, *[[arg] * len(chunks) for arg in args]))
+    if not use_mpi:
+        return [func(chunk, *args) for chunk in chunks]
+    rets = {i: func(chunks[i], *args) for i in range(mpi.rank, len(chunks), mpi.size)}
+    if mpi.size > 1:
+        for rets_rank in mpi.allgather(rets):
+            rets.update(rets_rank)
+    return [rets[i] for i in range(len(chunks))]
+
 
 def get_patchy_N0s(qekey_in, npatches, pixivmap_t, pixivmap_p, cls_unl, cls_cmb_dat, cls_cmb_filt, cls_weight, lmin_ivf, lmax_ivf, lmax_qlm, transf,
                   rvmap_uKamin_t_data=None, rvmap_uKamin_p_data=None, joint_TP=False,
-                  nlevt_fid=None, nlevp_fid=None, cacher=cachers.cacher_mem(), source='p'):
+                  nlevt_fid=None, nlevp_fid=None, cacher=None, source='p', chunk_size=16, executor=None, use_mpi=False):
     """Collects the effective reconstruction noise levels for different filtering and spectrum weighting schemes
 
         Args:
@@ -35,8 +69,13 @@ def get_patchy_N0s(qekey_in, npatches, pixivmap_t, pixivmap_p, cls_unl, cls_cmb_
             joint_TP: set this to true if temperature and polarization are jointly filtered before building the QE
             nlevt_fid: set this to the fiducial temperature noise value to use for the single full-sky normalization
             nlevp_fid: set this to the fiducial polarisation noise value to use for the single full-sky normalization
-            cacher: can use this to store results (descriptors only use the noise levels, joint_TP and qe_keys though)
+            cacher: can use this to store results (defaults to a disk cacher in $PLENS/temp/patchy)
             source: anistropy source for the responses calculations
+            chunk_size: number of patches whose transforms are stacked together
+            executor: *concurrent.futures* executor (e.g. a ProcessPoolExecutor) over which the patches chunks are spread.
+                      If not set, the chunks are spread over the MPI ranks if use_mpi is set, or evaluated serially
+            use_mpi: set this to collect the results jointly with all MPI ranks (this must then be called by all ranks).
+                     If not set, every calling process is independent
 
         Returns:
             N0s: a dict of N0 arrays for different filtering and spectr weighting types
@@ -62,14 +101,18 @@ def get_patchy_N0s(qekey_in, npatches, pixivmap_t, pixivmap_p, cls_unl, cls_cmb_
     if qekey_in[0] == 'x':
         cpp *= 0.
 
-    rfid = get_responses(qe_key, cls_cmb_dat, cls_cmb_filt, cls_weight, lmin_ivf, lmax_ivf, lmax_qlm, transf, [nlevt_fid], [nlevp_fid],
-                  joint_TP=joint_TP, cacher=cacher, source=source)[0]
-    resps = get_responses(qe_key, cls_cmb_dat, cls_cmb_filt, cls_weight, lmin_ivf, lmax_ivf, lmax_qlm, transf, nlevst_ftl, nlevsp_ftl,
-                  joint_TP=joint_TP, cacher=cacher, source=source)
-    nhls_pds = get_nhls(qe_key, qe_key, cls_cmb_dat, cls_cmb_filt, cls_weight, lmin_ivf, lmax_ivf, lmax_qlm, transf, nlevst_ftl, nlevst_data, nlevsp_ftl, nlevsp_data,
-                    joint_TP=joint_TP,cacher=cacher)
-    nhls_fds = get_nhls(qe_key, qe_key, cls_cmb_dat, cls_cmb_filt, cls_weight, lmin_ivf, lmax_ivf, lmax_qlm, transf, [nlevt_fid] * npatches, nlevst_data, [nlevp_fid] * npatches, nlevsp_data,
-                    joint_TP=joint_TP,cacher=cacher)
+    if cacher is None:
+        cacher = _default_cacher()
+    # fiducial and patches responses, then patchy and fiducial filtering noise, are collected together
+    resps = get_responses(qe_key, cls_cmb_dat, cls_cmb_filt, cls_weight, lmin_ivf, lmax_ivf, lmax_qlm, transf,
+                          [nlevt_fid] + list(nlevst_ftl), [nlevp_fid] + list(nlevsp_ftl),
+                          joint_TP=joint_TP, cacher=cacher, source=source, chunk_size=chunk_size, executor=executor, use_mpi=use_mpi)
+    rfid, resps = resps[0], resps[1:]
+    nhls = get_nhls(qe_key, qe_key, cls_cmb_dat, cls_cmb_filt, cls_weight, lmin_ivf, lmax_ivf, lmax_qlm, transf,
+                    list(nlevst_ftl) + [nlevt_fid] * npatches, list(nlevst_data) * 2,
+                    list(nlevsp_ftl) + [nlevp_fid] * npatches, list(nlevsp_data) * 2,
+                    joint_TP=joint_TP, cacher=cacher, chunk_size=chunk_size, executor=executor, use_mpi=use_mpi)
+    nhls_pds, nhls_fds = nhls[:npatches], nhls[npatches:]
 
     labels = ['hom-filt, no-rew', 'hom-filt, mv-rew', 'inhom-filt, no-rew', 'inhom-filt, mv-rew']
     N0s = {q: np.zeros(lmax_qlm + 1, dtype=float) for q in labels}
@@ -110,39 +153,56 @@ def mk_patches(Np, pix_ivmap, rvmap_uKamin_data=None, ret_masks=False):
             rvmap_uKamin_data: root variance map in uK amin of the data (if different from pix_ivmap)
             ret_masks: returns the defined series of masks if set
 
+        Returns:
+            filtering and data noise levels of each patch (uK amin), fiducial noise level, patches sky fractions and masks (if ret_masks)
 
     """
 
-    mask = _read_map(pix_ivmap) > 0
+    pix_ivmap = _read_map(pix_ivmap)
+    mask = pix_ivmap > 0
     npix = mask.size
     nside = hp.npix2nside(npix)
-    vmap = utils.cli(np.sqrt(_read_map(pix_ivmap))) * np.sqrt(hp.nside2pixarea(nside)) / np.pi * 60 * 180.
-    edges = np.percentile(vmap[np.where(mask)], np.linspace(0, 100, Np + 1))
+    vmap = utils.cli(np.sqrt(pix_ivmap[mask])) * np.sqrt(hp.nside2pixarea(nside)) / np.pi * 60 * 180.
+    vmap_sorted = np.sort(vmap)  # percentiles and patches sums are then cheap
+    edges = np.percentile(vmap_sorted, np.linspace(0, 100, Np + 1))
     edges[0] = -1.
     edges[-1] = 10000
-    nlevs = []  # from filtering variance map
-    nlevs_data = []  # from data variance map
-    fskies = []
+    # patch i covers edges[i] < vmap <= edges[i + 1], i.e. vmap_sorted[bounds[i]:bounds[i + 1]]
+    bounds = np.searchsorted(vmap_sorted, edges, side='right')
+    counts = np.diff(bounds)
+    empty = counts == 0
+    # (trailing zero only there to keep reduceat indices in range. reduceat returns the element at an empty
+    # patch lower bound rather than zero, hence the empty patches are explicitly set to nan means, as before)
+    sums = np.add.reduceat(np.append(vmap_sorted[:bounds[-1]], 0.), bounds[:-1])
+    sums[empty] = np.nan
+    nlevs = list(sums / np.maximum(counts, 1))  # from filtering variance map
+    fskies = list(counts / float(npix))
     masks = []
-    for i in range(1, Np + 1):
-        this_mask = (vmap > edges[i - 1]) & (vmap <= edges[i])
-        nlevs.append(np.mean(vmap[mask * this_mask]))
-        fskies.append(np.mean(mask * this_mask))
-        if rvmap_uKamin_data is not None:
-            nlevs_data.append(np.mean(_read_map(rvmap_uKamin_data[mask * this_mask])))
+    if rvmap_uKamin_data is not None or ret_masks:
+        ipatch = np.digitize(vmap, edges, right=True) - 1  # patch index of each unmasked pixel (Np if in none)
+        if rvmap_uKamin_data is not None:  # from data variance map
+            dmap = _read_map(rvmap_uKamin_data)[mask]
+            sums_data = np.bincount(ipatch, weights=dmap, minlength=Np + 1)[:Np]
+            sums_data[empty] = np.nan
+            nlevs_data = list(sums_data / np.maximum(counts, 1))
         if ret_masks:
-            masks.append(this_mask * mask)
+            pix = np.where(mask)[0]
+            for i in range(Np):
+                this_mask = np.zeros(npix, dtype=bool)
+                this_mask[pix[ipatch == i]] = True
+                masks.append(this_mask)
     if rvmap_uKamin_data is None:
         nlevs_data = nlevs
-    nlev_fid = np.sqrt(4. * np.pi / npix / np.sum(_read_map(pix_ivmap)) * np.sum(mask)) * 180. * 60. / np.pi
+    nlev_fid = np.sqrt(4. * np.pi / npix / np.sum(pix_ivmap) * np.sum(mask)) * 180. * 60. / np.pi
     for nf, nd in zip(nlevs, nlevs_data):
         print('%.2f (ftl)   %.2f (dat) uKamin' % (nf, nd))
     print('%.2f (fid)' %nlev_fid)
     return nlevs, nlevs_data, nlev_fid, fskies, masks
 
 def get_nlev_fid(pix_ivmap):
-    mask = _read_map(pix_ivmap) > 0
-    nlev_fid = np.sqrt(4. * np.pi / mask.size / np.sum(_read_map(pix_ivmap)) * np.sum(mask)) * 180. * 60. / np.pi
+    pix_ivmap = _read_map(pix_ivmap)
+    mask = pix_ivmap > 0
+    nlev_fid = np.sqrt(4. * np.pi / mask.size / np.sum(pix_ivmap) * np.sum(mask)) * 180. * 60. / np.pi
     return nlev_fid
 
 def get_fal(a, cl_len, nlev, transf, lmin, lmax):
@@ -218,7 +278,7 @@ def cls_dot(cls_fidi, cls_dat, lmin, lmax):
     return ret
 
 def get_responses(qe_key, cls_cmb_dat, cls_cmb_filt, cls_weight, lmin, lmax, lmax_qlm, transf, nlevts_filt, nlevps_filt,
-                  joint_TP=False, cacher=cachers.cacher_mem(), source='p'):
+                  joint_TP=False, cacher=None, source='p', chunk_size=16, executor=None, use_mpi=False):
     """Collects estimator responses for a list of filtering noise levels
 
 
@@ -234,28 +294,54 @@ def get_responses(qe_key, cls_cmb_dat, cls_cmb_filt, cls_weight, lmin, lmax, lma
             nlevts_filt: list or array of filtering temperature noise levels
             nlevps_filt: list or array of filtering polarization noise levels
             joint_TP: uses joint temperature and polarization filtering if set, separate if not
-            cacher: can be used to store results
+            cacher: can be used to store results (defaults to a disk cacher in $PLENS/temp/patchy)
             source: QE response anisotropy source (defaults to lensing)
+            chunk_size: number of noise levels whose transforms are stacked together
+            executor: *concurrent.futures* executor over which the chunks are spread
+            use_mpi: spreads the chunks over the MPI ranks if no executor is set, rank 0 writing the results to the cacher,
+                     which must then be shared by all ranks (e.g. on disk). This must then be called by all ranks
 
         Returns:
             lists of responses (GG, CC, GC CG for spin-weight QE)
 
         Note:
-            Results may be stored with the cacher but only the filtering noise levels, QE keys and joint_TP are differentiated in the filename
+            Results may be stored with the cacher. The filenames differentiate the noise levels with a double-precision hash
 
     """
-    resps = []
-    for i, (nlevt_f, nlevp_f) in utils.enumerate_progress(list(zip(nlevts_filt, nlevps_filt)), 'collecting responses'):
-        fname = 'vmapresps%s_%s_%s' % ('jTP' * joint_TP, qe_key, qe_key) + utils.clhash(np.array([nlevt_f, nlevp_f]))
-        if not cacher.is_cached(fname):
-            cls_filt_i = get_ivf_cls(cls_cmb_dat, cls_cmb_filt, lmin, lmax, nlevt_f, nlevp_f, nlevt_f, nlevp_f, transf, jt_tp=joint_TP)[1]
-            this_resp =  qresp.get_response(qe_key, lmax, source, cls_weight, cls_cmb_dat, cls_filt_i, lmax_qlm=lmax_qlm)
-            cacher.cache(fname, this_resp)
-        resps.append(cacher.load(fname))
-    return resps
+    if cacher is None:
+        cacher = _default_cacher()
+    cl_hash = _cls_hash(cls_cmb_dat, cls_cmb_filt, cls_weight, lmin, lmax, lmax_qlm, transf)
+    fnames = ['vmapresps%s_%s_%s_%s' % ('jTP' * joint_TP, qe_key, qe_key, source) + utils.clhash(np.array([nlevt_f, nlevp_f], dtype=float), dtype=float) + '_' + cl_hash
+              for nlevt_f, nlevp_f in zip(nlevts_filt, nlevps_filt)]
+    todo = {}  # distinct missing filenames and noise levels
+    for fname, nlevt_f, nlevp_f in zip(fnames, nlevts_filt, nlevps_filt):
+        if fname not in todo and not cacher.is_cached(fname):
+            todo[fname] = (nlevt_f, nlevp_f)
+    if use_mpi:  # all ranks must agree on the missing results
+        todo = mpi.bcast(todo, root=0)
+    if len(todo) > 0:
+        nlevs = list(todo.values())
+        chunks = [nlevs[i:i + chunk_size] for i in range(0, len(nlevs), chunk_size)]
+        args = (qe_key, cls_cmb_dat, cls_cmb_filt, cls_weight, lmin, lmax, lmax_qlm, transf, joint_TP, source)
+        resps = [resp for resps_c in _run_chunks(_get_responses_chunk, chunks, args, executor=executor, use_mpi=use_mpi) for resp in resps_c]
+        todo = dict(zip(todo.keys(), resps))
+        if not use_mpi or mpi.rank == 0:
+            for fname, resp in todo.items():
+                cacher.cache(fname, resp)
+        if use_mpi:
+            mpi.barrier()
+    return [todo[fname] if fname in todo else cacher.load(fname) for fname in fnames]
+
+def _get_responses_chunk(nlevs, qe_key, cls_cmb_dat, cls_cmb_filt, cls_weight, lmin, lmax, lmax_qlm, transf, joint_TP, source):
+    fals = [get_ivf_cls(cls_cmb_dat, cls_cmb_filt, lmin, lmax, nlevt_f, nlevp_f, nlevt_f, nlevp_f, transf, jt_tp=joint_TP)[1]
+            for nlevt_f, nlevp_f in nlevs]
+    if '_bh_' in qe_key:
+        return [np.array(qresp.get_response(qe_key, lmax, source, cls_weight, cls_cmb_dat, fal, lmax_qlm=lmax_qlm)) for fal in fals]
+    qes = qresp.get_qes(qe_key, lmax, cls_weight)
+    return [np.array(resp) for resp in qresp._get_response_many(qes, source, cls_cmb_dat, fals, lmax_qlm)]
 
 def get_nhls(qe_key1, qe_key2, cls_cmb_dat, cls_cmb_filt, cls_weight, lmin, lmax, lmax_qlm, transf, nlevts_filt, nlevts_map, nlevps_filt, nlevps_map,
-             joint_TP=False, cacher=cachers.cacher_mem()):
+             joint_TP=False, cacher=None, chunk_size=16, executor=None, use_mpi=False):
     """Collects unnormalized estimator noise levels for a list of filtering noise levels and data map noise levels
 
 
@@ -274,22 +360,47 @@ def get_nhls(qe_key1, qe_key2, cls_cmb_dat, cls_cmb_filt, cls_weight, lmin, lmax
             nlevps_filt: list or array of filtering polarization noise levels
             nlevps_map: list or array of data maptemperature noise levels
             joint_TP: uses joint temperature and polarization filtering if set, separate if not
-            cacher: can be used to store results
+            cacher: can be used to store results (defaults to a disk cacher in $PLENS/temp/patchy)
+            chunk_size: number of noise levels whose transforms are stacked together
+            executor: *concurrent.futures* executor over which the chunks are spread
+            use_mpi: spreads the chunks over the MPI ranks if no executor is set, rank 0 writing the results to the cacher,
+                     which must then be shared by all ranks (e.g. on disk). This must then be called by all ranks
 
         Returns:
             lists of reconstruction noise levels (GG, CC, GC CG for spin-weight QE)
 
         Note:
-            Results may be stored with the cacher but only the filtering and data noise levels, QE keys and joint_TP are differentiated in the filename
+            Results may be stored with the cacher. The filenames differentiate the noise levels with a double-precision hash
 
     """
-    Nhls = []
-    for i, (nlevt_f, nlevt_m, nlevp_f, nlevp_m) in utils.enumerate_progress(list(zip(nlevts_filt, nlevts_map, nlevps_filt, nlevps_map)), 'collecting nhls'):
-        fname = 'vmapnhl%s_%s_%s' % ('jTP' * joint_TP, qe_key1, qe_key2) + utils.clhash(np.array([nlevt_f, nlevt_m, nlevp_f, nlevp_m]))
-        if not cacher.is_cached(fname):
-            ivf_cls = get_ivf_cls(cls_cmb_dat, cls_cmb_filt, lmin, lmax, nlevt_f, nlevp_f, nlevt_m, nlevp_m, transf, jt_tp=joint_TP)[0]
-            this_nhl = nhl.get_nhl(qe_key1, qe_key2, cls_weight, ivf_cls, lmax, lmax, lmax_out=lmax_qlm)
-            cacher.cache(fname, this_nhl)
-        Nhls.append(cacher.load(fname))
-    return Nhls
-
+    if cacher is None:
+        cacher = _default_cacher()
+    cl_hash = _cls_hash(cls_cmb_dat, cls_cmb_filt, cls_weight, lmin, lmax, lmax_qlm, transf)
+    nlevs = list(zip(nlevts_filt, nlevts_map, nlevps_filt, nlevps_map))
+    fnames = ['vmapnhl%s_%s_%s' % ('jTP' * joint_TP, qe_key1, qe_key2) + utils.clhash(np.array(nlev, dtype=float), dtype=float) + '_' + cl_hash for nlev in nlevs]
+    todo = {}  # distinct missing filenames and noise levels
+    for fname, nlev in zip(fnames, nlevs):
+        if fname not in todo and not cacher.is_cached(fname):
+            todo[fname] = nlev
+    if use_mpi:  # all ranks must agree on the missing results
+        todo = mpi.bcast(todo, root=0)
+    if len(todo) > 0:
+        nlevs = list(todo.values())
+        chunks = [nlevs[i:i + chunk_size] for i in range(0, len(nlevs), chunk_size)]
+        args = (qe_key1, qe_key2, cls_cmb_dat, cls_cmb_filt, cls_weight, lmin, lmax, lmax_qlm, transf, joint_TP)
+        Nhls = [N for Nhls_c in _run_chunks(_get_nhls_chunk, chunks, args, executor=executor, use_mpi=use_mpi) for N in Nhls_c]
+        todo = dict(zip(todo.keys(), Nhls))
+        if not use_mpi or mpi.rank == 0:
+            for fname, N in todo.items():
+                cacher.cache(fname, N)
+        if use_mpi:
+            mpi.barrier()
+    return [todo[fname] if fname in todo else cacher.load(fname) for fname in fnames]
+
+def _get_nhls_chunk(nlevs, qe_key1, qe_key2, cls_cmb_dat, cls_cmb_filt, cls_weight, lmin, lmax, lmax_qlm, transf, joint_TP):
+    ivfs_cls = [get_ivf_cls(cls_cmb_dat, cls_cmb_filt, lmin, lmax, nlevt_f, nlevp_f, nlevt_m, nlevp_m, transf, jt_tp=joint_TP)[0]
+                for nlevt_f, nlevt_m, nlevp_f, nlevp_m in nlevs]
+    qes1 = qresp.get_qes(qe_key1, lmax, cls_weight)
+    qes2 = qresp.get_qes(qe_key2, lmax, cls_weight)
+    Nhls = nhl._get_nhl_many(qes1, qes2, ivfs_cls, lmax_qlm)
+    return [np.array([N[i] for N in Nhls]) for i in range(len(nlevs))]
@@ -55,7 +55,7 @@ class library(object):
                 pk.dump(self.hashdict(), open(hname, 'wb'), protocol=2)
         mpi.barrier()
         utils.hash_check(pk.load(open(hname, 'rb')), self.hashdict())
-        self.npdb = sql.npdb(os.path.join(lib_dir, 'cldb.db'))
+        self.npdb = sql.npdb(os.path.join(lib_dir, 'cldb.db'), codec='raw')
         fskies = {}
         with open(fsname) as f:
             for line in f:
@@ -66,6 +66,7 @@ class library(object):
         self.fsky11 = fskies[11]
         self.fsky12 = fskies[12]
         self.fsky22 = fskies[22]
+        self._mfs = {} # mean-fields kept in memory, keyed by leg and QE key
 
     def hashdict(self):
         return {'qeA': self.qeA.hashdict(),
@@ -102,24 +103,80 @@ class library(object):
         lmax_qcl = self.get_lmaxqcl(k1, k2)
         lmax_out = lmax or lmax_qcl
         assert lmax_out <= lmax_qcl
-        if idx >= 0:
-            fname = os.path.join(self.lib_dir, 'sim_qcl_k1%s_k2%s_lmax%s_%04d_%s.dat' % (k1, k2, lmax_qcl, idx, self._mcmf_hash()))
-        else:
-            assert idx ==-1
-            fname = os.path.join(self.lib_dir, 'sim_qcl_k1%s_k2%s_lmax%s_dat_%s.dat' % (k1, k2, lmax_qcl, self._mcmf_hash()))
+        fname = self._get_fname(k1, k2, idx)
         if calc:
             recache=False
         if calc and (self.npdb.get(fname) is None or recache):
             qlmA = self.qeA.get_sim_qlm(k1, idx, lmax=lmax_qcl)
-            qlmA -= self.qeA.get_sim_qlm_mf(k1, self.mc_sims_mf[0::2], lmax=lmax_qcl)
+            qlmA -= self._get_sim_qlm_mf(1, k1, lmax_qcl)
             qlmB = self.qeB.get_sim_qlm(k2, idx, lmax=lmax_qcl)
-            qlmB -= self.qeB.get_sim_qlm_mf(k2, self.mc_sims_mf[1::2], lmax=lmax_qcl)
+            qlmB -= self._get_sim_qlm_mf(2, k2, lmax_qcl)
             if recache and self.npdb.get(fname) is not None:
                 self.npdb.remove(fname)
             self.npdb.add(fname, self._alm2clfsky1234(qlmA, qlmB, k1, k2))
             del qlmA, qlmB
         return self.npdb.get(fname)[:lmax_out + 1] / self.fskies[1234]
 
+    def get_sim_qcls(self, k1s, k2s, idxs):
+        """Returns QE (cross-)power spectra for a set of keys pairs and simulation indices.
+
+            Each QE map is read only once per simulation, whatever the number of pairs it enters.
+
+            Args:
+                k1s: list of QE anisotropy keys of the first leg
+                k2s: list of QE anisotropy keys of the second leg
+                idxs: simulation indices
+
+            Returns:
+               dictionary with (k1, k2) keys and (len(idxs), lmax + 1) arrays of QE power spectra as values
+
+        """
+        pairs = [(k1, k2) for k1 in k1s for k2 in k2s]
+        for k1, k2 in pairs:
+            assert k1 in self.qeA.keys and k2 in self.qeB.keys, (k1, k2)
+        ret = {(k1, k2): np.zeros((len(idxs), self.get_lmaxqcl(k1, k2) + 1), dtype=float) for k1, k2 in pairs}
+        for i, idx in enumerate(idxs):
+            assert idx not in self.mc_sims_mf, idx
+            qlms = {}  # mean-field subtracted QE maps for this sim
+            raws = {}  # raw QE maps, shared by the two legs if these are built from the same QE library
+            def get_qlm(leg, k):
+                if (leg, k) not in qlms:
+                    qe = self.qeA if leg == 1 else self.qeB
+                    if (id(qe), k) not in raws:
+                        raws[(id(qe), k)] = qe.get_sim_qlm(k, idx)
+                    lmax = qe.get_lmax_qlm(k)
+                    qlms[(leg, k)] = utils.alm_copy(raws[(id(qe), k)], lmax=lmax) - self._get_sim_qlm_mf(leg, k, lmax)
+                return qlms[(leg, k)]
+            fnames = [self._get_fname(k1, k2, idx) for k1, k2 in pairs]
+            new_fnames, new_cls = [], []
+            for (k1, k2), fname, cl in zip(pairs, fnames, self.npdb.get_many(fnames)):
+                if cl is None:
+                    lmax_qcl = self.get_lmaxqcl(k1, k2)
+                    cl = self._alm2clfsky1234(utils.alm_copy(get_qlm(1, k1), lmax=lmax_qcl),
+                                              utils.alm_copy(get_qlm(2, k2), lmax=lmax_qcl), k1, k2)
+                    new_fnames.append(fname)
+                    new_cls.append(cl)
+                ret[(k1, k2)][i] = cl / self.fskies[1234]
+            if len(new_fnames) > 0:
+                self.npdb.add_many(new_fnames, new_cls)
+            del qlms, raws
+        return ret
+
+    def _get_fname(self, k1, k2, idx):
+        lmax_qcl = self.get_lmaxqcl(k1, k2)
+        if idx >= 0:
+            return os.path.join(self.lib_dir, 'sim_qcl_k1%s_k2%s_lmax%s_%04d_%s.dat' % (k1, k2, lmax_qcl, idx, self._mcmf_hash()))
+        assert idx == -1
+        return os.path.join(self.lib_dir, 'sim_qcl_k1%s_k2%s_lmax%s_dat_%s.dat' % (k1, k2, lmax_qcl, self._mcmf_hash()))
+
+    def _get_sim_qlm_mf(self, leg, k, lmax):
+        """Mean-field of leg 1 or 2, read once at the QE lmax and kept in memory afterwards """
+        if (leg, k) not in self._mfs:
+            qe = self.qeA if leg == 1 else self.qeB
+            mc_sims = self.mc_sims_mf[0::2] if leg == 1 else self.mc_sims_mf[1::2]
+            self._mfs[(leg, k)] = qe.get_sim_qlm_mf(k, mc_sims, lmax=qe.get_lmax_qlm(k))
+        return utils.alm_copy(self._mfs[(leg, k)], lmax=lmax)
+
     def get_sim_stats_qcl(self, k1, mc_sims, k2=None, recache=False):
         """Returns the average of QE power spectra
 
@@ -188,7 +188,7 @@ class resp_lib_simple:
                 pk.dump(self.hashdict(), open(fn_hash, 'wb'), protocol=2)
         mpi.barrier()
         ut.hash_check(pk.load(open(fn_hash, 'rb')), self.hashdict())
-        self.npdb = sql.npdb(os.path.join(lib_dir, 'npdb.db'))
+        self.npdb = sql.npdb(os.path.join(lib_dir, 'npdb.db'), codec='raw')
 
     def hashdict(self):
         ret = {'lmaxqe':self.lmax_qe, 'lmax_qlm':self.lmax_qlm}
@@ -200,6 +200,70 @@ class resp_lib_simple:
             ret['fal' + k] = ut.clhash(self.fal[k])
         return ret
 
+    @staticmethod
+    def _get_pairs(k, ksource):
+        """(QE key, source) pairs on which the response of *k* to *ksource* depends """
+        if '_bh_' in k:
+            kQE, bhksource = k.split('_bh_')
+            kh = bhksource + kQE[1:]
+            return [(kQE, bhksource), (kh, bhksource), (kQE, ksource), (kh, ksource)]
+        return [(k, ksource)]
+
+    @staticmethod
+    def _fn_root(k, ksource):
+        s, GorC, sins, ksp = qe_spin_data(k)
+        return 'qe_' + ksp + k[1:] + '_source_%s' % ksource
+
+    def precompute(self, keys, sources, recache=False):
+        """Computes and caches at once all responses of a set of QE keys to a set of sources.
+
+            Bias-hardened keys are resolved into the responses they depend on, and each distinct response is evaluated once.
+            All sources of a QE key are calculated together, sharing their position-space transforms.
+            The work is distributed over the MPI ranks, and the results collected and written by rank 0 in a single transaction.
+
+            Args:
+                keys: list of QE anisotropy keys
+                sources: list of CMB anisotropy source keys
+
+        """
+        todo = {}  # fn_root -> (k, ksource)
+        for k in keys:
+            for ksource in sources:
+                for pair in self._get_pairs(k, ksource):
+                    todo.setdefault(self._fn_root(*pair), pair)
+        fn_roots = sorted(todo.keys())
+        if not recache:
+            cached = self.npdb.get_many([fn_root + '_GG' for fn_root in fn_roots])
+            fn_roots = [fn_root for fn_root, arr in zip(fn_roots, cached) if arr is None]
+        qe_sources = {}  # sources sharing the same QE
+        for fn_root in fn_roots:
+            k, ksource = todo[fn_root]
+            qe_sources.setdefault(k, []).append((fn_root, ksource))
+        fns = []
+        arrs = []
+        for k in sorted(qe_sources.keys())[mpi.rank::mpi.size]:
+            fn_roots_k, ksources = zip(*qe_sources[k])
+            s = qe_spin_data(k)[0]
+            qes = get_qes(k, self.lmax_qe, self.cls_weight)
+            for fn_root, (GG, CC, GC, CG) in zip(fn_roots_k, _get_responses(qes, ksources, self.cls_cmb, self.fal, self.lmax_qlm)):
+                if np.any(CG) or np.any(GC):
+                    print("Warning: C-G or G-C responses non-zero but not returned")
+                fns.append(fn_root + '_GG')
+                arrs.append(GG)
+                if s > 0:
+                    fns.append(fn_root + '_CC')
+                    arrs.append(CC)
+        fns_arrs = mpi.gather((fns, arrs), root=0)  # only the writing rank needs the arrays
+        if mpi.rank == 0:
+            fns = [fn for rank_fns, rank_arrs in fns_arrs for fn in rank_fns]
+            arrs = [arr for rank_fns, rank_arrs in fns_arrs for arr in rank_arrs]
+            if recache:
+                for fn in fns:
+                    if self.npdb.get(fn) is not None:
+                        self.npdb.remove(fn)
+            self.npdb.add_many(fns, arrs)
+        mpi.barrier()
+
     def get_response(self, k, ksource, recache=False):
         """
             Args:
@@ -238,6 +302,37 @@ class resp_lib_simple:
                 self.npdb.add('qe_' + ksp + k[1:] + '_source_%s' % ksource + '_CC', CC)
         return self.npdb.get(fn)
 
+    def get_dresponse_dlncl(self, k, ksource, cl_key, recache=False):
+        """Response derivative matrix dR_L / dlnC_l for all CMB multipoles l
+
+            Args:
+                k: QE anisotropy key
+                ksource: CMB anisotropy source key
+                cl_key: CMB spectrum key (e.g. 'tt') of *cls_cmb*
+
+            Returns:
+                (lmax_qlm + 1, lmax_ivf + 1) array
+
+        """
+        assert '_bh_' not in k, 'bias-hardened response derivatives not implemented'
+        s, GorC, sins, ksp = qe_spin_data(k)
+        assert s >= 0, s
+        if s == 0: assert GorC == 'G', (s, GorC)
+        fn_root = 'dRdlncl_' + cl_key + '_qe_' + ksp + k[1:] + '_source_%s' % ksource
+        fn = fn_root + '_' + GorC + GorC
+        if self.npdb.get(fn) is None or recache:
+            GG, CC, GC, CG = get_dresponse_dlncl_matrix(k, cl_key, self.lmax_qe, ksource, self.cls_weight, self.cls_cmb,
+                                                        self.fal, lmax_out=self.lmax_qlm)
+            if recache and self.npdb.get(fn) is not None:
+                self.npdb.remove(fn_root + '_GG')
+                if s > 0:
+                    self.npdb.remove(fn_root + '_CC')
+            # npdb stores flat arrays
+            self.npdb.add(fn_root + '_GG', GG.flatten())
+            if s > 0:
+                self.npdb.add(fn_root + '_CC', CC.flatten())
+        return self.npdb.get(fn).reshape((self.lmax_qlm + 1, self.lmax_qe + 1))
+
 
 def get_response(qe_key, lmax_ivf, source, cls_weight, cls_cmb, fal, fal_leg2=None, lmax_ivf2=None, lmax_qlm=None):
     r"""QE response calculation
@@ -293,13 +388,78 @@ def get_dresponse_dlncl(qe_key, l, cl_key, lmax_ivf, source, cls_weight, cls_cmb
     qes = get_qes(qe_key, lmax_ivf, cls_weight, lmax2=lmax_ivf2)
     return _get_response(qes, source, dcls_cmb, fal_leg1,lmax_out, fal_leg2=fal_leg2)
 
+def get_dresponse_dlncl_matrix(qe_key, cl_key, lmax_ivf, source, cls_weight, cls_cmb, fal_leg1,
+                               fal_leg2=None, lmax_ivf2=None, lmax_out=None, lblock=128):
+    r"""QE isotropic response derivative matrix dR_L / dlnC_l, for all CMB multipoles l at once.
+
+        Same as *get_dresponse_dlncl* for all l up to max(lmax_ivf, lmax_ivf2), in a single pass.
+
+        Args:
+            lblock(optional): number of CMB multipoles processed together (sets the memory footprint)
+
+        Returns:
+            4-tuple GG, CC, GC, CG of (lmax_out + 1, max(lmax_ivf, lmax_ivf2) + 1) arrays
+
+    """
+    if lmax_ivf2 is None: lmax_ivf2 = lmax_ivf
+    if lmax_out is None : lmax_out = lmax_ivf2 + lmax_ivf
+    qes = get_qes(qe_key, lmax_ivf, cls_weight, lmax2=lmax_ivf2)
+    return _get_dresponse_dlncl_matrix(qes, source, cls_cmb, cl_key, fal_leg1, lmax_out, max(lmax_ivf, lmax_ivf2),
+                                       fal_leg2=fal_leg2, lblock=lblock)
+
 def _get_response(qes, source, cls_cmb, fal_leg1, lmax_qlm, fal_leg2=None):
-    fal_leg2 = fal_leg1 if fal_leg2 is None else fal_leg2
-    RGG = np.zeros(lmax_qlm + 1, dtype=float)
-    RCC = np.zeros(lmax_qlm + 1, dtype=float)
-    RGC = np.zeros(lmax_qlm + 1, dtype=float)
-    RCG = np.zeros(lmax_qlm + 1, dtype=float)
     Ls = np.arange(lmax_qlm + 1, dtype=int)
+    # collects all Wigner transforms first, to evaluate them grouped by spins
+    jobs, lins, terms = _get_response_jobs(qes, source, cls_cmb, fal_leg1, Ls, fal_leg2=fal_leg2)
+    Rs = uspin.wignerc_grouped(jobs, lmax_out=lmax_qlm)
+    return _sum_response_terms(terms, Rs, Ls, (lmax_qlm + 1,))
+
+def _get_responses(qes, sources, cls_cmb, fal_leg1, lmax_qlm, fal_leg2=None):
+    """Same as *_get_response* for a list of sources, sharing the position-space transforms of the QE legs
+
+    """
+    Ls = np.arange(lmax_qlm + 1, dtype=int)
+    jobs, terms = [], []
+    for source in sources:
+        jobs_s, lins_s, terms_s = _get_response_jobs(qes, source, cls_cmb, fal_leg1, Ls, fal_leg2=fal_leg2)
+        jobs.append(jobs_s)
+        terms.append(terms_s)
+    Rs = uspin.wignerc_grouped([job for jobs_s in jobs for job in jobs_s], lmax_out=lmax_qlm)
+    ret = []
+    i = 0
+    for jobs_s, terms_s in zip(jobs, terms):
+        ret.append(_sum_response_terms(terms_s, Rs[i:i + len(jobs_s)], Ls, (lmax_qlm + 1,)))
+        i += len(jobs_s)
+    return ret
+
+def _get_response_many(qes, source, cls_cmb, fals_leg1, lmax_qlm, fals_leg2=None):
+    """Same as *_get_response* for a list of filtering spectra (e.g. one per noise configuration), with stacked transforms
+
+    """
+    fals_leg2 = fals_leg1 if fals_leg2 is None else fals_leg2
+    assert len(fals_leg1) == len(fals_leg2), (len(fals_leg1), len(fals_leg2))
+    Ls = np.arange(lmax_qlm + 1, dtype=int)
+    jobs, terms = [], []
+    for fal_leg1, fal_leg2 in zip(fals_leg1, fals_leg2):
+        jobs_f, lins_f, terms_f = _get_response_jobs(qes, source, cls_cmb, fal_leg1, Ls, fal_leg2=fal_leg2)
+        jobs.append(jobs_f)
+        terms.append(terms_f)
+    Rs = uspin.wignerc_grouped([job for jobs_f in jobs for job in jobs_f], lmax_out=lmax_qlm)
+    ret = []
+    i = 0
+    for jobs_f, terms_f in zip(jobs, terms):
+        ret.append(_sum_response_terms(terms_f, Rs[i:i + len(jobs_f)], Ls, (lmax_qlm + 1,)))
+        i += len(jobs_f)
+    return ret
+
+def _get_response_jobs(qes, source, cls_cmb, fal_leg1, Ls, fal_leg2=None):
+    """Lists the *wignerc* calls entering the response, together with the index of the leg carrying *cls_cmb*
+
+    """
+    fal_leg2 = fal_leg1 if fal_leg2 is None else fal_leg2
+    jobs = []
+    lins = []
+    terms = []
     for qe in qes:
         si, ti = (qe.leg_a.spin_in, qe.leg_b.spin_in)
         so, to = (qe.leg_a.spin_ou, qe.leg_b.spin_ou)
@@ -312,31 +472,93 @@ def _get_response(qes, source, cls_cmb, fal_leg1, lmax_qlm, fal_leg2=None):
                         rW_st, prW_st, mrW_st, s_cL_st = get_covresp(source, -s2, t2, cls_cmb, len(FB) - 1)
                         clA = ut.joincls([qe.leg_a.cl, FA])
                         clB = ut.joincls([qe.leg_b.cl, FB, mrW_st.conj()])
-                        Rpr_st = uspin.wignerc(clA, clB, so, s2, to, -s2 + rW_st, lmax_out=lmax_qlm) * s_cL_st(Ls)
+                        jobs.append((clA, clB, so, s2, to, -s2 + rW_st))
+                        lins.append(1)
 
                         rW_ts, prW_ts, mrW_ts, s_cL_ts = get_covresp(source, -t2, s2, cls_cmb, len(FA) - 1)
                         clA = ut.joincls([qe.leg_a.cl, FA, mrW_ts.conj()])
                         clB = ut.joincls([qe.leg_b.cl, FB])
-                        Rpr_st = Rpr_st + uspin.wignerc(clA, clB, so, -t2 + rW_ts, to, t2, lmax_out=lmax_qlm) * s_cL_ts(Ls)
+                        jobs.append((clA, clB, so, -t2 + rW_ts, to, t2))
+                        lins.append(0)
                         assert rW_st == rW_ts and rW_st >= 0, (rW_st, rW_ts)
                         if rW_st > 0:
                             clA = ut.joincls([qe.leg_a.cl, FA])
                             clB = ut.joincls([qe.leg_b.cl, FB, prW_st.conj()])
-                            Rmr_st = uspin.wignerc(clA, clB, so, s2, to, -s2 - rW_st, lmax_out=lmax_qlm) * s_cL_st(Ls)
+                            jobs.append((clA, clB, so, s2, to, -s2 - rW_st))
+                            lins.append(1)
 
                             clA = ut.joincls([qe.leg_a.cl, FA, prW_ts.conj()])
                             clB = ut.joincls([qe.leg_b.cl, FB])
-                            Rmr_st = Rmr_st + uspin.wignerc(clA, clB, so, -t2 - rW_ts, to, t2, lmax_out=lmax_qlm) * s_cL_ts(Ls)
-                        else:
-                            Rmr_st = Rpr_st
-                        prefac = qe.cL(Ls)
-                        RGG += prefac * ( Rpr_st.real + Rmr_st.real * (-1) ** rW_st)
-                        RCC += prefac * ( Rpr_st.real - Rmr_st.real * (-1) ** rW_st)
-                        RGC += prefac * (-Rpr_st.imag + Rmr_st.imag * (-1) ** rW_st)
-                        RCG += prefac * ( Rpr_st.imag + Rmr_st.imag * (-1) ** rW_st)
-
+                            jobs.append((clA, clB, so, -t2 - rW_ts, to, t2))
+                            lins.append(0)
+                        terms.append((qe, rW_st, s_cL_st(Ls), s_cL_ts(Ls)))
+    return jobs, lins, terms
+
+def _sum_response_terms(terms, Rs, Ls, shape):
+    RGG = np.zeros(shape, dtype=float)
+    RCC = np.zeros(shape, dtype=float)
+    RGC = np.zeros(shape, dtype=float)
+    RCG = np.zeros(shape, dtype=float)
+    Rs = iter(Rs)
+    for qe, rW_st, s_cL_st, s_cL_ts in terms:
+        Rpr_st = next(Rs) * s_cL_st
+        Rpr_st = Rpr_st + next(Rs) * s_cL_ts
+        if rW_st > 0:
+            Rmr_st = next(Rs) * s_cL_st
+            Rmr_st = Rmr_st + next(Rs) * s_cL_ts
+        else:
+            Rmr_st = Rpr_st
+        prefac = qe.cL(Ls)
+        RGG += prefac * ( Rpr_st.real + Rmr_st.real * (-1) ** rW_st)
+        RCC += prefac * ( Rpr_st.real - Rmr_st.real * (-1) ** rW_st)
+        RGC += prefac * (-Rpr_st.imag + Rmr_st.imag * (-1) ** rW_st)
+        RCG += prefac * ( Rpr_st.imag + Rmr_st.imag * (-1) ** rW_st)
     return RGG, RCC, RGC, RCG
 
+def _get_dresponse_dlncl_matrix(qes, source, cls_cmb, cl_key, fal_leg1, lmax_qlm, lmax_cmb, fal_leg2=None, lblock=128):
+    # The response is linear in the CMB spectra, and for each term only one leg depends on them.
+    # We transform the other legs once, and evaluate the derivatives against blocks of unit spectra.
+    assert source in ['p', 'x', 'f', 'a', 'a_p'], source + ' response not linear in the CMB spectra'
+    Ls = np.arange(lmax_qlm + 1, dtype=int)
+    dcls_cmb = {k: np.zeros_like(cls_cmb[k]) for k in cls_cmb.keys()}
+    dcls_cmb[cl_key] = np.copy(cls_cmb[cl_key])
+    jobs, lins, terms = _get_response_jobs(qes, source, dcls_cmb, fal_leg1, Ls, fal_leg2=fal_leg2)
+    if len(jobs) == 0:
+        return tuple(np.zeros((lmax_qlm + 1, lmax_cmb + 1), dtype=float) for i in range(4))
+    lmaxtot = max([len(job[0]) + len(job[1]) - 2 + lmax_qlm for job in jobs])
+    xg, wg = uspin._get_xgwg((lmaxtot + 2 - lmaxtot % 2) // 2)
+    xis_fixed = {}
+    for j, (job, lin) in enumerate(zip(jobs, lins)):
+        cl, sp, s = (job[1], job[4], job[5]) if lin == 0 else (job[0], job[2], job[3])
+        if np.any(cl):
+            key = (uspin._spechash(cl), sp, s)
+            if key not in xis_fixed:
+                xis_fixed[key] = uspin._wignerpos(cl, xg, sp, s) * wg
+            xis_fixed[j] = xis_fixed[key]
+    ret = tuple(np.zeros((lmax_qlm + 1, lmax_cmb + 1), dtype=float) for i in range(4))
+    for l0 in range(0, lmax_cmb + 1, lblock):
+        ls = np.arange(l0, min(l0 + lblock, lmax_cmb + 1))
+        unit_xis = {}
+        Rs = []
+        for j, (job, lin) in enumerate(zip(jobs, lins)):
+            cl, sp, s = (job[0], job[2], job[3]) if lin == 0 else (job[1], job[4], job[5])
+            valid = ls < len(cl)
+            vls = np.zeros(len(ls), dtype=cl.dtype)
+            vls[valid] = cl[ls[valid]]
+            if j not in xis_fixed or not np.any(vls):
+                Rs.append(0.)
+                continue
+            key = (sp, s, len(cl))
+            if key not in unit_xis:
+                units = np.zeros((len(ls), len(cl)), dtype=float)
+                units[np.where(valid)[0], ls[valid]] = 1.
+                unit_xis[key] = uspin._wignerpos_many(units, xg, sp, s)
+            xi12s = unit_xis[key] * vls[:, None] * xis_fixed[j]
+            Rs.append(uspin._wignercoeff_many(xi12s, xg, job[2] + job[4], job[3] + job[5], lmax_qlm))
+        for R, Rblock in zip(ret, _sum_response_terms(terms, Rs, Ls, (len(ls), lmax_qlm + 1))):
+            R[:, ls] = Rblock.T
+    return ret
+
 
 def get_mf_resp(qe_key, cls_cmb, cls_ivfs, lmax_qe, lmax_out):
     """Deflection-induced mean-field response calculation.
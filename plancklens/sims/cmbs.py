@@ -22,11 +22,40 @@ def _get_fields(cls):
             if _f not in ret: ret.append(_f)
     return ret
 
+def _cholesky(rmat):
+    """Lower-triangular Cholesky factors of a stack of positive semi-definite matrices.
+
+        Vectorized over the first axis. Null pivots (e.g. vanishing spectra) give zero columns instead of failing.
+
+    """
+    Nf = rmat.shape[1]
+    ret = np.zeros_like(rmat)
+    for j in range(Nf):
+        d = rmat[:, j, j] - np.sum(ret[:, j, :j] ** 2, axis=1)
+        assert np.all(d >= -1e-10 * np.abs(rmat[:, j, j])), 'Matrix not positive semidefinite'
+        ret[:, j, j] = np.sqrt(np.maximum(d, 0.))
+        ljji = utils.cli(ret[:, j, j])
+        for i in range(j + 1, Nf):
+            ret[:, i, j] = (rmat[:, i, j] - np.sum(ret[:, i, :j] * ret[:, j, :j], axis=1)) * ljji
+    return ret
+
+
 class sims_cmb_unl:
     """Unlensed CMB skies simulation library.
 
+        Args:
+            cls_unl(dict): unlensed cmbs power spectra
+            lib_pha: random phases library for the unlensed maps (see *plancklens.sims.phas*)
+            cholesky(optional): if set, uses the lower-triangular Cholesky factor of the spectral matrix rather than its
+                                symmetric square root (the sims then differ from the default ones for the same phases).
+                                Field number i then only requires the phases 0 to i.
+            cache_alms(optional): if set (default), the single-field getters (e.g. *get_sim_tlm*) generate all fields
+                                  of the requested sim together in one pass, and keep them in memory until another sim is
+                                  requested, so that the other fields of the same sim are not regenerated.
+                                  *get_sim_alms* obtains all fields in one pass and does not fill this cache.
+
     """
-    def __init__(self, cls_unl, lib_pha):
+    def __init__(self, cls_unl, lib_pha, cholesky=False, cache_alms=True):
         lmax = lib_pha.lmax
         lmin = 0
         fields = _get_fields(cls_unl)
@@ -43,10 +72,12 @@ class sims_cmb_unl:
                     else:
                         str += " " + _t1 + _t2
         if verbose and str != '': print(str + ' set to zero')
-        for ell in range(lmin,lmax + 1):
-            t, v = np.linalg.eigh(rmat[ell, :, :])
-            assert np.all(t >= 0.), (ell, t, rmat[ell, :, :])  # Matrix not positive semidefinite
-            rmat[ell, :, :] = np.dot(v, np.dot(np.diag(np.sqrt(t)), v.T))
+        if cholesky:
+            rmat = _cholesky(rmat)
+        else:
+            t, v = np.linalg.eigh(rmat)
+            assert np.all(t >= 0.), 'Matrix not positive semidefinite'
+            rmat = np.einsum('lik,lk,ljk->lij', v, np.sqrt(t), v)
 
         self._cl_hash = {}
         for k in cls_unl.keys():
@@ -54,19 +85,52 @@ class sims_cmb_unl:
         self.rmat = rmat
         self.lib_pha = lib_pha
         self.fields = fields
+        self.cholesky = cholesky
+        self.cache_alms = cache_alms
+        self._cache = (None, None) # sim index, alms
 
     def hashdict(self):
         ret = {k : self._cl_hash[k] for k in self._cl_hash.keys()}
         ret['phas'] = self.lib_pha.hashdict()
+        if self.cholesky:
+            ret['cholesky'] = True
         return ret
 
-    def _get_sim_alm(self, idx, idf):
-        # FIXME : triangularise this
-        ret = hp.almxfl(self.lib_pha.get_sim(idx, idf=0), self.rmat[:, idf, 0])
-        for _i in range(1,len(self.fields)):
-            ret += hp.almxfl(self.lib_pha.get_sim(idx, idf=_i), self.rmat[:, idf, _i])
+    def _mix_phases(self, phases, idfs):
+        """Applies the spectral matrix rows idfs to the phases, with one matrix product per m."""
+        lmax = self.lib_pha.lmax
+        Nf = phases.shape[0]
+        ret = np.empty((len(idfs), phases.shape[1]), dtype=complex)
+        rmat = self.rmat[:, idfs, :Nf]
+        for m in range(lmax + 1):
+            sli = slice(hp.Alm.getidx(lmax, m, m), hp.Alm.getidx(lmax, lmax, m) + 1)
+            ret[:, sli] = np.einsum('lij,jl->il', rmat[m:], phases[:, sli])
         return ret
 
+    def get_sim_alms(self, idx):
+        """Returns all fields of a simulation, generated in one pass from a single draw of the phases.
+
+            Args:
+                idx: simulation index
+
+            Returns:
+                (number of fields, alm size) array, in the order of the *fields* attribute
+
+        """
+        if self._cache[0] == idx:
+            return np.copy(self._cache[1])
+        return self._mix_phases(self.lib_pha.get_sim(idx), list(range(len(self.fields))))
+
+    def _get_sim_alm(self, idx, idf):
+        if self.cache_alms and self._cache[0] != idx:
+            self._cache = (None, None)  # releases the previous sim first
+            self._cache = (idx, self.get_sim_alms(idx))
+        if self._cache[0] == idx:
+            return np.copy(self._cache[1][idf])
+        Nf = idf + 1 if self.cholesky else len(self.fields) # triangular mixing matrix
+        phases = np.array([self.lib_pha.get_sim(idx, idf=_i) for _i in range(Nf)])
+        return self._mix_phases(phases, [idf])[0]
+
     def get_sim_alm(self, idx, field):
         assert field in self.fields, self.fields
         return self._get_sim_alm(idx, self.fields.index(field))
@@ -91,14 +155,6 @@ class sims_cmb_unl:
         assert 'b' in self.fields, self.fields
         return self._get_sim_alm(idx, self.fields.index('b'))
 
-    def get_sim_alms(self, idx):
-        phases = self.lib_pha.get_sim(idx)
-        ret = np.zeros_like(phases)
-        Nf = len(self.fields)
-        for _i in range(Nf):
-            for _j in range(Nf):
-                ret[_i] += hp.almxfl(phases[_j], self.rmat[:, _i, _j])
-
 
 class sims_cmb_len:
     """Lensed CMB skies simulation library.
@@ -116,13 +172,19 @@ class sims_cmb_len:
             lib_pha(optional): random phases library for the unlensed maps (see *plancklens.sims.phas*)
             dlmax(defaults to 1024): unlensed cmbs are produced up to lmax + dlmax, for accurate lensing at lmax
             nside_lens(defaults to 4096): healpy resolution at which the lensed maps are produced
-            facres(defaults to 0): sets the interpolation resolution in lenspyx
-            nbands(defaults to 16): number of band-splits in *lenspyx.alm2lenmap(_spin)*
+            facres(defaults to 0): sets the interpolation resolution in lenspyx (versions < 2 only)
+            nbands(defaults to 16): number of band-splits in *lenspyx.alm2lenmap(_spin)* (versions < 2 only)
             verbose(defaults to True): lenspyx timing info printout
+            nthreads(defaults to 0): number of threads used by lenspyx (versions >= 2 only, 0 uses all cpus)
+
+        Note:
+            The lensed T, E and B alms of a sim are produced and cached together, with a single deflection field setup.
+            With lenspyx >= 2, temperature and polarization are also lensed in a single call.
+            lenspyx >= 2 ignores *facres* and *nbands*; *facres* remains part of the hash for compatibility with existing caches.
 
     """
     def __init__(self, lib_dir, lmax, cls_unl, lib_pha=None,
-                 dlmax=1024, nside_lens=4096, facres=0, nbands=16, verbose=True):
+                 dlmax=1024, nside_lens=4096, facres=0, nbands=16, verbose=True, nthreads=0):
         if not os.path.exists(lib_dir) and mpi.rank == 0:
             os.makedirs(lib_dir)
         mpi.barrier()
@@ -158,6 +220,7 @@ class sims_cmb_len:
             lenspyx = None
         self.lens_module = lenspyx
         self.verbose=verbose
+        self.nthreads = nthreads
 
     def hashdict(self):
         return {'unl_cmbs': self.unlcmbs.hashdict(),'lmax':self.lmax,
@@ -186,44 +249,62 @@ class sims_cmb_len:
     def get_sim_olm(self, idx):
         return self.unlcmbs.get_sim_olm(idx)
 
-    def _cache_eblm(self, idx):
-        elm = self.unlcmbs.get_sim_elm(idx)
-        blm = None if 'b' not in self.fields else self.unlcmbs.get_sim_blm(idx)
-        dlm = self.get_sim_plm(idx)
+    def _get_dlm(self, idx, plm=None):
+        dlm = self.get_sim_plm(idx) if plm is None else plm
         assert 'o' not in self.fields, 'not implemented'
-
         lmaxd = hp.Alm.getlmax(dlm.size)
         hp.almxfl(dlm, np.sqrt(np.arange(lmaxd + 1, dtype=float) * np.arange(1, lmaxd + 2)), inplace=True)
-        Qlen, Ulen = self.lens_module.alm2lenmap_spin([elm, blm], [dlm, None], self.nside_lens, 2,
-                                                nband=self.nbands, facres=self.facres, verbose=self.verbose)
-        elm, blm = hp.map2alm_spin([Qlen, Ulen], 2, lmax=self.lmax)
-        del Qlen, Ulen
-        hp.write_alm(os.path.join(self.lib_dir, 'sim_%04d_elm.fits' % idx), elm)
-        del elm
-        hp.write_alm(os.path.join(self.lib_dir, 'sim_%04d_blm.fits' % idx), blm)
-
-    def get_sim_tlm(self, idx):
-        fname = os.path.join(self.lib_dir, 'sim_%04d_tlm.fits' % idx)
+        return dlm
+
+    def _cache_teblm(self, idx):
+        """Lenses all CMB fields of a simulation with a single deflection field and caches the lensed alms."""
+        fields = [f for f in ['t', 'e', 'b'] if f in self.fields]
+        unl_alms = self.unlcmbs.get_sim_alms(idx) # all unlensed fields in one pass, released once lensed
+        unl = {f: unl_alms[self.unlcmbs.fields.index(f)] for f in fields}
+        if 'e' in unl and 'b' not in unl:
+            unl['b'] = np.zeros_like(unl['e'])
+        dlm = self._get_dlm(idx, plm=unl_alms[self.unlcmbs.fields.index('p')])
+        del unl_alms
+        len_alms = {}
+        if hasattr(self.lens_module, 'get_geom'): # lenspyx >= 2: one call for T and Pol.
+            # with pol=True the input is always (T, E, B) (zero T if absent): a two-array input would be read as (T, E)
+            pol = 'e' in unl
+            alms = [unl.get(f, np.zeros_like(unl['e'])) for f in ['t', 'e', 'b']] if pol else [unl['t']]
+            geom = ('healpix', {'nside': self.nside_lens})
+            maps = self.lens_module.alm2lenmap(alms, dlm, geometry=geom, verbose=self.verbose, nthreads=self.nthreads,
+                                               pol=pol)
+            maps = np.atleast_2d(maps)
+            if 't' in unl:
+                len_alms['t'] = hp.map2alm(maps[0], lmax=self.lmax, iter=0)
+            QU = maps[1:3] if pol else None
+        else:
+            if 't' in unl:
+                Tlen = self.lens_module.alm2lenmap(unl['t'], [dlm, None], self.nside_lens,
+                                                   facres=self.facres, nband=self.nbands, verbose=self.verbose)
+                len_alms['t'] = hp.map2alm(Tlen, lmax=self.lmax, iter=0)
+                del Tlen
+            QU = None
+            if 'e' in unl:
+                QU = self.lens_module.alm2lenmap_spin([unl['e'], unl['b']], [dlm, None], self.nside_lens, 2,
+                                                      nband=self.nbands, facres=self.facres, verbose=self.verbose)
+        del unl, dlm
+        if QU is not None:
+            len_alms['e'], len_alms['b'] = hp.map2alm_spin([QU[0], QU[1]], 2, lmax=self.lmax)
+            del QU
+        for f, alm in len_alms.items():
+            hp.write_alm(os.path.join(self.lib_dir, 'sim_%04d_%slm.fits' % (idx, f)), alm)
+
+    def _get_sim_alm_len(self, idx, f):
+        fname = os.path.join(self.lib_dir, 'sim_%04d_%slm.fits' % (idx, f))
         if not os.path.exists(fname):
-            tlm= self.unlcmbs.get_sim_tlm(idx)
-            dlm = self.get_sim_plm(idx)
-            assert 'o' not in self.fields, 'not implemented'
-
-            lmaxd = hp.Alm.getlmax(dlm.size)
-            hp.almxfl(dlm, np.sqrt(np.arange(lmaxd + 1, dtype=float) * np.arange(1, lmaxd + 2)), inplace=True)
-            Tlen = self.lens_module.alm2lenmap(tlm, [dlm, None], self.nside_lens,
-                                               facres=self.facres, nband=self.nbands, verbose=self.verbose)
-            hp.write_alm(fname, hp.map2alm(Tlen, lmax=self.lmax, iter=0))
+            self._cache_teblm(idx)
         return hp.read_alm(fname)
 
+    def get_sim_tlm(self, idx):
+        return self._get_sim_alm_len(idx, 't')
+
     def get_sim_elm(self, idx):
-        fname = os.path.join(self.lib_dir, 'sim_%04d_elm.fits' % idx)
-        if not os.path.exists(fname):
-            self._cache_eblm(idx)
-        return hp.read_alm(fname)
+        return self._get_sim_alm_len(idx, 'e')
 
     def get_sim_blm(self, idx):
-        fname = os.path.join(self.lib_dir, 'sim_%04d_blm.fits' % idx)
-        if not os.path.exists(fname):
-            self._cache_eblm(idx)
-        return hp.read_alm(fname)
\ No newline at end of file
+        return self._get_sim_alm_len(idx, 'b')
@@ -5,7 +5,7 @@ import pickle as pk
 import healpy as hp
 import numpy as np
 
-from plancklens.utils import clhash, hash_check
+from plancklens.utils import clhash, hash_check, alm_copy
 from plancklens.helpers import mpi
 from plancklens.sims import phas
 
@@ -88,7 +88,25 @@ class cmb_maps_noisefree(cmb_maps):
     def get_sim_unoise(self, idx):
         return np.zeros(hp.nside2npix(self.nside))
 
-class cmb_maps_nlev(cmb_maps):
+class lib_phas_noise(object):
+    """Mixin for simulation libraries generating homogeneous noise alms from a harmonic-space phases library *self.lib_phas*
+
+    """
+    def _get_lmax(self, lmax, lmax_cmb=None):
+        """Output lmax, defaulting to and bounded by the smallest of the phases and CMB (if set) lmaxs
+
+        """
+        lmax_max = self.lib_phas.lmax if lmax_cmb is None else min(lmax_cmb, self.lib_phas.lmax)
+        if lmax is None:
+            return lmax_max
+        assert lmax <= lmax_max, (lmax, lmax_cmb, self.lib_phas.lmax)
+        return lmax
+
+    def _get_noise_alm(self, idx, idf, nlev, lmax):
+        return (nlev / 60. / 180. * np.pi) * alm_copy(self.lib_phas.get_sim(idx, idf=idf), lmax=lmax)
+
+
+class cmb_maps_nlev(cmb_maps, lib_phas_noise):
     r"""CMB simulation library combining a lensed CMB library, transfer function and idealized homogeneous noise.
 
         Args:
@@ -100,15 +118,29 @@ class cmb_maps_nlev(cmb_maps):
             lib_dir(optional): noise maps random phases will be cached there. Only relevant if *pix_lib_phas is not set*
             pix_lib_phas(optional): random phases library for the noise maps (from *plancklens.sims.phas.py*).
                                     If not set, *lib_dir* arg must be set.
+            lib_phas(optional): harmonic-space random phases library with 3 fields (e.g. *plancklens.sims.phas.lib_phas_gen*).
+                                If set, the noise is generated directly as alms at the same noise level, with maximal
+                                multipole the smallest of that of *lib_phas* and of the lensed CMB,
+                                and the pixel maps are the synthesis of CMB + noise alms.
+                                The noise-only maps are then band-limited at the *lib_phas* lmax.
+
+        Note:
+            *get_sim_tlm* and *get_sim_eblm* return CMB + noise alms, as input to full-sky filtering.
+            With *lib_phas* set, this avoids any spherical harmonic transform.
+            Otherwise, they are obtained from the pixel-space maps.
 
 
     """
-    def __init__(self,sims_cmb_len, cl_transf, nlev_t, nlev_p, nside, lib_dir=None, pix_lib_phas=None):
-        if pix_lib_phas is None:
+    def __init__(self,sims_cmb_len, cl_transf, nlev_t, nlev_p, nside, lib_dir=None, pix_lib_phas=None, lib_phas=None):
+        if pix_lib_phas is None and lib_phas is None:
             assert lib_dir is not None
             pix_lib_phas = phas.pix_lib_phas(lib_dir, 3, (hp.nside2npix(nside),))
-        assert pix_lib_phas.shape == (hp.nside2npix(nside),), (pix_lib_phas.shape, (hp.nside2npix(nside),))
+        if pix_lib_phas is not None:
+            assert pix_lib_phas.shape == (hp.nside2npix(nside),), (pix_lib_phas.shape, (hp.nside2npix(nside),))
+        if lib_phas is not None:
+            assert lib_phas.nfields >= 3, lib_phas.nfields
         self.pix_lib_phas = pix_lib_phas
+        self.lib_phas = lib_phas
         self.nlev_t = nlev_t
         self.nlev_p = nlev_p
 
@@ -116,9 +148,77 @@ class cmb_maps_nlev(cmb_maps):
 
 
     def hashdict(self):
-        return {'sims_cmb_len':self.sims_cmb_len.hashdict(),
+        ret = {'sims_cmb_len':self.sims_cmb_len.hashdict(),
                 'nside':self.nside,'cl_transf':clhash(self.cl_transf),
-                'nlev_t':self.nlev_t,'nlev_p':self.nlev_p, 'pixphas':self.pix_lib_phas.hashdict()}
+                'nlev_t':self.nlev_t,'nlev_p':self.nlev_p}
+        if self.lib_phas is not None:
+            ret['almphas'] = self.lib_phas.hashdict()
+        else:
+            ret['pixphas'] = self.pix_lib_phas.hashdict()
+        return ret
+
+    def get_sim_tlm(self, idx, lmax=None):
+        """Returns temperature healpy alm array (CMB and noise) for a simulation
+
+            Args:
+                idx: simulation index
+                lmax(optional): maximal multipole of the output.
+                                With *lib_phas* set, defaults to the smallest of the lensed CMB and *lib_phas* lmaxs, and cannot exceed it.
+
+            Returns:
+                healpy alm array
+
+        """
+        if self.lib_phas is None:
+            return hp.map2alm(self.get_sim_tmap(idx), lmax=lmax, iter=0)
+        tlm = self.sims_cmb_len.get_sim_tlm(idx)
+        lmax = self._get_lmax(lmax, hp.Alm.getlmax(tlm.size))
+        tlm = alm_copy(tlm, lmax=lmax)
+        hp.almxfl(tlm, self.cl_transf, inplace=True)
+        tlm += self._get_noise_alm(idx, 0, self.nlev_t, lmax)
+        return tlm
+
+    def get_sim_eblm(self, idx, lmax=None):
+        """Returns E and B-polarization healpy alm arrays (CMB and noise) for a simulation
+
+            Args:
+                idx: simulation index
+                lmax(optional): maximal multipole of the output.
+                                With *lib_phas* set, defaults to the smallest of the lensed CMB and *lib_phas* lmaxs, and cannot exceed it.
+
+            Returns:
+                E and B healpy alm arrays
+
+        """
+        if self.lib_phas is None:
+            return hp.map2alm_spin(self.get_sim_pmap(idx), 2, lmax=lmax)
+        elm = self.sims_cmb_len.get_sim_elm(idx)
+        lmax = self._get_lmax(lmax, hp.Alm.getlmax(elm.size))
+        elm = alm_copy(elm, lmax=lmax)
+        hp.almxfl(elm, self.cl_transf, inplace=True)
+        elm += self._get_noise_alm(idx, 1, self.nlev_p, lmax)
+        blm = alm_copy(self.sims_cmb_len.get_sim_blm(idx), lmax=lmax)
+        hp.almxfl(blm, self.cl_transf, inplace=True)
+        blm += self._get_noise_alm(idx, 2, self.nlev_p, lmax)
+        return elm, blm
+
+    def get_sim_tmap(self, idx):
+        if self.lib_phas is None:
+            return super(cmb_maps_nlev, self).get_sim_tmap(idx)
+        return hp.alm2map(self.get_sim_tlm(idx), self.nside)
+
+    def get_sim_pmap(self, idx):
+        if self.lib_phas is None:
+            return super(cmb_maps_nlev, self).get_sim_pmap(idx)
+        elm, blm = self.get_sim_eblm(idx)
+        Q, U = hp.alm2map_spin([elm, blm], self.nside, 2, hp.Alm.getlmax(elm.size))
+        return Q, U
+
+    def _get_sim_pnoise(self, idx):
+        lmax = self._get_lmax(None)
+        nelm = self._get_noise_alm(idx, 1, self.nlev_p, lmax)
+        nblm = self._get_noise_alm(idx, 2, self.nlev_p, lmax)
+        return hp.alm2map_spin([nelm, nblm], self.nside, 2, lmax)
 
     def get_sim_tnoise(self,idx):
         """Returns noise temperature map for a simulation
@@ -130,6 +230,8 @@ class cmb_maps_nlev(cmb_maps):
                 healpy map
 
         """
+        if self.lib_phas is not None:
+            return hp.alm2map(self._get_noise_alm(idx, 0, self.nlev_t, self._get_lmax(None)), self.nside)
         vamin = np.sqrt(hp.nside2pixarea(self.nside, degrees=True)) * 60
         return self.nlev_t / vamin * self.pix_lib_phas.get_sim(idx, idf=0)
 
@@ -143,6 +245,8 @@ class cmb_maps_nlev(cmb_maps):
                 healpy map
 
         """
+        if self.lib_phas is not None:
+            return self._get_sim_pnoise(idx)[0]
         vamin = np.sqrt(hp.nside2pixarea(self.nside, degrees=True)) * 60
         return self.nlev_p / vamin * self.pix_lib_phas.get_sim(idx, idf=1)
 
@@ -156,9 +260,7 @@ class cmb_maps_nlev(cmb_maps):
                 healpy map
 
         """
+        if self.lib_phas is not None:
+            return self._get_sim_pnoise(idx)[1]
         vamin = np.sqrt(hp.nside2pixarea(self.nside, degrees=True)) * 60
         return self.nlev_p / vamin * self.pix_lib_phas.get_sim(idx, idf=2)
-
-
-
-
@@ -2,6 +2,7 @@ from __future__ import print_function
 
 import os
 import sqlite3
+import threading
 
 import healpy as hp
 import numpy as np
@@ -124,9 +125,14 @@ class _pix_lib_phas(sim_lib):
         self.shape = shape
         super(_pix_lib_phas, self).__init__(lib_dir, **kwargs)
 
-    def _build_sim_from_rng(self, rng_state, **kwargs):
+    def _build_sim_from_rng(self, rng_state, phas_only=False, dtype=np.float64, out=None):
         np.random.set_state(rng_state)
-        return np.random.standard_normal(self.shape)
+        if phas_only: return
+        if out is None:
+            return np.random.standard_normal(self.shape).astype(dtype, copy=False)
+        assert out.shape == tuple(self.shape), (out.shape, self.shape)
+        out[:] = np.random.standard_normal(self.shape)
+        return out
 
     def hashdict(self):
         return {'shape': self.shape}
@@ -142,11 +148,19 @@ class pix_lib_phas:
     def is_full(self):
         return np.all([lib.is_full() for lib in self.lib_pix.values()])
 
-    def get_sim(self, idx, idf=None, phas_only=False):
+    def get_sim(self, idx, idf=None, phas_only=False, dtype=np.float64, out=None):
         if idf is not None:
             assert idf < self.nfields, (idf, self.nfields)
-            return self.lib_pix[idf].get_sim(idx, phas_only=phas_only)
-        return np.array([self.lib_pix[_idf].get_sim(idx, phas_only=phas_only) for _idf in range(self.nfields)])
+            return self.lib_pix[idf].get_sim(idx, phas_only=phas_only, dtype=dtype, out=out)
+        if phas_only:
+            for _idf in range(self.nfields):
+                self.lib_pix[_idf].get_sim(idx, phas_only=True)
+            return
+        if out is None:
+            out = np.empty((self.nfields,) + tuple(self.shape), dtype=dtype)
+        for _idf in range(self.nfields):
+            self.lib_pix[_idf].get_sim(idx, phas_only=phas_only, out=out[_idf])
+        return out
 
     def hashdict(self):
         return {'nfields': self.nfields, 'shape': self.shape}
@@ -190,3 +204,231 @@ class lib_phas:
 
     def hashdict(self):
         return {'nfields': self.nfields, 'lmax':self.lmax}
+
+
+def get_rng(seed, idf, idx, bitgen='philox', sub=None):
+    """Returns a counter-based random number generator keyed by (seed, field, simulation index).
+
+        Any (seed, idf, idx) triplet defines an independent stream, reproducible without storing any state.
+
+        Args:
+            seed: global seed of the simulation set (non-negative integer)
+            idf: field index
+            idx: simulation index
+            bitgen: 'philox' or 'sfc64'
+            sub(optional): independent sub-stream index (e.g. chunk index of a large map)
+
+    """
+    assert idx >= 0 and idf >= 0, (idf, idx)
+    key = (int(idf), int(idx)) if sub is None else (int(idf), int(idx), int(sub))
+    ss = np.random.SeedSequence(seed, spawn_key=key)
+    if bitgen == 'philox':
+        return np.random.Generator(np.random.Philox(ss))
+    elif bitgen == 'sfc64':
+        return np.random.Generator(np.random.SFC64(ss))
+    assert 0, bitgen + ' not implemented'
+
+
+class gen_lib(object):
+    """Generic class for simulations built from a counter-based random number generator.
+
+        Contrary to *sim_lib*, no rng state is stored: the random numbers of field *idf* of sim *idx* are always
+        those of *get_rng(seed, idf, idx)*. Any simulation can be accessed in any order and from any thread or process.
+
+        Args:
+            nfields: number of independent fields per simulation
+            seed: global seed of the simulation set
+            lib_dir(optional): hash checks will be cached there
+            nsims_max(optional): maximal number of simulations
+            bitgen(optional): 'philox' (default) or 'sfc64'
+            nthreads(optional): number of threads used to generate the fields. Defaults to *os.cpu_count()*
+
+    """
+    def __init__(self, nfields, seed, lib_dir=None, nsims_max=None, bitgen='philox', nthreads=None):
+        assert bitgen in ['philox', 'sfc64'], bitgen
+        self.nfields = nfields
+        self.seed = seed
+        self.nmax = nsims_max
+        self.bitgen = bitgen
+        self.nthreads = nthreads or os.cpu_count() or 1
+        if lib_dir is not None:
+            if not os.path.exists(lib_dir) and mpi.rank == 0:
+                os.makedirs(lib_dir)
+            fn_hash = os.path.join(lib_dir, 'sim_hash.pk')
+            if mpi.rank == 0 and not os.path.exists(fn_hash):
+                pk.dump(self.hashdict(), open(fn_hash, 'wb'), protocol=2)
+            mpi.barrier()
+            utils.hash_check(pk.load(open(fn_hash, 'rb')), self.hashdict(), ignore=['lib_dir'])
+
+    def get_sim(self, idx, idf=None, **kwargs):
+        """Returns field *idf* of sim number *idx*, or all fields if *idf* is not set. """
+        if self.has_nmax(): assert idx < self.nmax, (idx, self.nmax)
+        if idf is not None:
+            assert idf < self.nfields, (idf, self.nfields)
+            return self._build_sim(idx, idf, **kwargs)
+        return np.array(self.get_sims([idx], **kwargs)[0])
+
+    def get_sims(self, idxs, idfs=None, **kwargs):
+        """Returns a list (one entry per sim) of lists (one entry per field) of simulations, generated in parallel.
+
+            Args:
+                idxs: simulation indices
+                idfs(optional): field indices (defaults to all fields)
+
+        """
+        idfs = range(self.nfields) if idfs is None else idfs
+        jobs = [(idx, idf) for idx in idxs for idf in idfs]
+        if self.nthreads > 1 and len(jobs) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(self.nthreads, len(jobs))) as ex:
+                sims = list(ex.map(lambda job: self.get_sim(job[0], idf=job[1], **kwargs), jobs))
+        else:
+            sims = [self.get_sim(idx, idf=idf, **kwargs) for idx, idf in jobs]
+        nf = len(idfs)
+        return [sims[i * nf:(i + 1) * nf] for i in range(len(idxs))]
+
+    def has_nmax(self):
+        return not self.nmax is None
+
+    def is_stored(self, idx):
+        """Always true: all sims are accessible without any stored state. """
+        return not self.has_nmax() or idx < self.nmax
+
+    def is_full(self):
+        return True
+
+    def is_empty(self):
+        return False
+
+    def hashdict(self):
+        return {'nfields': self.nfields, 'seed': self.seed, 'bitgen': self.bitgen}
+
+    def _build_sim(self, idx, idf, **kwargs):
+        return self._build_sim_from_rng(get_rng(self.seed, idf, idx, bitgen=self.bitgen), **kwargs)
+
+    def _build_sim_from_rng(self, rng, **kwargs):
+        """Override this """
+        assert 0
+
+
+class lib_phas_gen(gen_lib):
+    """Counter-based random phases library for harmonic space unit variance Gaussian fields.
+
+        Drop-in replacement of *lib_phas*, without the sqlite database of rng states.
+
+        Args:
+            nfields: number of fields
+            lmax: alms are generated up to lmax
+            seed: global seed of the simulation set
+
+        See *gen_lib* for the other arguments.
+
+    """
+    def __init__(self, nfields, lmax, seed, **kwargs):
+        self.lmax = lmax
+        super(lib_phas_gen, self).__init__(nfields, seed, **kwargs)
+
+    def _build_sim_from_rng(self, rng, phas_only=False):
+        if phas_only: return
+        alm = rng.standard_normal(2 * hp.Alm.getsize(self.lmax)).view(complex)
+        alm *= 1. / np.sqrt(2.)
+        alm[:self.lmax + 1] = np.sqrt(2.) * alm[:self.lmax + 1].real # m = 0 entries
+        return alm
+
+    def hashdict(self):
+        ret = super(lib_phas_gen, self).hashdict()
+        ret['lmax'] = self.lmax
+        return ret
+
+
+class pix_lib_phas_gen(gen_lib):
+    """Counter-based random phases library for pixel space unit variance Gaussian white noise maps.
+
+        Drop-in replacement of *pix_lib_phas*, without the sqlite database of rng states.
+
+        Each map is split into chunks of *chunk_size* pixels, each drawn from its own sub-stream.
+        The chunks are generated in parallel threads when called from the main thread, or with the executor passed
+        to *get_sim*. Calls made from other threads (e.g. the *get_sims* or *sim_lib_add* pools) generate the chunks
+        serially, so that nested pools do not oversubscribe the cores.
+
+        Args:
+            nfields: number of fields
+            shape: shape of the maps
+            seed: global seed of the simulation set
+            chunk_size(optional): number of pixels per independent sub-stream. Defaults to 2 ** 20.
+
+        See *gen_lib* for the other arguments.
+
+        Note:
+            The maps depend on *chunk_size*, which is part of the hash.
+
+    """
+    def __init__(self, nfields, shape, seed, chunk_size=2 ** 20, **kwargs):
+        self.shape = shape
+        self.chunk_size = chunk_size
+        super(pix_lib_phas_gen, self).__init__(nfields, seed, **kwargs)
+
+    def get_sim(self, idx, idf=None, phas_only=False, dtype=np.float64, out=None, executor=None):
+        """Returns noise map *idf* of sim *idx*, or all fields if *idf* is not set.
+
+            Args:
+                idx: simulation index
+                idf(optional): field index
+                dtype(optional): np.float64 (default) or np.float32
+                out(optional): preallocated output array, of shape *shape* (or (nfields,) + shape if idf is None)
+                executor(optional): *concurrent.futures* executor generating the chunks
+
+        """
+        if idf is not None or phas_only:
+            return super(pix_lib_phas_gen, self).get_sim(idx, idf=idf, phas_only=phas_only, dtype=dtype, out=out,
+                                                         executor=executor)
+        if self.has_nmax(): assert idx < self.nmax, (idx, self.nmax)
+        if out is None:
+            out = np.empty((self.nfields,) + tuple(self.shape), dtype=dtype)
+        assert out.shape == (self.nfields,) + tuple(self.shape), (out.shape, self.shape)
+        if executor is None and self._parallel_chunks():  # one pool for all fields
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(self.nthreads, self._nchunks())) as ex:
+                return self.get_sim(idx, dtype=dtype, out=out, executor=ex)
+        for _idf in range(self.nfields):
+            self._build_sim(idx, _idf, dtype=out.dtype, out=out[_idf], executor=executor)
+        return out
+
+    def _nchunks(self):
+        return (int(np.prod(self.shape)) + self.chunk_size - 1) // self.chunk_size
+
+    def _parallel_chunks(self):
+        """Chunks are generated by a new pool only from the main thread """
+        return self.nthreads > 1 and self._nchunks() > 1 and threading.current_thread() is threading.main_thread()
+
+    def _build_sim(self, idx, idf, phas_only=False, dtype=np.float64, out=None, executor=None):
+        if phas_only: return
+        if out is None:
+            out = np.empty(self.shape, dtype=dtype)
+        assert out.shape == tuple(self.shape) and out.dtype in [np.float32, np.float64], (out.shape, out.dtype)
+        assert out.flags.c_contiguous
+        flat = out.reshape(-1)
+        nchunks = self._nchunks()
+        def _fill(ichunk):
+            sli = slice(ichunk * self.chunk_size, min((ichunk + 1) * self.chunk_size, flat.size))
+            rng = get_rng(self.seed, idf, idx, bitgen=self.bitgen, sub=ichunk)
+            if out.dtype == np.float64:
+                rng.standard_normal(out=flat[sli])
+            else: # same realization as in double precision
+                flat[sli] = rng.standard_normal(sli.stop - sli.start)
+        if executor is not None and nchunks > 1:
+            list(executor.map(_fill, range(nchunks)))
+        elif self._parallel_chunks():
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(self.nthreads, nchunks)) as ex:
+                list(ex.map(_fill, range(nchunks)))
+        else:  # serial, in particular when already running in a pool thread
+            for ichunk in range(nchunks):
+                _fill(ichunk)
+        return out
+
+    def hashdict(self):
+        ret = super(pix_lib_phas_gen, self).hashdict()
+        ret['shape'] = self.shape
+        ret['chunk_size'] = self.chunk_size
+        return ret
@@ -11,6 +11,8 @@ import healpy as hp
 import numpy as np
 
 from plancklens import utils
+from plancklens.sims.utils import map_reader
+from plancklens.sims.maps import lib_phas_noise
 
 class smica_dx12:
     r""" SMICA 2018 release simulation and data library at NERSC.
@@ -18,11 +20,24 @@ class smica_dx12:
         Note:
             This now converts all maps to double precision
             (healpy 1.15 changed read_map default type behavior, breaking in a way that is not very clear as yet the behavior of the conjugate gradient inversion chain)
+
+        Args:
+            cache_size(optional): number of files (with all T, Q, U fields) kept in memory.
+                                  Defaults to 0: each field is read on request, and the files are read once per field.
+                                  Set this to 2 (keeping the CMB and noise of one sim, at ~2.4 GB) to read each file once.
+                                  1 is not allowed, since the CMB and noise files would then evict each other.
+            mirror_dir(optional): if set, local memory-mapped *.npy* copies of the files are made and used there.
+
     """
-    def __init__(self):
+    def __init__(self, cache_size=0, mirror_dir=None):
+        assert cache_size == 0 or cache_size >= 2, 'CMB and noise files evict each other with cache_size 1'
         self.cmbs = '/project/projectdirs/cmb/data/planck2018/ffp10/compsep/mc_cmb/dx12_v3_smica_cmb_mc_%05d_005a_2048.fits'
         self.noise = '/project/projectdirs/cmb/data/planck2018/ffp10/compsep/mc_noise/dx12_v3_smica_noise_mc_%05d_005a_2048.fits'
         self.data = '/project/projectdirs/cmb/data/planck2018/pr3/cmbmaps/dx12_v3_smica_cmb_005a_2048.fits'
+        self.reader = map_reader(fields=(0, 1, 2), cache_size=cache_size, mirror_dir=mirror_dir, dtype=np.float64)
+
+    def _read_map(self, fname, field):
+        return self.reader.get_map(fname, field)
 
     def hashdict(self):
         return {'cmbs':self.cmbs, 'noise':self.noise, 'data':self.data}
@@ -39,10 +54,10 @@ class smica_dx12:
         """
         if idx == -1:
             return self.get_dat_tmap()
-        return 1e6 * (hp.read_map(self.cmbs % idx, field=0, dtype=np.float64) + hp.read_map(self.noise % idx, field=0, dtype=np.float64))
+        return 1e6 * (self._read_map(self.cmbs % idx, 0) + self._read_map(self.noise % idx, 0))
 
     def get_dat_tmap(self):
-        return 1e6 * hp.read_map(self.data, field=0, dtype=np.float64)
+        return 1e6 * self._read_map(self.data, 0)
 
     def get_sim_pmap(self, idx):
         r"""Returns dx12 SMICA polarization map for a simulation
@@ -56,14 +71,14 @@ class smica_dx12:
         """
         if idx == -1:
             return self.get_dat_pmap()
-        Q = 1e6 * (hp.read_map(self.cmbs % idx, field=1, dtype=np.float64) + hp.read_map(self.noise % idx, field=1, dtype=np.float64))
-        U = 1e6 * (hp.read_map(self.cmbs % idx, field=2, dtype=np.float64) + hp.read_map(self.noise % idx, field=2, dtype=np.float64))
+        Q = 1e6 * (self._read_map(self.cmbs % idx, 1) + self._read_map(self.noise % idx, 1))
+        U = 1e6 * (self._read_map(self.cmbs % idx, 2) + self._read_map(self.noise % idx, 2))
         return Q, U
 
     def get_dat_pmap(self):
-        return 1e6 * hp.read_map(self.data, field=1, dtype=np.float64), 1e6 * hp.read_map(self.data, field=2, dtype=np.float64)
+        return 1e6 * self._read_map(self.data, 1), 1e6 * self._read_map(self.data, 2)
 
-class ffp10cmb_widnoise:
+class ffp10cmb_widnoise(lib_phas_noise):
     r"""Simulation library with freq-0 FFP10 lensed CMB together with idealized, homogeneous noise.
 
         Args:
@@ -71,27 +86,66 @@ class ffp10cmb_widnoise:
             nlevt: temperature noise level in :math:`\mu K`-arcmin.
             nlevp: polarization noise level in :math:`\mu K`-arcmin.
             pix_libphas: random phases simulation library (see plancklens.sims.phas.py) of the noise maps.
+            lib_phas(optional): harmonic-space random phases library with 3 fields (e.g. *plancklens.sims.phas.lib_phas_gen*).
+                                If set, the noise is generated as alms instead and *pix_libphas* may be None.
+
+        Note:
+            *get_sim_tlm* and *get_sim_eblm* return CMB + noise alms, as input to full-sky filtering.
+            With *lib_phas* set, this avoids any spherical harmonic transform. Their lmax then defaults to
+            the smallest of the lensed CMB and *lib_phas* lmaxs, and cannot exceed it.
 
     """
-    def __init__(self, transf, nlevt, nlevp, pix_libphas, nside=2048):
-        assert pix_libphas.shape == (hp.nside2npix(nside),), pix_libphas.shape
+    def __init__(self, transf, nlevt, nlevp, pix_libphas, nside=2048, lib_phas=None):
+        assert pix_libphas is not None or lib_phas is not None
+        if pix_libphas is not None:
+            assert pix_libphas.shape == (hp.nside2npix(nside),), pix_libphas.shape
         self.nlevt = nlevt
         self.nlevp = nlevp
         self.transf = transf
         self.pix_libphas = pix_libphas
+        self.lib_phas = lib_phas
         self.nside = nside
 
     def hashdict(self):
-        return {'transf':utils.clhash(self.transf), 'nlevt':np.float32(self.nlevt), 'nlevp':np.float32(self.nlevp),
-                'pix_phas':self.pix_libphas.hashdict()}
+        ret = {'transf':utils.clhash(self.transf), 'nlevt':np.float32(self.nlevt), 'nlevp':np.float32(self.nlevp)}
+        if self.lib_phas is not None:
+            ret['alm_phas'] = self.lib_phas.hashdict()
+        else:
+            ret['pix_phas'] = self.pix_libphas.hashdict()
+        return ret
+
+    def get_sim_tlm(self, idx, lmax=None):
+        if self.lib_phas is None:
+            return hp.map2alm(self.get_sim_tmap(idx), lmax=lmax, iter=0)
+        tlm = cmb_len_ffp10.get_sim_tlm(idx)
+        lmax = self._get_lmax(lmax, hp.Alm.getlmax(tlm.size))
+        tlm = hp.almxfl(utils.alm_copy(tlm, lmax=lmax), self.transf)
+        tlm += self._get_noise_alm(idx, 0, self.nlevt, lmax)
+        return tlm
+
+    def get_sim_eblm(self, idx, lmax=None):
+        if self.lib_phas is None:
+            return hp.map2alm_spin(self.get_sim_pmap(idx), 2, lmax=lmax)
+        elm = cmb_len_ffp10.get_sim_elm(idx)
+        lmax = self._get_lmax(lmax, hp.Alm.getlmax(elm.size))
+        elm = hp.almxfl(utils.alm_copy(elm, lmax=lmax), self.transf)
+        elm += self._get_noise_alm(idx, 1, self.nlevp, lmax)
+        blm = hp.almxfl(utils.alm_copy(cmb_len_ffp10.get_sim_blm(idx), lmax=lmax), self.transf)
+        blm += self._get_noise_alm(idx, 2, self.nlevp, lmax)
+        return elm, blm
 
     def get_sim_tmap(self, idx):
+        if self.lib_phas is not None:
+            return hp.alm2map(self.get_sim_tlm(idx), self.nside)
         T = hp.alm2map(hp.almxfl(cmb_len_ffp10.get_sim_tlm(idx), self.transf), self.nside)
         nlevt_pix = self.nlevt / np.sqrt(hp.nside2pixarea(self.nside, degrees=True)) / 60.
         T += self.pix_libphas.get_sim(idx, idf=0) * nlevt_pix
         return T
 
     def get_sim_pmap(self, idx):
+        if self.lib_phas is not None:
+            elm, blm = self.get_sim_eblm(idx)
+            return hp.alm2map_spin((elm, blm), self.nside, 2, hp.Alm.getlmax(elm.size))
         elm = hp.almxfl(cmb_len_ffp10.get_sim_elm(idx), self.transf)
         blm = hp.almxfl(cmb_len_ffp10.get_sim_blm(idx), self.transf)
         Q, U = hp.alm2map_spin((elm, blm), self.nside, 2, hp.Alm.getlmax(elm.size))
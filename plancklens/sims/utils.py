@@ -1,4 +1,10 @@
+import os
+import hashlib
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import healpy as hp
 
 class sim_lib_shuffle:
     """A simulation library with remapped indices.
@@ -8,6 +14,10 @@ class sim_lib_shuffle:
     def __init__(self, sim_lib, shuffle_dict):
         self.sim_lib = sim_lib
         self._shuffle = shuffle_dict
+        # harmonic-space access is exposed only if the shuffled library has it
+        if hasattr(sim_lib, 'get_sim_tlm') and hasattr(sim_lib, 'get_sim_eblm'):
+            self.get_sim_tlm = lambda idx, **kwargs: self.sim_lib.get_sim_tlm(self._shuffle[idx], **kwargs)
+            self.get_sim_eblm = lambda idx, **kwargs: self.sim_lib.get_sim_eblm(self._shuffle[idx], **kwargs)
 
     def get_sim_tmap(self, idx): return self.sim_lib.get_sim_tmap(self._shuffle[idx])
 
@@ -17,33 +27,116 @@ class sim_lib_shuffle:
         return {'sim_lib': self.sim_lib.hashdict(), 'shuffle': self._shuffle}
 
 
-class sim_lib_add_sim:
-    """Added simulation libraries.
+class _sim_lib_add(object):
+    """Added simulation libraries, with components optionally fetched concurrently.
 
-        Addition only for sim (>= 0) indices.
+        Args:
+            sim_libs: list of simulation libraries
+            weights(optional): weights of the libraries in the sum (defaults to ones)
+            nthreads(optional): number of threads fetching the components (defaults to 1, serial)
+            prefetch(optional): if set, the sum for simulation index *idx + 1* is built in a background thread after each
+                                request of simulation *idx* >= 0
+
+        Note:
+            The thread pools are shut down by *close* (or when the instance is garbage collected).
+
+        Note:
+            *nthreads > 1* and *prefetch* require thread-safe component libraries, e.g. built on the counter-based
+            *phas.lib_phas_gen* or *phas.pix_lib_phas_gen*. The legacy *phas.lib_phas* and *phas.pix_lib_phas* are not
+            (sqlite rng database and global numpy random state).
 
     """
-    def __init__(self, sim_libs, weights=None):
+    def __init__(self, sim_libs, weights=None, nthreads=1, prefetch=False):
         self.w = weights if weights is not None else np.ones(len(sim_libs))
         self.sim_libs = sim_libs
+        self.nthreads = nthreads
+        self.prefetch = prefetch
+
+        self._pool = None
+        self._prefetch_pool = None
+        self._prefetched = {}
+        self._lock = threading.Lock()
+
+    def _adds(self, idx):
+        assert 0, 'override this'
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.nthreads)
+        return self._pool
+
+    def _build(self, field, idx):
+        libs = self.sim_libs if self._adds(idx) else self.sim_libs[:1]
+        fetch = (lambda s: (s.get_sim_tmap(idx),)) if field == 't' else (lambda s: tuple(s.get_sim_pmap(idx)))
+        with self._lock: # one sum at a time (a prefetch and a direct request do not read the same files concurrently)
+            if self.nthreads > 1 and len(libs) > 1:
+                futs = [self._get_pool().submit(fetch, s) for s in libs]
+                comps = (f.result() for f in futs)
+            else:
+                comps = (fetch(s) for s in libs)
+            ret = None
+            for m, w in zip(comps, self.w): # summed in library order whatever the order of completion
+                if ret is None:
+                    ret = tuple(np.multiply(_m, w) for _m in m)
+                else:
+                    for _r, _m in zip(ret, m):
+                        if w == 1.:
+                            _r += _m
+                        else:
+                            _r += w * _m
+                del m
+        return ret[0] if field == 't' else ret
+
+    def _get(self, field, idx):
+        fut = self._prefetched.pop((field, idx), None)
+        for k in [k for k in self._prefetched if k[0] == field]:
+            # pending prefetches are cancelled and finished ones released. A running one cannot be stopped,
+            # and is kept so that its result can still be used
+            if self._prefetched[k].cancel() or self._prefetched[k].done():
+                del self._prefetched[k]
+        ret = fut.result() if fut is not None else self._build(field, idx)
+        if self.prefetch and idx >= 0 and (field, idx + 1) not in self._prefetched:
+            if self._prefetch_pool is None:
+                self._prefetch_pool = ThreadPoolExecutor(max_workers=1)
+            self._prefetched[(field, idx + 1)] = self._prefetch_pool.submit(self._build, field, idx + 1)
+        return ret
+
+    def close(self, wait=True):
+        """Cancels the pending prefetches and shuts down the thread pools
+
+        """
+        for fut in self._prefetched.values():
+            fut.cancel()
+        self._prefetched = {}
+        for pool in [self._pool, self._prefetch_pool]:
+            if pool is not None:
+                pool.shutdown(wait=wait)
+        self._pool = None
+        self._prefetch_pool = None
+
+    def __del__(self):
+        self.close(wait=False)
 
     def get_sim_tmap(self, idx):
-        t = self.sim_libs[0].get_sim_tmap(idx) * self.w[0]
-        if idx >= 0:
-            for s, w in zip(self.sim_libs[1:], self.w[1:]):
-                t += s.get_sim_tmap(idx) * w
-        return t
+        return self._get('t', idx)
 
     def get_sim_pmap(self, idx):
-        q, u = self.sim_libs[0].get_sim_pmap(idx)
-        q *= self.w[0]
-        u *= self.w[0]
-        if idx >= 0:
-            for s, w in zip(self.sim_libs[1:], self.w[1:]):
-                _q, _u = s.get_sim_pmap(idx)
-                q += w * _q
-                u += w * _u
-        return q, u
+        return self._get('p', idx)
+
+
+class sim_lib_add_sim(_sim_lib_add):
+    """Added simulation libraries.
+
+        Addition only for sim (>= 0) indices.
+
+        See *_sim_lib_add* for the concurrency arguments.
+
+    """
+    def __init__(self, sim_libs, weights=None, nthreads=1, prefetch=False):
+        super(sim_lib_add_sim, self).__init__(sim_libs, weights=weights, nthreads=nthreads, prefetch=prefetch)
+
+    def _adds(self, idx):
+        return idx >= 0
 
     def hashdict(self):
         ret = {'lib': 'add_sim'}
@@ -54,33 +147,19 @@ class sim_lib_add_sim:
 
 
 
-class sim_lib_add_dat:
+class sim_lib_add_dat(_sim_lib_add):
     """Added simulation libraries.
 
         Addition only for data (< 0) indices.
 
-    """
-    def __init__(self, sim_libs, weights=None):
-        self.w = weights if weights is not None else np.ones(len(sim_libs))
-        self.sim_libs = sim_libs
+        See *_sim_lib_add* for the concurrency arguments.
 
-    def get_sim_tmap(self, idx):
-        t = self.sim_libs[0].get_sim_tmap(idx) * self.w[0]
-        if idx < 0:
-            for s, w in zip(self.sim_libs[1:], self.w[1:]):
-                t += s.get_sim_tmap(idx) * w
-        return t
+    """
+    def __init__(self, sim_libs, weights=None, nthreads=1, prefetch=False):
+        super(sim_lib_add_dat, self).__init__(sim_libs, weights=weights, nthreads=nthreads, prefetch=prefetch)
 
-    def get_sim_pmap(self, idx):
-        q, u = self.sim_libs[0].get_sim_pmap(idx)
-        q *= self.w[0]
-        u *= self.w[0]
-        if idx < 0:
-            for s, w in zip(self.sim_libs[1:], self.w[1:]):
-                _q, _u = s.get_sim_pmap(idx)
-                q += w * _q
-                u += w * _u
-        return q, u
+    def _adds(self, idx):
+        return idx < 0
 
     def hashdict(self):
         ret = {'lib': 'add_dat'}
@@ -93,3 +172,63 @@ class sim_lib_add_dat:
 
 
 
+
+
+class map_reader:
+    """Healpy maps reader, optionally reading all fields of a file at once and keeping a small cache of recently read files.
+
+        Args:
+            fields: fields read in each file (defaults to T, Q, U)
+            cache_size: number of files kept in memory (defaults to 0: only the requested field is read, and not kept).
+                        If set, all fields of a file are read at once, and this must be at least the number of files
+                        whose fields are requested alternately (e.g. 2 for the CMB and noise files of a simulation):
+                        otherwise the files evict each other and every field request reads all fields again
+            mirror_dir(optional): if set, each file is converted once to a local *.npy* copy there,
+                                  subsequently accessed with memory-mapping instead of parsing the original file again.
+                                  The copies are keyed by the full path, modification time and size of the original file.
+            dtype: maps data type (defaults to double precision)
+
+    """
+    def __init__(self, fields=(0, 1, 2), cache_size=0, mirror_dir=None, dtype=np.float64):
+        self.fields = tuple(fields)
+        self.cache_size = cache_size
+        self.mirror_dir = mirror_dir
+        self.dtype = dtype
+        self._cache = collections.OrderedDict()
+        if mirror_dir is not None and not os.path.exists(mirror_dir):
+            os.makedirs(mirror_dir, exist_ok=True)
+
+    def _mirror_path(self, fname):
+        st = os.stat(fname)
+        key = '%s_%s_%s' % (os.path.abspath(fname), st.st_mtime_ns, st.st_size)
+        return os.path.join(self.mirror_dir, os.path.basename(fname).replace('.fits', '')
+                            + '_%s_f%s.npy' % (hashlib.sha1(key.encode()).hexdigest()[:16], ''.join(str(f) for f in self.fields)))
+
+    def _read(self, fname):
+        if self.mirror_dir is None:
+            return np.atleast_2d(hp.read_map(fname, field=self.fields, dtype=self.dtype))
+        path = self._mirror_path(fname)
+        if not os.path.exists(path):
+            maps = np.atleast_2d(hp.read_map(fname, field=self.fields, dtype=self.dtype))
+            tmp = path.replace('.npy', '_%s.tmp.npy' % os.getpid())
+            np.save(tmp, maps)
+            os.replace(tmp, path) # atomic, in case of concurrent writers
+        return np.load(path, mmap_mode='r')
+
+    def get_map(self, fname, field):
+        """Returns a (read-only) field of a map file, reading and caching all fields of the file if caching or mirroring."""
+        if fname in self._cache:
+            self._cache.move_to_end(fname)
+        elif self.cache_size <= 0 and self.mirror_dir is None:
+            return hp.read_map(fname, field=field, dtype=self.dtype)
+        else:
+            maps = self._read(fname)
+            if self.cache_size > 0:
+                self._cache[fname] = maps
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            return maps[self.fields.index(field)]
+        return self._cache[fname][self.fields.index(field)]
+
+    def clear(self):
+        self._cache.clear()
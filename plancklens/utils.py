@@ -24,11 +24,11 @@ def alm_copy(alm, lmax=None):
         lmax (int, optional): new alm lmax.
     """
     alm_lmax = int(np.floor(np.sqrt(2 * len(alm)) - 1))
-    assert lmax <= alm_lmax, (lmax, alm_lmax)
-    if (alm_lmax == lmax) or (lmax is None):
+    assert lmax is None or lmax <= alm_lmax, (lmax, alm_lmax)
+    if (lmax is None) or (alm_lmax == lmax):
         ret = np.copy(alm)
     else:
-        ret = np.zeros((lmax + 1) * (lmax + 2) // 2, dtype=np.complex)
+        ret = np.zeros((lmax + 1) * (lmax + 2) // 2, dtype=complex)
         for m in range(0, lmax + 1):
             ret[((m * (2 * lmax + 1 - m) // 2) + m):(m * (2 * lmax + 1 - m) // 2 + lmax + 1)] \
                 = alm[(m * (2 * alm_lmax + 1 - m) // 2 + m):(m * (2 * alm_lmax + 1 - m) // 2 + lmax + 1)]
@@ -174,39 +174,145 @@ def hash_check(hash1, hash2, ignore=['lib_dir', 'prefix'], keychain=[]):
 class stats:
     """Simple minded library for means and covariances from sims.
 
+        Means and covariances are accumulated with numerically stable streaming updates (Welford / Chan et al.),
+        and two instances built from disjoint sets of samples can be merged (e.g. for a reduction across MPI ranks).
+
+        Args:
+            size: size of the data vector
+            xcoord(optional): data vector coordinates
+            docov: covariance to keep track of. *True* for the full matrix, *False* for none, 'diag' for the diagonal only,
+                   or a list of index arrays defining the diagonal blocks of a block-diagonal covariance
+
     """
 
     def __init__(self, size, xcoord=None, docov=True):
         self.N = 0  # number of samples
         self.size = size  # dim of data vector
-        self.sum = np.zeros(self.size)  # sum_i x_i
-        if docov: self.mom = np.zeros((self.size, self.size))  # sum_i x_ix_i^t
         self.xcoord = xcoord
         self.docov = docov
+        self._mean = np.zeros(self.size) # running mean
+        self._M2 = self._zeros_M2() # running sum_i (x_i - mean) (x_i - mean)^t, or its diagonal or diagonal blocks
+
+    def _blocks(self):
+        return self.docov if isinstance(self.docov, (list, tuple)) else None
+
+    def _zeros_M2(self):
+        if self._blocks() is not None:
+            return [np.zeros((len(b), len(b))) for b in self._blocks()]
+        if isinstance(self.docov, str):
+            assert self.docov == 'diag', self.docov
+            return np.zeros(self.size)
+        return np.zeros((self.size, self.size)) if self.docov else None
+
+    def _update_M2(self, a, b, w=1.):
+        """Adds w a^T b (or its relevant part) to the second moment, for (n, size) arrays a and b """
+        if self._M2 is None:
+            return
+        if self._blocks() is not None:
+            for M2, idc in zip(self._M2, self._blocks()):
+                M2 += w * np.dot(a[:, idc].T, b[:, idc])
+        elif isinstance(self.docov, str):
+            self._M2 += w * np.sum(a * b, axis=0)
+        else:
+            self._M2 += w * np.dot(a.T, b)
+
+    def __setstate__(self, state):
+        # instances pickled before the streaming updates stored raw sums and moments.
+        if 'sum' in state:
+            N = state['N']
+            mean = state.pop('sum') / max(N, 1)
+            mom = state.pop('mom', None)
+            state['_mean'] = mean
+            state['_M2'] = None if mom is None else mom - N * np.outer(mean, mean)
+        self.__dict__.update(state)
+
+    @property
+    def sum(self):
+        return self._mean * self.N
+
+    @property
+    def mom(self):
+        assert self.docov is True, 'full covariance only'
+        return self._M2 + self.N * np.outer(self._mean, self._mean)
 
     def add(self, v):
         assert (v.shape == (self.size,)), "input not understood"
-        self.sum += v
-        if self.docov:
-            self.mom += np.outer(v, v)
         self.N += 1
+        delta = v - self._mean
+        self._mean += delta / self.N
+        self._update_M2(delta[None, :], (v - self._mean)[None, :])
+
+    def add_many(self, V):
+        """Adds a set of samples at once.
+
+            Args:
+                V: (nsamples, size) array, one sample per row
+
+        """
+        V = np.atleast_2d(V)
+        assert V.shape[1] == self.size, "input not understood"
+        other = stats(self.size, xcoord=self.xcoord, docov=self.docov)
+        other.N = V.shape[0]
+        other._mean = np.mean(V, axis=0)
+        dV = V - other._mean
+        other._update_M2(dV, dV)
+        self.merge(other)
+
+    def merge(self, other):
+        """Adds to this instance the samples of another instance (of same size and covariance type).
+
+        """
+        assert other.size == self.size, (other.size, self.size)
+        assert (other._M2 is None) == (self._M2 is None), 'incompatible covariances'
+        if other.N == 0:
+            return self
+        N = self.N + other.N
+        delta = other._mean - self._mean
+        if self._M2 is not None:
+            if self._blocks() is not None:
+                for M2, oM2 in zip(self._M2, other._M2):
+                    M2 += oM2
+            else:
+                self._M2 += other._M2
+            self._update_M2(delta[None, :], delta[None, :], w=self.N * other.N / float(N))
+        self._mean += delta * (other.N / float(N))
+        self.N = N
+        return self
 
     def mean(self):
         assert (self.N > 0)
-        return self.sum / float(self.N)
+        return self._mean.copy()
 
     def avg(self):
         return self.mean()
 
+    def var(self):
+        """Diagonal of the covariance matrix """
+        assert self.docov
+        assert (self.N > 0)
+        if self.N == 1: return np.zeros(self.size)
+        if self._blocks() is not None:
+            ret = np.zeros(self.size)
+            for M2, idc in zip(self._M2, self._blocks()):
+                ret[idc] = np.diagonal(M2)
+            return ret / (self.N - 1.)
+        return (self._M2 if self._M2.ndim == 1 else np.diagonal(self._M2)) / (self.N - 1.)
+
     def cov(self):
         assert self.docov
         assert (self.N > 0)
         if self.N == 1: return np.zeros((self.size, self.size))
-        mean = self.mean()
-        return self.mom / (self.N - 1.) - self.N / (self.N - 1.) * np.outer(mean, mean)
+        if self._blocks() is not None:
+            ret = np.zeros((self.size, self.size))
+            for M2, idc in zip(self._M2, self._blocks()):
+                ret[np.ix_(idc, idc)] = M2
+            return ret / (self.N - 1.)
+        if self._M2.ndim == 1:
+            return np.diag(self._M2 / (self.N - 1.))
+        return self._M2 / (self.N - 1.)
 
     def sigmas(self):
-        return np.sqrt(np.diagonal(self.cov()))
+        return np.sqrt(self.var())
 
     def corrcoeffs(self):
         sigmas = self.sigmas()
@@ -239,24 +345,21 @@ class stats:
         assert np.all(np.diff(np.array(lmaxs)) > 0.), "This only for non overlapping bins."
         assert np.all(lmaxs - lmins) > 0., "This only for non overlapping bins."
 
+        assert self.docov is True, 'full covariance only'
         if weights is None: weights = np.ones(self.size)
         assert weights.size == self.size, "incompatible input"
         newsize = len(lmaxs)
         assert self.size > newsize, "Incompatible dimensions"
         Tmat = np.zeros((newsize, self.size))
-        newsum = np.zeros(newsize)
         for k, lmin, lmax in zip(np.arange(newsize), lmins, lmaxs):
             idc = np.where((orig_coord >= lmin) & (orig_coord <= lmax))
             if len(idc) > 0:
                 norm = np.sum(weights[idc])
                 Tmat[k, idc] = weights[idc] / norm
-                newsum[k] = np.sum(weights[idc] * self.sum[idc]) / norm
 
-        newmom = np.dot(np.dot(Tmat, self.mom), Tmat.transpose())  # New mom. matrix is T M T^T
         newstats = stats(newsize, xcoord=0.5 * (lmins[0:len(lmins) - 1] + lmaxs[1:]))
-
-        newstats.mom = newmom
-        newstats.sum = newsum
+        newstats._mean = np.dot(Tmat, self._mean)
+        newstats._M2 = np.dot(np.dot(Tmat, self._M2), Tmat.transpose())  # New mom. matrix is T M T^T
         newstats.N = self.N
         return newstats
 
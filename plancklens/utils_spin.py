@@ -15,6 +15,10 @@ r"""Module with spin-weight related utilities.
 
 """
 
+import os
+import hashlib
+from collections import OrderedDict
+
 import healpy as hp
 import numpy as np
 
@@ -41,7 +45,72 @@ except:
     print("could not load wigners.so fortran shared object")
     print('try f2py -c -m wigners wigners.f90 from the command line in wigners directory ?')
 
-GL_cache = {}
+class gl_cache:
+    """Least-recently-used cache of Gauss-Legendre quadrature nodes and weights on [-1, 1].
+
+        Args:
+            maxsize: maximal number of node sets kept in memory
+            cache_dir(optional): if set, node sets are also stored there as *.npy* files,
+                                 and loaded memory-mapped by other processes instead of being recomputed.
+                                 Defaults to the *PLENS_GL_CACHE* environment variable if defined.
+
+    """
+    def __init__(self, maxsize=32, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = os.environ.get('PLENS_GL_CACHE', None) if cache_dir is None else cache_dir
+        self._cache = OrderedDict()
+
+    def _fname(self, N):
+        return os.path.join(self.cache_dir, 'xgwg_%s.npy' % N)
+
+    def _load_or_build(self, N):
+        if self.cache_dir is None:
+            return np.array(wigners.get_xgwg(-1., 1., N))
+        fname = self._fname(N)
+        if not os.path.exists(fname):
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir, exist_ok=True)
+            # write then rename, so that concurrent processes never see a partial file
+            tmp = fname[:-4] + '_%s.tmp.npy' % os.getpid()
+            np.save(tmp, np.array(wigners.get_xgwg(-1., 1., N)))
+            os.replace(tmp, fname)
+        return np.load(fname, mmap_mode='r')
+
+    def get(self, N):
+        """Returns Gauss-Legendre nodes and weights with N points """
+        if N in self._cache:
+            self._cache.move_to_end(N)
+        else:
+            self._cache[N] = self._load_or_build(N)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        xgwg = self._cache[N]
+        return xgwg[0], xgwg[1]
+
+    def __contains__(self, N):
+        return N in self._cache
+
+    def __len__(self):
+        return len(self._cache)
+
+    def clear(self):
+        self._cache.clear()
+
+GL_cache = gl_cache()
+def _get_xgwg(N):
+    """Gauss-Legendre quadrature nodes and weights with N points """
+    return GL_cache.get(N)
+
+def _wignerpos(cl, xg, s1, s2):
+    if np.iscomplexobj(cl):
+        return wigners.wignerpos(np.real(cl), xg, s1, s2) + 1j * wigners.wignerpos(np.imag(cl), xg, s1, s2)
+    return wigners.wignerpos(cl, xg, s1, s2)
+
+def _wignercoeff(xi, xg, s1, s2, lmax):
+    if np.iscomplexobj(xi):
+        return wigners.wignercoeff(np.real(xi), xg, s1, s2, lmax) + 1j * wigners.wignercoeff(np.imag(xi), xg, s1, s2, lmax)
+    return wigners.wignercoeff(xi, xg, s1, s2, lmax)
+
 def wignerc(cl1, cl2, sp1, s1, sp2, s2, lmax_out=None):
     """Legendre coeff. of $ (\\xi_{sp1,s1} * \\xi_{sp2,s2})(\\cos \\theta)$ from their harmonic series.
 
@@ -57,30 +126,108 @@ def wignerc(cl1, cl2, sp1, s1, sp2, s2, lmax_out=None):
     so = s1 + s2
     if np.any(cl1) and np.any(cl2):
         N = (lmaxtot + 2 - lmaxtot % 2) // 2
-        if not 'xg wg %s' % N in GL_cache.keys():
-            GL_cache['xg wg %s' % N] = wigners.get_xgwg(-1., 1., N)
-        xg, wg = GL_cache['xg wg %s' % N]
-        if HASWIGNER:
-            if np.iscomplexobj(cl1):
-                xi1 = wigners.wignerpos(np.real(cl1), xg, sp1, s1) + 1j * wigners.wignerpos(np.imag(cl1), xg, sp1, s1)
-            else:
-                xi1 = wigners.wignerpos(cl1, xg, sp1, s1)
-            if np.iscomplexobj(cl2):
-                xi2 = wigners.wignerpos(np.real(cl2), xg, sp2, s2) + 1j * wigners.wignerpos(np.imag(cl2), xg, sp2, s2)
-            else:
-                xi2 = wigners.wignerpos(cl2, xg, sp2, s2)
-            xi1xi2w = xi1 * xi2 * wg
-            if np.iscomplexobj(xi1xi2w):
-                ret = wigners.wignercoeff(np.real(xi1xi2w), xg, spo, so, lmax_out)
-                ret = ret + 1j * wigners.wignercoeff(np.imag(xi1xi2w), xg, spo, so, lmax_out)
-                return ret
-            else:
-                return wigners.wignercoeff(xi1xi2w, xg, spo, so, lmax_out)
-        else:
-            assert 0
+        xg, wg = _get_xgwg(N)
+        xi1xi2w = _wignerpos(cl1, xg, sp1, s1) * _wignerpos(cl2, xg, sp2, s2) * wg
+        return _wignercoeff(xi1xi2w, xg, spo, so, lmax_out)
     else:
         return np.zeros(lmax_out + 1, dtype=float)
 
+def _spechash(cl):
+    return hashlib.sha1(np.ascontiguousarray(cl)).hexdigest() + cl.dtype.str
+
+def wignerc_grouped(jobs, lmax_out=None):
+    """Evaluates a list of *wignerc* calls, sharing the position-space transforms between them.
+
+        All jobs use the same quadrature nodes. Distinct (spectrum, spins) forward transforms are performed once,
+        in stacks of same spins, and the inverse transforms are stacked according to their output spins.
+
+        Args:
+            jobs: list of (cl1, cl2, sp1, s1, sp2, s2) tuples, with the same meaning as in *wignerc*
+            lmax_out(optional): common output multipole range. Defaults to lmax1 + lmax2 for each job
+
+        Returns:
+            list of *wignerc* outputs, in the same order as *jobs*
+
+    """
+    assert HASWIGNER
+    ret = [None] * len(jobs)
+    lmaxs_out = [len(cl1) + len(cl2) - 2 if lmax_out is None else lmax_out for (cl1, cl2, _, _, _, _) in jobs]
+    live = []
+    for i, job in enumerate(jobs):
+        if np.any(job[0]) and np.any(job[1]):
+            live.append(i)
+        else:
+            ret[i] = np.zeros(lmaxs_out[i] + 1, dtype=float)
+    if len(live) == 0:
+        return ret
+    lmaxtot = max([len(jobs[i][0]) + len(jobs[i][1]) - 2 + lmaxs_out[i] for i in live])
+    N = (lmaxtot + 2 - lmaxtot % 2) // 2
+    xg, wg = _get_xgwg(N)
+
+    # distinct forward transforms, stacked by spins, length and type (real spectra are not promoted to complex)
+    fwd = {}  # (spectrum hash, spins) -> (group, row)
+    fwd_groups = {}
+    legs = []
+    for i in live:
+        cl1, cl2, sp1, s1, sp2, s2 = jobs[i]
+        keys = []
+        for cl, sp, s in [(cl1, sp1, s1), (cl2, sp2, s2)]:
+            key = (_spechash(cl), sp, s)
+            if key not in fwd:
+                gkey = (sp, s, len(cl), np.iscomplexobj(cl))
+                group = fwd_groups.setdefault(gkey, [])
+                fwd[key] = (gkey, len(group))
+                group.append(cl)
+            keys.append(fwd[key])
+        legs.append(keys)
+    xis = {gkey: _wignerpos_many(np.array(cls), xg, gkey[0], gkey[1]) for gkey, cls in fwd_groups.items()}
+
+    # products, and inverse transforms stacked by output spins
+    bwd = {}  # job key -> (group, row)
+    bwd_groups = {}
+    outs = []
+    for i, ((g1, r1), (g2, r2)) in zip(live, legs):
+        _, _, sp1, s1, sp2, s2 = jobs[i]
+        key = (g1, r1, g2, r2, lmaxs_out[i])
+        if key not in bwd:
+            gkey = (sp1 + sp2, s1 + s2, lmaxs_out[i], g1[3] or g2[3])
+            group = bwd_groups.setdefault(gkey, [])
+            bwd[key] = (gkey, len(group))
+            group.append(xis[g1][r1] * xis[g2][r2] * wg)
+        outs.append(bwd[key])
+    cls = {gkey: _wignercoeff_many(np.array(xi12s), xg, gkey[0], gkey[1], gkey[2]) for gkey, xi12s in bwd_groups.items()}
+    for i, (g, r) in zip(live, outs):
+        ret[i] = cls[g][r]
+    return ret
+
+def _wignerpos_many(cls, xg, s1, s2):
+    """Position-space functions of a stack of (n, lmax + 1) spectra with shared spins and nodes, as (n, len(xg)) array
+
+        Complex spectra have their real and imaginary parts sent to the same Fortran call.
+
+    """
+    cls = np.atleast_2d(cls)
+    if not hasattr(wigners, 'wignerpos_many'):  # older shared object
+        return np.array([_wignerpos(cl, xg, s1, s2) for cl in cls])
+    if np.iscomplexobj(cls):
+        n = cls.shape[0]
+        xis = wigners.wignerpos_many(np.concatenate([cls.real, cls.imag]), xg, s1, s2)
+        return xis[:n] + 1j * xis[n:]
+    return wigners.wignerpos_many(cls, xg, s1, s2)
+
+def _wignercoeff_many(xis, xg, s1, s2, lmax):
+    """Harmonic coefficients of a stack of (n, len(xg)) position-space functions with shared spins and nodes
+
+    """
+    xis = np.atleast_2d(xis)
+    if not hasattr(wigners, 'wignercoeff_many'):  # older shared object
+        return np.array([_wignercoeff(xi, xg, s1, s2, lmax) for xi in xis])
+    if np.iscomplexobj(xis):
+        n = xis.shape[0]
+        cls = wigners.wignercoeff_many(np.concatenate([xis.real, xis.imag]), xg, s1, s2, lmax)
+        return cls[:n] + 1j * cls[n:]
+    return wigners.wignercoeff_many(xis, xg, s1, s2, lmax)
+
 
 def get_spin_raise(s, lmax):
     r"""Response coefficient of spin-s spherical harmonic to spin raising operator.
@@ -544,6 +544,117 @@ module poly
             end if
         end subroutine pos2pol_omp_zsym
 
+        subroutine pol2pos_many_omp(xi, nx, lmax, ncl, x, an, bn, cn, cl, p0, zsym)
+            ! Same as pol2pos_omp(_zsym) for a stack of ncl spectra, sharing the polynomials evaluation
+            ! If zsym, assumes x(i) = -x(N-i) and Pl(-x) = (-1)^l Pl(x) and fills half of the array
+            implicit none
+            integer, intent(in) :: nx, lmax, ncl
+            double precision, intent(in) :: x(nx)
+            double precision, intent(in) :: an(0:lmax-1), bn(0:lmax-1), cn(0:lmax-1), cl(ncl, 0:lmax)
+            double precision, intent(out) :: xi(ncl, nx)
+            logical, intent(in) :: zsym
+            double precision :: pl, plp1, plm1, p0, txi_p(ncl), txi_m(ncl)
+            integer :: l, ix, nxh
+
+            if (lmax == 0) then
+                do ix = 1, nx
+                    xi(:, ix) = cl(:, 0) * p0
+                end do
+                return
+            end if
+            nxh = nx
+            if (zsym) then
+                nxh = nx / 2 + MOD(nx, 2)
+            end if
+        !$OMP PARALLEL DO DEFAULT(NONE) PRIVATE(ix, txi_p, txi_m, plm1, pl, plp1, l) &
+        !$OMP& SHARED(xi, x, nx, nxh, lmax, an, bn, cn, cl, p0, zsym)
+            do ix = 1, nxh
+                pl = p0
+                plp1 = (an(0) * x(ix) + bn(0)) * pl
+                txi_p = cl(:, 0) * pl   ! collects even multipoles only
+                txi_m = cl(:, 1) * plp1 ! collects odd mutipoles only
+                do l = 1, lmax - 1
+                    plm1 = pl
+                    pl = plp1
+                    plp1 = (an(l) * x(ix) + bn(l)) * pl - cn(l) * plm1
+                    if ( BTEST(l, 0) ) then
+                        txi_p = txi_p + plp1 * cl(:, l + 1)
+                    else
+                        txi_m = txi_m + plp1 * cl(:, l + 1)
+                    end if
+                end do
+                if (zsym) then
+                    xi(:, nx - (ix - 1)) = txi_p - txi_m
+                end if
+                xi(:, ix) = txi_p + txi_m
+            end do
+        !$OMP END PARALLEL DO
+        end subroutine pol2pos_many_omp
+
+        subroutine pos2pol_many_omp(xi, nx, lmax, ncl, x, an, bn, cn, cl, p0, kmax, zsym)
+            ! Same as pos2pol_omp(_zsym) for a stack of ncl position-space functions, sharing the polynomials evaluation
+            implicit none
+            integer, intent(in) :: nx, lmax, kmax, ncl
+            double precision, intent(in) :: x(nx)
+            double precision, intent(in) :: an(0:kmax-1), bn(0:kmax-1), cn(0:kmax-1), xi(ncl, nx), p0(nx)
+            double precision, intent(out) :: cl(ncl, 0:lmax)
+            logical, intent(in) :: zsym
+            double precision :: pl, plp1, plm1, xs(ncl), xd(ncl)
+            double precision, allocatable :: cl_priv(:, :)
+            integer :: k, lmin, ix, nxh
+            if (kmax > lmax) then
+                write(*, *) 'incompatible Wigner and Jacobi limits'
+                error stop
+            end if
+
+            cl = 0.d0
+            lmin = lmax - kmax
+            do ix = 1, nx
+                cl(:, lmin) = cl(:, lmin) + xi(:, ix) * p0(ix)
+            end do
+            if (lmax == lmin) then
+                return
+            end if
+            nxh = nx
+            if (zsym) then
+                nxh = nx / 2 + MOD(nx, 2)
+            end if
+        !$OMP PARALLEL DEFAULT(NONE) PRIVATE(k, ix, plm1, pl, plp1, xs, xd, cl_priv) &
+        !$OMP& SHARED(lmin, x, xi, nx, nxh, ncl, kmax, p0, an, bn, cn, cl, zsym)
+            allocate(cl_priv(ncl, 0:kmax - 1))
+            cl_priv = 0.d0
+        !$OMP DO
+            do ix = 1, nxh
+                ! even (resp. odd) polynomials see the symmetric (resp. antisymmetric) part of xi
+                if (zsym .and. (ix /= nx - (ix - 1))) then
+                    xs = xi(:, ix) + xi(:, nx - (ix - 1))
+                    xd = xi(:, ix) - xi(:, nx - (ix - 1))
+                else
+                    xs = xi(:, ix)
+                    xd = xi(:, ix)
+                end if
+                pl = p0(ix)
+                plp1 = (an(0) * x(ix) + bn(0)) * pl
+                cl_priv(:, 0) = cl_priv(:, 0) + plp1 * xd
+                do k = 1, kmax - 1
+                    plm1 = pl
+                    pl = plp1
+                    plp1 = (an(k) * x(ix) + bn(k)) * pl - cn(k) * plm1
+                    if ( BTEST(k, 0) ) then
+                        cl_priv(:, k) = cl_priv(:, k) + plp1 * xs
+                    else
+                        cl_priv(:, k) = cl_priv(:, k) + plp1 * xd
+                    end if
+                end do
+            end do
+        !$OMP END DO
+        !$OMP CRITICAL
+            cl(:, lmin + 1:) = cl(:, lmin + 1:) + cl_priv
+        !$OMP END CRITICAL
+            deallocate(cl_priv)
+        !$OMP END PARALLEL
+        end subroutine pos2pol_many_omp
+
 end module poly
 
 
@@ -665,4 +776,108 @@ subroutine wignercoeff(cl, xi, x, s1, s2, lmax, nx)
     else
         call pos2pol_omp(xi, nx, lmax, x, an, bn, cn, cl, p0, lmax-lmin)
     end if
-end subroutine wignercoeff
\ No newline at end of file
+end subroutine wignercoeff
+
+
+subroutine wignerpos_many(xi, nx, lmax, ncl, cl, x, s1, s2)
+    ! Same as wignerpos for a stack of ncl spectra with same spins and grid, with output xi(ncl, nx)
+    use gridutils, only: symgrid
+    use jacobi, only:anbncn_jacobi, rescal_jacobi
+    use poly, only: rescal_coeff, pol2pos_many_omp
+    implicit None
+    integer, intent(in) :: s1, s2, nx, lmax, ncl
+    double precision, intent(in) :: x(nx), cl(ncl, 0:lmax)
+    double precision, intent(out) :: xi(ncl, nx)
+    double precision rn(0:lmax-max(abs(s1), abs(s2)))
+    double precision an(0:lmax-max(abs(s1), abs(s2)) - 1)
+    double precision bn(0:lmax-max(abs(s1), abs(s2)) - 1)
+    double precision cn(0:lmax-max(abs(s1), abs(s2)) - 1)
+    double precision a, b, p0, fx(nx), clm(ncl, 0:lmax - max(abs(s1), abs(s2)))
+    double precision, parameter :: PI4_i = 0.07957747154594767d0
+    integer lmin, l, ix
+    logical zsym
+
+    lmin = max(abs(s1), abs(s2))
+    if (lmin > lmax) then
+        xi = 0.d0
+        return
+    end if
+    a = abs(s1 - s2)
+    b = abs(s1 + s2)
+    zsym = (a == b) .and. (symgrid(x, nx))
+    do l = lmin, lmax ! cl to pass against the Jacobi polynomials
+        clm(:, l-lmin) = cl(:, l) * (2 * l + 1) * PI4_i !  cl (2l + 1) / 4pi
+    end do
+    p0 = 1.d0
+    call anbncn_jacobi(a, b, lmax-lmin, an, bn, cn) ! Jacobi 3-terms recursion coefficients
+    if (lmin > 0) then !at least one spin non-zero, we must rescale
+        call rescal_jacobi(s1, s2, lmax, rn)
+        if (lmax > lmin) then
+            call rescal_coeff(lmax-lmin, an, bn, cn, rn)
+        end if
+        p0 = p0 * rn(0)
+    end if
+    call pol2pos_many_omp(xi, nx, lmax-lmin, ncl, x, an, bn, cn, clm, p0, zsym)
+    fx = 1.d0
+    if (a > 0) then
+        fx = fx * (0.5 * (1 - x) ) ** (a * 0.5d0)  ! sin(x/2) ** a/2
+    end if
+    if (b > 0) then
+        fx = fx * (0.5 * (1 + x) ) ** (b * 0.5d0)  ! cos(x/2) ** b/2
+    end if
+    if ( (s1 > s2) .AND. (BTEST(s1-s2, 0))) then
+        fx = -fx
+    end if
+    do ix = 1, nx
+        xi(:, ix) = xi(:, ix) * fx(ix)
+    end do
+end subroutine wignerpos_many
+
+subroutine wignercoeff_many(cl, xi, x, s1, s2, lmax, nx, ncl)
+    ! Same as wignercoeff for a stack of ncl position-space functions xi(ncl, nx) with same spins and grid
+    use gridutils, only : symgrid
+    use jacobi, only:anbncn_jacobi, rescal_jacobi
+    use poly, only: pos2pol_many_omp, rescal_coeff
+    implicit None
+    integer, intent(in) :: s1, s2, nx, lmax, ncl
+    double precision, intent(in) :: x(nx), xi(ncl, nx)
+    double precision, intent(out) :: cl(ncl, 0:lmax)
+    double precision rn(0:lmax-max(abs(s1), abs(s2)))
+    double precision an(0:lmax-max(abs(s1), abs(s2)) - 1)
+    double precision bn(0:lmax-max(abs(s1), abs(s2)) - 1)
+    double precision cn(0:lmax-max(abs(s1), abs(s2)) - 1)
+    double precision p0(nx)
+    double precision a, b
+    double precision, parameter :: PI2 = 6.283185307179586d0
+    integer lmin
+    logical zsym
+
+    lmin = max(abs(s1), abs(s2))
+    if (lmin > lmax) then
+        cl = 0.d0
+        return
+    end if
+    a = abs(s1 - s2)
+    b = abs(s1 + s2)
+    zsym = (a == b) .and. (symgrid(x, nx))
+    call anbncn_jacobi(a, b, lmax-lmin, an, bn, cn)
+    if ( (s1 > s2) .AND. (mod(s1-s2, 2) == 1) ) then
+        p0 = -PI2
+    else
+        p0 = PI2
+    end if
+    if (a > 0) then
+        p0 = p0 * (0.5 * (1 - x) ) ** (a * 0.5d0)  ! sin(x/2) ** a/2
+    end if
+    if (b > 0) then
+        p0 = p0 * (0.5 * (1 + x) ) ** (b * 0.5d0)  ! cos(x/2) ** b/2
+    end if
+    if (lmin > 0) then !at least one spin non-zero. We need to rescal Jacobi polynomials
+        call rescal_jacobi(s1, s2, lmax, rn)
+        p0 = p0 * rn(0)
+        if (lmax > lmin) then
+            call rescal_coeff(lmax-lmin, an, bn, cn, rn)
+        end if
+    end if
+    call pos2pol_many_omp(xi, nx, lmax, ncl, x, an, bn, cn, cl, p0, lmax-lmin, zsym)
+end subroutine wignercoeff_many
@@ -0,0 +1,90 @@
+from __future__ import print_function
+
+import numpy as np
+
+from plancklens import utils, bandpowers
+
+
+class _cls_fixed:
+    """Deterministic QE spectra library stand-in (also used for the semi-analytical N0s)
+
+    """
+    def __init__(self, lmax, seed):
+        self.lmax = lmax
+        self.seed = seed
+        self.mc_sims_mf = np.arange(10)
+
+    def get_sim_qcl(self, k1, idx, k2=None, lmax=None):
+        rng = np.random.default_rng((self.seed, idx + 100))
+        return (1. + 0.1 * rng.standard_normal(self.lmax + 1)) * 1e-7 / (np.arange(self.lmax + 1) + 10.) ** 2
+
+    def get_sim_nhl(self, idx, k1, k2):
+        return 0.9 * self.get_sim_qcl(k1, idx, k2=k2)
+
+    def get_sim_stats_qcl(self, k1, mc_sims, k2=None):
+        ret = utils.stats(self.lmax + 1, docov=False)
+        for idx in mc_sims:
+            ret.add(self.get_sim_qcl(k1, idx, k2=k2))
+        return ret
+
+
+class _qresp_fixed:
+    def __init__(self, lmax):
+        self.lmax = lmax
+
+    def get_response(self, k, ksource):
+        return 1e3 / (np.arange(self.lmax + 1) + 10.) ** 0.5
+
+
+class _parfile:
+    def __init__(self, lmax=2500):
+        self.qresp_dd = _qresp_fixed(lmax)
+        self.qcls_dd = _cls_fixed(lmax, 0)
+        self.qcls_ds = _cls_fixed(lmax, 1)
+        self.qcls_ss = _cls_fixed(lmax, 2)
+        self.nhl_dd = _cls_fixed(lmax, 0)
+        self.mc_sims_var = np.arange(20, 40)
+
+
+def test_bin_many():
+    for btype in ['consext8', 'agr2', '1_10_unb']:
+        binner = bandpowers.ffp10_binner('ptt', 'ptt', _parfile(), btype)
+        cls_2d = np.random.default_rng(0).standard_normal((5, 2500))
+        rets = binner.bin_many(cls_2d)
+        assert rets.shape == (5, binner.nbins)
+        for cl, ret in zip(cls_2d, rets):
+            # per-bin sums of the bin window functions
+            ref = np.zeros(binner.nbins)
+            for i, (lmin, lmax) in enumerate(zip(binner.bin_lmins, binner.bin_lmaxs)):
+                ref[i] = np.sum(binner._get_bil(i, np.arange(lmin, lmax + 1)) * cl[lmin:lmax + 1])
+            assert np.allclose(ret, ref, rtol=1e-12, atol=1e-12 * np.max(np.abs(ref))), btype
+            assert np.allclose(binner._get_binnedcl(cl), ref, rtol=1e-12, atol=1e-12 * np.max(np.abs(ref))), btype
+
+def test_stacks():
+    binner = bandpowers.ffp10_binner('ptt', 'ptt', _parfile(), 'agr2')
+    binner_st = bandpowers.ffp10_binner('ptt', 'ptt', _parfile(), 'agr2', stacks=True)
+    for get in ['get_mcn0', 'get_rdn0', 'get_mcn0_cov', 'get_nhl_cov']:
+        ret, ret_st = getattr(binner, get)(), getattr(binner_st, get)()
+        assert np.allclose(ret, ret_st, rtol=1e-10, atol=1e-10 * np.max(np.abs(ret))), get
+    for ret, ret_st in zip(binner.get_bamc(wn1=False), binner_st.get_bamc(wn1=False)):
+        assert np.allclose(ret, ret_st, rtol=1e-10, atol=1e-10 * np.max(np.abs(ret)))
+    assert np.allclose(binner.get_bmmc(wN1=False), binner_st.get_bmmc(wN1=False), rtol=1e-10)
+
+def test_stacks_mpi(monkeypatch):
+    from plancklens.helpers import mpi
+    ref = bandpowers.ffp10_binner('ptt', 'ptt', _parfile(), 'agr2')
+    # two ranks, run one after the other: rank 1 records its statistics, that rank 0 then merges
+    monkeypatch.setattr(mpi, 'size', 2)
+    monkeypatch.setattr(mpi, 'rank', 1)
+    gathered = []
+    monkeypatch.setattr(mpi, 'allgather', lambda obj: gathered.append(obj) or [obj])
+    binner = bandpowers.ffp10_binner('ptt', 'ptt', _parfile(), 'agr2', stacks=True)
+    binner.get_rdn0(), binner.get_nhl_cov()
+    assert len(binner._get_stack('dd', ref.parfile.mc_sims_var)) == 10
+    parts = iter(gathered)
+    monkeypatch.setattr(mpi, 'rank', 0)
+    monkeypatch.setattr(mpi, 'allgather', lambda obj: [obj, next(parts)])
+    binner = bandpowers.ffp10_binner('ptt', 'ptt', _parfile(), 'agr2', stacks=True)
+    for get in ['get_rdn0', 'get_nhl_cov']:
+        ret, ret_st = getattr(ref, get)(), getattr(binner, get)()
+        assert np.allclose(ret, ret_st, rtol=1e-10, atol=1e-10 * np.max(np.abs(ret))), get
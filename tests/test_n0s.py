@@ -0,0 +1,54 @@
+from __future__ import print_function
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+import plancklens
+from plancklens import n0s, utils
+
+
+def test_N0_grid():
+    beams, nlevs_t, nlevs_p = [1., 5.], [2., 20.], [5., 30.]
+    kwargs = {'lmax_CMB': {'t': 120, 'e': 150, 'b': 100}, 'lmin_CMB': 10, 'lmax_out': 100}
+    N0s, N0_curls = n0s.get_N0_grid(beams, nlevs_t, nlevs_p, chunk_size=3, **kwargs)
+    N0s_sep, N0_curls_sep = n0s.get_N0_grid(beams, nlevs_t, nlevs_p, joint_TP=False, **kwargs)
+    with ThreadPoolExecutor(2) as executor:
+        N0s_ex, N0_curls_ex = n0s.get_N0_grid(beams, nlevs_t, nlevs_p, executor=executor, **kwargs)
+    for i, beam in enumerate(beams):
+        for j, (nlev_t, nlev_p) in enumerate(zip(nlevs_t, nlevs_p)):
+            refs = n0s.get_N0(beam, nlev_t, nlev_p, **kwargs)
+            refs_sep = n0s.get_N0(beam, nlev_t, nlev_p, joint_TP=False, **kwargs)
+            for rets, refs in [((N0s, N0_curls), refs), ((N0s_ex, N0_curls_ex), refs), ((N0s_sep, N0_curls_sep), refs_sep)]:
+                for ret, ref in zip(rets, refs):
+                    assert ret.keys() == ref.keys()
+                    for k in ref.keys():
+                        assert ret[k].shape == (len(beams), len(nlevs_t), kwargs['lmax_out'] + 1)
+                        assert np.allclose(ret[k][i, j], ref[k], rtol=1e-10), (k, beam, nlev_t)
+
+def _get_cls():
+    cls_path = os.path.join(os.path.dirname(os.path.abspath(plancklens.__file__)), 'data', 'cls')
+    cls_unl = utils.camb_clfile(os.path.join(cls_path, 'FFP10_wdipole_lenspotentialCls.dat'))
+    cls_len = utils.camb_clfile(os.path.join(cls_path, 'FFP10_wdipole_lensedCls.dat'))
+    return cls_unl, cls_len
+
+def test_lensed_cls_fullsky():
+    cls_unl, cls_len = _get_cls()
+    lmax, lmax_out = 4000, 2000
+    dls_unl, cldd = n0s.cls2dls({k: cls_unl[k][:lmax + 1] for k in ['tt', 'ee', 'bb', 'te', 'pp']})
+    ret = n0s.dls2cls(n0s.lensed_cls_fullsky(dls_unl, cldd, lmax_out=lmax_out))
+    sli = slice(2, lmax_out + 1)
+    for k, rtol in [('tt', 1e-3), ('ee', 1e-3), ('bb', 1e-2)]:
+        assert np.max(np.abs(ret[k][sli] / cls_len[k][sli] - 1.)) < rtol, k
+    assert np.max(np.abs(ret['te'][sli] - cls_len['te'][sli]) / np.sqrt(cls_len['tt'][sli] * cls_len['ee'][sli])) < 5e-4
+
+def test_lensed_cls_memo():
+    cls_unl, cls_len = _get_cls()
+    dls_unl, cldd = n0s.cls2dls({k: cls_unl[k][:301] for k in ['tt', 'ee', 'bb', 'te', 'pp']})
+    ret = n0s._get_lensed_cls(dls_unl, cldd, kernel='fullsky')
+    ref = {k: cl.copy() for k, cl in ret.items()}
+    for cl in ret.values():  # callers modifying the result in place do not affect the memoized spectra
+        cl *= 0.
+    ret2 = n0s._get_lensed_cls(dls_unl, cldd, kernel='fullsky')
+    for k in ref.keys():
+        assert np.array_equal(ret2[k], ref[k]) and ret2[k] is not ret[k], k
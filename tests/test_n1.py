@@ -0,0 +1,87 @@
+from __future__ import print_function
+
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+from scipy.interpolate import UnivariateSpline as spline
+
+import plancklens
+from plancklens import utils
+from plancklens.n1 import n1
+
+requires_n1f = pytest.mark.skipif(not n1.HASN1F, reason='n1f fortran module not built')
+
+
+def _get_lib_fals(lmax_ivf=300, nlev=35.):
+    cls_path = os.path.join(os.path.dirname(os.path.abspath(plancklens.__file__)), 'data', 'cls')
+    cls_len = utils.camb_clfile(os.path.join(cls_path, 'FFP10_wdipole_lensedCls.dat'))
+    cpp = utils.camb_clfile(os.path.join(cls_path, 'FFP10_wdipole_lenspotentialCls.dat'))['pp']
+    lps = np.concatenate([[1], np.arange(2, 113, 10), np.arange(142, 401, 30)])  # small lmaxphi
+    lib = n1.library_n1(tempfile.mkdtemp(), cls_len['tt'][:lmax_ivf + 1], cls_len['te'][:lmax_ivf + 1], cls_len['ee'][:lmax_ivf + 1],
+                        dL=20, lps=lps)
+    nl = (nlev / 60. / 180. * np.pi) ** 2
+    fals = {'tt': utils.cli(cls_len['tt'][:lmax_ivf + 1] + nl),
+            'ee': utils.cli(cls_len['ee'][:lmax_ivf + 1] + 2 * nl),
+            'bb': utils.cli(cls_len['bb'][:lmax_ivf + 1] + 2 * nl)}
+    for fal in fals.values():
+        fal[:10] *= 0.
+    return lib, cpp[:lib.lmaxphi + 1], fals
+
+@requires_n1f
+def test_n1_executor():
+    lib, cpp, fals = _get_lib_fals()
+    lib_ex = n1.library_n1(tempfile.mkdtemp(), lib.cltt, lib.clte, lib.clee, dL=lib.dL, lps=lib.lps)
+    with ThreadPoolExecutor(2) as executor:
+        for k in ['ptt', 'p_p']:
+            ref = lib.get_n1(k, 'p', cpp, fals['tt'], fals['ee'], fals['bb'], 100)
+            ret = lib_ex.get_n1(k, 'p', cpp, fals['tt'], fals['ee'], fals['bb'], 100, executor=executor)
+            assert np.allclose(ret, ref, rtol=1e-12), k
+    assert lib_ex.nevals == lib.nevals > 0
+
+@requires_n1f
+def test_n1_jtp():
+    lib, cpp, fals = _get_lib_fals()
+    fal_jtp = {'tt': fals['tt'], 'te': 0.1 * np.sqrt(fals['tt'] * fals['ee']), 'ee': fals['ee'], 'bb': fals['bb']}
+    lib_ex = n1.library_n1(tempfile.mkdtemp(), lib.cltt, lib.clte, lib.clee, dL=lib.dL, lps=lib.lps)
+    with ThreadPoolExecutor(2) as executor:
+        for k in ['ptt', 'pte']:  # second key pair shares some of the terms of the first
+            ret = lib.get_n1_jtp(k, 'p', cpp, fal_jtp, 100)
+            ret_ex = lib_ex.get_n1_jtp(k, 'p', cpp, fal_jtp, 100, executor=executor)
+            ref = lib.get_n1_jtp(k, 'p', cpp, fal_jtp, 100)  # all terms from the database
+            assert np.allclose(ret, ref, rtol=1e-12), k
+            assert np.allclose(ret_ex, ref, rtol=1e-12), k
+
+def test_sample_adaptive():
+    f = lambda L: L ** 2 * np.exp(-L / 150.) * (1. + 0.3 * np.sin(L / 40.))
+    n1_flat = lambda ell: np.ones(len(ell), dtype=float)
+    for Lmax in [2, 3, 1000]:
+        nsamples = []
+        for rtol in [1e-2, 1e-3, 1e-4]:
+            calls = []
+            get_n1s = lambda Ls: (calls.extend(Ls), f(np.asarray(Ls, dtype=float)))[1]
+            Ls, n1L = n1._sample_adaptive(get_n1s, Lmax, rtol, n1_flat)
+            assert len(calls) == len(set(calls)) == len(Ls)  # each multipole evaluated once
+            assert len(Ls) >= 4 and (Lmax < 100 or len(Ls) < Lmax // 10)
+            ells = np.arange(1, Lmax + 1) * 1.
+            err = np.max(np.abs(spline(Ls, n1L, s=0., k=3)(ells) - f(ells)))
+            assert err <= rtol * np.max(np.abs(f(ells))), (Lmax, rtol)
+            nsamples.append(len(Ls))
+        assert Lmax < 100 or nsamples[0] < nsamples[1] < nsamples[2]
+
+@requires_n1f
+def test_n1_adaptive():
+    lib, cpp, fals = _get_lib_fals()
+    fal = (fals['tt'], fals['ee'], fals['bb'])
+    lib_ref = n1.library_n1(tempfile.mkdtemp(), lib.cltt, lib.clte, lib.clee, dL=lib.dL, lps=lib.lps)
+    for Lmax in [3, 100]:
+        ret = lib.get_n1('ptt', 'p', cpp, *fal, Lmax, adaptive_rtol=1e-3)
+        ref = np.array([lib_ref._get_n1_L(L, 'ptt', 'ptt', 'p', cpp, *(fal * 2), lib.cltt, lib.clte, lib.clee) for L in range(1, Lmax + 1)])
+        # (the interpolation accuracy is tested above, the integrals themselves are noisy at the percent level at this dL)
+        assert np.max(np.abs(ret[1:] - ref)) <= 5e-2 * np.max(np.abs(ref)), Lmax
+    assert lib.nevals < 100 // 2
+    idxs = [lib._get_n1_L_args(L, 'ptt', 'ptt', 'p', cpp, *(fal * 2), lib.cltt, lib.clte, lib.clee)[0] for L in range(1, 101)]
+    assert np.sum([n1L is not None for n1L in lib.fldb.get_many(idxs)]) > 10
+    assert not np.any(lib.get_n1('ptt', 'p', cpp, *fal, 100, remove_only=True, adaptive_rtol=1e-3))
+    assert all(n1L is None for n1L in lib.fldb.get_many(idxs))
@@ -0,0 +1,59 @@
+from __future__ import print_function
+
+import os
+import tempfile
+import numpy as np
+import healpy as hp
+
+import plancklens
+from plancklens import utils, nhl
+
+
+class _ivfs_fixed:
+    """Deterministic inverse-variance filtered maps library stand-in
+
+    """
+    def __init__(self, lmax, fsky=0.5):
+        self.lmax = lmax
+        self.fsky = fsky
+
+    def hashdict(self):
+        return {'lmax': self.lmax, 'fsky': self.fsky}
+
+    def get_fmask(self):
+        return np.arange(12 * 4 ** 2) < self.fsky * 12 * 4 ** 2
+
+    def _get_alm(self, idx, idf):
+        rng = np.random.default_rng((idf, idx + 100))
+        alm = rng.standard_normal(hp.Alm.getsize(self.lmax)) + 1j * rng.standard_normal(hp.Alm.getsize(self.lmax))
+        alm[:self.lmax + 1] = alm[:self.lmax + 1].real
+        return hp.almxfl(alm, 1. / (np.arange(self.lmax + 1) + 10.))
+
+    def get_sim_tlm(self, idx):
+        return self._get_alm(idx, 0)
+
+    def get_sim_elm(self, idx):
+        return self._get_alm(idx, 1)
+
+    def get_sim_blm(self, idx):
+        return self._get_alm(idx, 2)
+
+
+def test_get_sim_nhls():
+    cls_path = os.path.join(os.path.dirname(os.path.abspath(plancklens.__file__)), 'data', 'cls')
+    cls_len = utils.camb_clfile(os.path.join(cls_path, 'FFP10_wdipole_lensedCls.dat'))
+    lmax_ivf, lmax_qlm = 60, 50
+    cls_weight = {k: cls_len[k][:lmax_ivf + 101] for k in ['tt', 'te', 'ee', 'bb']}
+    ivfs = _ivfs_fixed(lmax_ivf)
+    lib = nhl.nhl_lib_simple(tempfile.mkdtemp(), ivfs, cls_weight, lmax_qlm)
+    lib_ref = nhl.nhl_lib_simple(tempfile.mkdtemp(), ivfs, cls_weight, lmax_qlm)
+    assert lib.npdb.codec == 'raw'
+    idxs = [-1, 0, 3, 1]
+    for k1, k2 in [('ptt', 'ptt'), ('p_p', 'p_p'), ('p', 'p'), ('ptt', 'p_p')]:
+        lib.get_sim_nhl(3, k1, k2)  # one of them already cached
+        rets = lib.get_sim_nhls(idxs, k1, k2)
+        assert rets.shape == (len(idxs), lmax_qlm + 1)
+        for idx, ret in zip(idxs, rets):
+            ref = lib_ref.get_sim_nhl(idx, k1, k2)
+            assert np.allclose(ret, ref, rtol=1e-10, atol=1e-10 * np.max(np.abs(ref))), (k1, k2, idx)
+        assert np.array_equal(lib.get_sim_nhls(idxs, k1, k2), rets)
@@ -0,0 +1,75 @@
+from __future__ import print_function
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import healpy as hp
+
+import plancklens
+from plancklens import utils, qresp, nhl
+from plancklens.helpers import cachers
+from plancklens.patchy import patchy
+
+
+def _get_cls(lmax):
+    cls_path = os.path.join(os.path.dirname(os.path.abspath(plancklens.__file__)), 'data', 'cls')
+    cls_len = utils.camb_clfile(os.path.join(cls_path, 'FFP10_wdipole_lensedCls.dat'))
+    return {k: cls_len[k][:lmax + 1] for k in ['tt', 'te', 'ee', 'bb']}
+
+def test_get_responses_nhls():
+    lmin, lmax, lmax_qlm = 10, 80, 60
+    cls = _get_cls(lmax)
+    transf = hp.gauss_beam(5. / 180. / 60. * np.pi, lmax=lmax)
+    nlevts_f = [10., 20., 10., 35., 50.]  # one duplicate
+    nlevps_f = [15., 30., 15., 50., 70.]
+    nlevts_m = [12., 20., 10., 30., 55.]
+    nlevps_m = [20., 30., 15., 45., 80.]
+    for qe_key, joint_TP in [('ptt', False), ('p_p', False), ('p', True)]:
+        resps_ref = []
+        nhls_ref = []
+        for nlevt_f, nlevp_f, nlevt_m, nlevp_m in zip(nlevts_f, nlevps_f, nlevts_m, nlevps_m):
+            fal = patchy.get_ivf_cls(cls, cls, lmin, lmax, nlevt_f, nlevp_f, nlevt_f, nlevp_f, transf, jt_tp=joint_TP)[1]
+            resps_ref.append(qresp.get_response(qe_key, lmax, 'p', cls, cls, fal, lmax_qlm=lmax_qlm))
+            ivf_cls = patchy.get_ivf_cls(cls, cls, lmin, lmax, nlevt_f, nlevp_f, nlevt_m, nlevp_m, transf, jt_tp=joint_TP)[0]
+            nhls_ref.append(nhl.get_nhl(qe_key, qe_key, cls, ivf_cls, lmax, lmax, lmax_out=lmax_qlm))
+        cacher = cachers.cacher_mem()
+        with ThreadPoolExecutor(2) as executor:
+            # chunked, through an executor, over the MPI ranks, then from the cache
+            for this_cacher, kwargs in [(cacher, {'chunk_size': 2}), (cachers.cacher_mem(), {'executor': executor}),
+                                        (cachers.cacher_mem(), {'use_mpi': True}), (cacher, {})]:
+                resps = patchy.get_responses(qe_key, cls, cls, cls, lmin, lmax, lmax_qlm, transf, nlevts_f, nlevps_f,
+                                             joint_TP=joint_TP, cacher=this_cacher, **kwargs)
+                nhls = patchy.get_nhls(qe_key, qe_key, cls, cls, cls, lmin, lmax, lmax_qlm, transf, nlevts_f, nlevts_m, nlevps_f, nlevps_m,
+                                       joint_TP=joint_TP, cacher=this_cacher, **kwargs)
+                assert len(resps) == len(resps_ref) and len(nhls) == len(nhls_ref)
+                for ret, ref in zip(resps + nhls, resps_ref + nhls_ref):
+                    for r, rf in zip(ret, ref):
+                        assert np.allclose(r, rf, rtol=1e-10, atol=1e-10 * np.max(np.abs(ref[0]))), qe_key
+
+def test_nearby_noise_levels():
+    lmin, lmax, lmax_qlm = 10, 80, 60
+    cls = _get_cls(lmax)
+    transf = np.ones(lmax + 1)
+    nlevts, nlevps = [35.12, 35.13], [50., 50.]
+    resps = patchy.get_responses('ptt', cls, cls, cls, lmin, lmax, lmax_qlm, transf, nlevts, nlevps, cacher=cachers.cacher_mem())
+    nhls = patchy.get_nhls('ptt', 'ptt', cls, cls, cls, lmin, lmax, lmax_qlm, transf, nlevts, nlevts, nlevps, nlevps, cacher=cachers.cacher_mem())
+    assert not np.array_equal(resps[0][0], resps[1][0]) and not np.array_equal(nhls[0][0], nhls[1][0])  # not merged into one entry
+    for i in range(2):
+        resp = patchy.get_responses('ptt', cls, cls, cls, lmin, lmax, lmax_qlm, transf, nlevts[i:i + 1], nlevps[i:i + 1], cacher=cachers.cacher_mem())[0]
+        assert np.allclose(resps[i][0], resp[0], rtol=1e-12)
+
+def test_mk_patches():
+    npix = 12 * 4 ** 2
+    rng = np.random.default_rng(0)
+    dmap = rng.uniform(1., 2., npix)
+    for ivmap in [rng.uniform(1., 4., npix), np.where(np.arange(npix) % 2, 1., 4.)]:  # two-valued map: empty patches
+        ivmap[:10] = 0.
+        nlevs, nlevs_data, nlev_fid, fskies, masks = patchy.mk_patches(5, ivmap, rvmap_uKamin_data=dmap, ret_masks=True)
+        vmap = utils.cli(np.sqrt(ivmap)) * np.sqrt(hp.nside2pixarea(4)) / np.pi * 60 * 180.
+        assert np.isclose(np.sum(fskies), 1. - 10. / npix)
+        for nlev, nlev_data, fsky, mask in zip(nlevs, nlevs_data, fskies, masks):
+            assert np.isclose(fsky, np.sum(mask) / float(npix))
+            if np.any(mask):
+                assert np.isclose(nlev, np.mean(vmap[mask])) and np.isclose(nlev_data, np.mean(dmap[mask]))
+            else:
+                assert np.isnan(nlev) and np.isnan(nlev_data)
@@ -0,0 +1,56 @@
+from __future__ import print_function
+
+import tempfile
+import numpy as np
+import healpy as hp
+
+from plancklens import utils, qecl
+
+
+class _qlms_fixed:
+    """Deterministic QE library stand-in, counting the mean-field requests
+
+    """
+    def __init__(self, lmaxs, seed):
+        self.lmaxs = lmaxs
+        self.keys = list(lmaxs.keys())
+        self.seed = seed
+        self.mf_calls = 0
+
+    def hashdict(self):
+        return {'lmaxs': self.lmaxs, 'seed': self.seed}
+
+    def get_mask(self, leg):
+        return np.ones(12 * 4 ** 2)
+
+    def get_lmax_qlm(self, k):
+        return self.lmaxs[k]
+
+    def get_sim_qlm(self, k, idx, lmax=None):
+        lmax_qlm = self.lmaxs[k]
+        rng = np.random.default_rng((self.seed, self.keys.index(k), idx + 100))
+        qlm = rng.standard_normal(hp.Alm.getsize(lmax_qlm)) + 1j * rng.standard_normal(hp.Alm.getsize(lmax_qlm))
+        qlm[:lmax_qlm + 1] = qlm[:lmax_qlm + 1].real
+        return utils.alm_copy(qlm, lmax=lmax)
+
+    def get_sim_qlm_mf(self, k, mc_sims, lmax=None):
+        self.mf_calls += 1
+        return np.mean([self.get_sim_qlm(k, idx, lmax=lmax) for idx in mc_sims], axis=0)
+
+
+def test_sim_qcls_mf():
+    lmaxs = {'p': 30, 'x': 20}
+    mc_sims_mf = np.arange(10, 16)
+    qeA, qeB = _qlms_fixed(lmaxs, 0), _qlms_fixed(lmaxs, 1)
+    lib = qecl.library(tempfile.mkdtemp(), qeA, qeB, mc_sims_mf)
+    lib_ref = qecl.library(tempfile.mkdtemp(), qeA, qeB, mc_sims_mf)
+    pairs = [('p', 'p'), ('p', 'x'), ('x', 'p'), ('x', 'x')]
+    refs = {(k1, k2): np.array([lib_ref.get_sim_qcl(k1, idx, k2=k2) for idx in [0, 1, 2]]) for k1, k2 in pairs}
+    lib.get_sim_qcl('p', 1, k2='x')  # mixed use of the per-sim and batched paths
+    rets = lib.get_sim_qcls(['p', 'x'], ['p', 'x'], [0, 1, 2])
+    for k1, k2 in pairs:
+        assert rets[(k1, k2)].shape == (3, min(lmaxs[k1], lmaxs[k2]) + 1)
+        assert np.allclose(rets[(k1, k2)], refs[(k1, k2)], rtol=1e-12), (k1, k2)
+    # one mean-field in memory per leg and key, whatever the spectra lmax
+    assert sorted(lib._mfs.keys()) == [(1, 'p'), (1, 'x'), (2, 'p'), (2, 'x')]
+    assert qeA.mf_calls + qeB.mf_calls == 8
@@ -0,0 +1,32 @@
+from __future__ import print_function
+
+import os
+import numpy as np
+
+import plancklens
+from plancklens import utils, qresp
+
+
+def _get_cls_fals(lmax_ivf, lmin_ivf=10, nlev=35.):
+    cls_path = os.path.join(os.path.dirname(os.path.abspath(plancklens.__file__)), 'data', 'cls')
+    cls_len = utils.camb_clfile(os.path.join(cls_path, 'FFP10_wdipole_lensedCls.dat'))
+    cls_len = {k: cls_len[k][:lmax_ivf + 1] for k in ['tt', 'te', 'ee', 'bb']}
+    nl = (nlev / 60. / 180. * np.pi) ** 2
+    fal = {'tt': utils.cli(cls_len['tt'] + nl), 'ee': utils.cli(cls_len['ee'] + 2 * nl), 'bb': utils.cli(cls_len['bb'] + 2 * nl)}
+    for cl in fal.values():
+        cl[:lmin_ivf] *= 0.
+    return cls_len, fal
+
+def test_dresponse_dlncl_matrix():
+    lmax_ivf, lmax_qlm = 60, 50
+    cls_len, fal = _get_cls_fals(lmax_ivf)
+    for qe_key, cl_key in [('ptt', 'tt'), ('p_p', 'ee'), ('p', 'te')]:
+        dR = qresp.get_dresponse_dlncl_matrix(qe_key, cl_key, lmax_ivf, 'p', cls_len, cls_len, fal, lmax_out=lmax_qlm, lblock=16)
+        assert dR[0].shape == (lmax_qlm + 1, lmax_ivf + 1)
+        for l in [10, 11, 33, 60]:
+            ref = qresp.get_dresponse_dlncl(qe_key, l, cl_key, lmax_ivf, 'p', cls_len, cls_len, fal, lmax_out=lmax_qlm)
+            for dR_i, ref_i in zip(dR, ref):
+                assert np.allclose(dR_i[:, l], ref_i, rtol=0., atol=1e-10 * np.max(np.abs(ref[0]))), (qe_key, l)
+        if qe_key == 'ptt':  # the response is linear in cltt, the derivatives sum up to the response
+            R = qresp.get_response(qe_key, lmax_ivf, 'p', cls_len, cls_len, fal, lmax_qlm=lmax_qlm)
+            assert np.allclose(np.sum(dR[0], axis=1)[1:], R[0][1:], rtol=1e-8)
@@ -0,0 +1,223 @@
+from __future__ import print_function
+
+import tempfile
+import os
+import numpy as np
+import healpy as hp
+
+import plancklens
+from plancklens import utils
+from plancklens.sims import cmbs, maps, phas, utils as sims_utils
+
+
+class _cmb_len_fixed:
+    """Deterministic lensed CMB library stand-in: one set of alms per index
+
+    """
+    def __init__(self, lmax, seed):
+        self.lmax = lmax
+        self.seed = seed
+
+    def hashdict(self):
+        return {'lmax': self.lmax, 'seed': self.seed}
+
+    def _get_alm(self, idx, idf):
+        rng = np.random.default_rng((self.seed, idf, idx + 100))  # (data indices are negative)
+        alm = rng.standard_normal(hp.Alm.getsize(self.lmax)) + 1j * rng.standard_normal(hp.Alm.getsize(self.lmax))
+        alm[:self.lmax + 1] = alm[:self.lmax + 1].real
+        return alm
+
+    def get_sim_tlm(self, idx):
+        return self._get_alm(idx, 0)
+
+    def get_sim_elm(self, idx):
+        return self._get_alm(idx, 1)
+
+    def get_sim_blm(self, idx):
+        return self._get_alm(idx, 2)
+
+
+def _get_maps_libs(lib_dir, nside=16, lmax=32):
+    """Two homogeneous noise libraries on the legacy pixel phases (sqlite rng db and global numpy random state)
+
+    """
+    transf = np.ones(lmax + 1)
+    libs = []
+    for i in range(2):
+        this_dir = os.path.join(lib_dir, 'lib%s' % i)
+        os.makedirs(this_dir)
+        libs.append(maps.cmb_maps_nlev(_cmb_len_fixed(lmax, i), transf, 10., 20., nside, lib_dir=this_dir))
+    return libs
+
+def test_sim_lib_add_legacy_phases():
+    lib_dir = tempfile.mkdtemp()
+    libs = _get_maps_libs(lib_dir)
+    w = [1., 0.5]
+    for idx in [0, 1]:  # builds the sims and stores the rng states
+        for lib in libs:
+            lib.get_sim_tmap(idx)
+            lib.get_sim_pmap(idx)
+    tmaps = [w[0] * libs[0].get_sim_tmap(idx) + w[1] * libs[1].get_sim_tmap(idx) for idx in [0, 1]]
+    pmaps = [[w[0] * p0 + w[1] * p1 for p0, p1 in zip(libs[0].get_sim_pmap(idx), libs[1].get_sim_pmap(idx))] for idx in [0, 1]]
+
+    lib_add = sims_utils.sim_lib_add_sim(libs, weights=w)
+    for idx in [0, 1]:
+        assert np.array_equal(lib_add.get_sim_tmap(idx), tmaps[idx])
+        for p, p_ref in zip(lib_add.get_sim_pmap(idx), pmaps[idx]):
+            assert np.array_equal(p, p_ref)
+    # data index: first library only
+    assert np.array_equal(lib_add.get_sim_tmap(-1), libs[0].get_sim_tmap(-1))
+
+    lib_dat = sims_utils.sim_lib_add_dat(libs, weights=w)
+    assert np.array_equal(lib_dat.get_sim_tmap(0), libs[0].get_sim_tmap(0))
+
+class _maps_fixed:
+    """Deterministic (and thread-safe) maps library stand-in
+
+    """
+    def __init__(self, seed, npix=12 * 16 ** 2):
+        self.seed = seed
+        self.npix = npix
+
+    def hashdict(self):
+        return {'seed': self.seed, 'npix': self.npix}
+
+    def get_sim_tmap(self, idx):
+        return np.random.default_rng((self.seed, 0, idx + 100)).standard_normal(self.npix)
+
+    def get_sim_pmap(self, idx):
+        rng = np.random.default_rng((self.seed, 1, idx + 100))
+        return rng.standard_normal(self.npix), rng.standard_normal(self.npix)
+
+def test_sim_lib_add_prefetch():
+    libs = [_maps_fixed(i) for i in range(2)]
+    lib_add = sims_utils.sim_lib_add_sim(libs, weights=[1., -1.], nthreads=2, prefetch=True)
+    assert np.array_equal(lib_add.get_sim_tmap(-1), libs[0].get_sim_tmap(-1))
+    assert len(lib_add._prefetched) == 0  # no prefetch after a data request
+    for idx in [0, 1, 5, 2]:  # prefetched, then not
+        assert np.array_equal(lib_add.get_sim_tmap(idx), libs[0].get_sim_tmap(idx) - libs[1].get_sim_tmap(idx))
+        assert ('t', idx + 1) in lib_add._prefetched
+    for p, p0, p1 in zip(lib_add.get_sim_pmap(3), libs[0].get_sim_pmap(3), libs[1].get_sim_pmap(3)):
+        assert np.array_equal(p, p0 - p1)
+    assert len([k for k in lib_add._prefetched if k[0] == 't']) <= 2
+    pools = [lib_add._pool, lib_add._prefetch_pool]
+    lib_add.close()
+    assert len(lib_add._prefetched) == 0 and lib_add._pool is None and lib_add._prefetch_pool is None
+    assert all(pool._shutdown for pool in pools)
+
+def test_pix_lib_phas():
+    pix_phas = phas.pix_lib_phas(tempfile.mkdtemp(), 3, (12 * 4 ** 2,))
+    assert pix_phas.get_sim(0, phas_only=True) is None
+    assert all(lib.is_stored(0) for lib in pix_phas.lib_pix.values())
+    sim = pix_phas.get_sim(0)
+    for idf in range(3):
+        assert np.array_equal(sim[idf], pix_phas.get_sim(0, idf=idf))
+
+def test_pix_lib_phas_gen_chunks(monkeypatch):
+    import threading
+    import concurrent.futures
+    pools = []  # threads creating a pool
+    class _pool(concurrent.futures.ThreadPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            pools.append(threading.current_thread())
+            super(_pool, self).__init__(*args, **kwargs)
+    monkeypatch.setattr(concurrent.futures, 'ThreadPoolExecutor', _pool)
+    lib = phas.pix_lib_phas_gen(2, (1000,), 1, chunk_size=100, nthreads=4)
+    lib_ser = phas.pix_lib_phas_gen(2, (1000,), 1, chunk_size=100, nthreads=1)
+    sim = lib.get_sim(3)
+    assert len(pools) == 1  # chunks of the main thread call
+    assert np.array_equal(sim, lib_ser.get_sim(3))
+    del pools[:]
+    sims = lib.get_sims([3, 4])
+    assert pools == [threading.main_thread()]  # no pools nested in the get_sims one
+    assert np.array_equal(sims[0][1], sim[1])
+    with _pool(max_workers=2) as ex:
+        assert np.array_equal(lib_ser.get_sim(3, executor=ex), sim)
+        assert np.array_equal(lib_ser.get_sim(4, idf=0, executor=ex), sims[1][0])
+
+class _phas_counting:
+    """Phases library wrapper counting the number of fields drawn
+
+    """
+    def __init__(self, lib_phas):
+        self.lib_phas = lib_phas
+        self.lmax = lib_phas.lmax
+        self.ndraws = 0
+
+    def hashdict(self):
+        return self.lib_phas.hashdict()
+
+    def get_sim(self, idx, idf=None):
+        self.ndraws += self.lib_phas.nfields if idf is None else 1
+        return self.lib_phas.get_sim(idx, idf=idf)
+
+def test_sims_cmb_unl():
+    cls_path = os.path.join(os.path.dirname(os.path.abspath(plancklens.__file__)), 'data', 'cls')
+    cls_unl = utils.camb_clfile(os.path.join(cls_path, 'FFP10_wdipole_lenspotentialCls.dat'))
+    lmax = 64
+    for cholesky in [False, True]:
+        for cache_alms in [True, False]:
+            lib_pha = _phas_counting(phas.lib_phas_gen(4, lmax, 1))
+            unlcmbs = cmbs.sims_cmb_unl({k: cl[:lmax + 1] for k, cl in cls_unl.items()}, lib_pha, cholesky=cholesky, cache_alms=cache_alms)
+            alms = unlcmbs.get_sim_alms(0)
+            assert unlcmbs._cache[0] is None  # not filled by get_sim_alms
+            lib_pha.ndraws = 0
+            for idf, f in enumerate(unlcmbs.fields):
+                assert np.array_equal(alms[idf], unlcmbs.get_sim_alm(0, f)), f
+            if cache_alms:  # phases drawn once for all fields
+                assert lib_pha.ndraws == len(unlcmbs.fields) and unlcmbs._cache[0] == 0
+            else:
+                assert lib_pha.ndraws > len(unlcmbs.fields) and unlcmbs._cache[0] is None
+
+def test_map_reader(monkeypatch):
+    lib_dir = tempfile.mkdtemp()
+    npix = 12 * 4 ** 2
+    fnames = [os.path.join(lib_dir, d, 'map.fits') for d in ['a', 'b']]  # same basenames
+    for i, fname in enumerate(fnames):
+        os.makedirs(os.path.dirname(fname))
+        hp.write_map(fname, np.arange(3 * npix, dtype=float).reshape(3, npix) + i)
+    for reader in [sims_utils.map_reader(), sims_utils.map_reader(cache_size=2),
+                   sims_utils.map_reader(mirror_dir=os.path.join(lib_dir, 'mirror'))]:
+        for i, fname in enumerate(fnames):
+            for field in [2, 0, 1]:
+                assert np.array_equal(reader.get_map(fname, field), np.arange(npix) + field * npix + i)
+    # CMB and noise files read alternately: each read once with a cache of 2 files
+    nreads = []
+    read_map = hp.read_map
+    monkeypatch.setattr(hp, 'read_map', lambda *args, **kwargs: (nreads.append(args[0]), read_map(*args, **kwargs))[1])
+    for cache_size, nreads_ref in [(0, 6), (1, 6), (2, 2)]:
+        nreads.clear()
+        reader = sims_utils.map_reader(cache_size=cache_size)
+        for field in [0, 1, 2]:
+            for fname in fnames:
+                reader.get_map(fname, field)
+        assert len(nreads) == nreads_ref, cache_size
+    monkeypatch.undo()
+    # stale mirrors are not reused
+    reader = sims_utils.map_reader(mirror_dir=os.path.join(lib_dir, 'mirror'))
+    hp.write_map(fnames[0], np.ones((3, npix)), overwrite=True, dtype=np.float32)
+    assert np.all(reader.get_map(fnames[0], 1) == 1.)
+
+def test_cmb_maps_nlev_alms():
+    lmax_cmb = 32
+    cmb_len = _cmb_len_fixed(lmax_cmb, 0)
+    for lmax_phas in [24, 48]:
+        lib = maps.cmb_maps_nlev(cmb_len, np.ones(lmax_cmb + 1), 10., 20., 16, lib_phas=phas.lib_phas_gen(3, lmax_phas, 1))
+        lmax = min(lmax_cmb, lmax_phas)
+        tlm = lib.get_sim_tlm(0)
+        elm, blm = lib.get_sim_eblm(0)
+        assert hp.Alm.getlmax(tlm.size) == lmax and hp.Alm.getlmax(elm.size) == lmax and hp.Alm.getlmax(blm.size) == lmax
+        assert np.array_equal(lib.get_sim_tlm(0, lmax=lmax - 4), utils.alm_copy(tlm, lmax=lmax - 4))
+        try:
+            lib.get_sim_tlm(0, lmax=lmax + 1)
+            assert 0, 'lmax larger than the CMB or phases lmax should fail'
+        except AssertionError as e:
+            assert 'should fail' not in str(e)
+        # noise-only maps, band-limited at the phases lmax
+        rad = lambda nlev: nlev / 60. / 180. * np.pi
+        nlm = [rad(nlev) * lib.lib_phas.get_sim(0, idf=idf) for idf, nlev in zip(range(3), [10., 20., 20.])]
+        assert np.allclose(lib.get_sim_tnoise(0), hp.alm2map(nlm[0], 16))
+        Q, U = hp.alm2map_spin(nlm[1:], 16, 2, lmax_phas)
+        assert np.allclose(lib.get_sim_qnoise(0), Q) and np.allclose(lib.get_sim_unoise(0), U)
+        if lmax_phas <= lmax_cmb:
+            assert np.allclose(lib.get_sim_tmap(0) - lib.get_sim_tnoise(0), hp.alm2map(utils.alm_copy(cmb_len.get_sim_tlm(0), lmax=lmax), 16))
@@ -0,0 +1,56 @@
+from __future__ import print_function
+
+import os
+import sqlite3
+import tempfile
+import numpy as np
+
+from plancklens.helpers import sql
+
+
+def test_npdb():
+    for codec in ['npy', 'raw']:
+        fname = os.path.join(tempfile.mkdtemp(), 'npdb.db')
+        db = sql.npdb(fname, codec=codec)
+        assert db.codec == codec
+        arr = np.arange(10, dtype=float)
+        db.add('a', arr)
+        db.add('a', arr + 1.)  # duplicate key: left untouched
+        assert np.array_equal(db.get('a'), arr)
+        assert not db.con.in_transaction
+        # a second connection can write right away
+        con = sqlite3.connect(fname, timeout=1.)
+        con.execute("DELETE FROM npdb WHERE id=?", ('nokey',))
+        con.commit()
+        con.close()
+
+        idxs = ['k%s' % i for i in range(1200)]  # more than one bulk SELECT statement
+        db.add_many(idxs, [np.full(3, i, dtype=float) for i in range(1200)])
+        db.add_many(['a'], [arr + 1.])
+        assert np.array_equal(db.get('a'), arr)
+        rets = db.get_many(idxs[::-1] + ['nokey'])
+        assert rets[-1] is None and db.get('nokey') is None
+        for i, ret in zip(range(1199, -1, -1), rets[:-1]):
+            assert np.array_equal(ret, np.full(3, i, dtype=float))
+        db.remove('a')
+        assert db.get('a') is None
+        # existing databases keep their codec
+        assert sql.npdb(fname, codec='npy').codec == codec
+
+def test_raw_codec():
+    for arr in [np.arange(12, dtype=np.float32).reshape(3, 4), np.arange(5) + 1j, np.zeros(0)]:
+        ret = sql.convert_array_raw(bytes(sql.adapt_array_raw(arr)))
+        assert ret.dtype == arr.dtype and np.array_equal(ret, arr)
+
+def test_fldb():
+    fname = os.path.join(tempfile.mkdtemp(), 'fldb.db')
+    db = sql.fldb(fname)
+    db.add('a', 1.5)
+    db.add('a', 2.5)
+    assert db.get('a') == 1.5
+    assert not db.con.in_transaction
+    idxs = ['k%s' % i for i in range(700)]
+    db.add_many(idxs, [float(i) for i in range(700)])
+    assert db.get_many(idxs + ['nokey']) == [float(i) for i in range(700)] + [None]
+    db.remove('a')
+    assert db.get('a') is None
@@ -0,0 +1,48 @@
+from __future__ import print_function
+
+import pickle as pk
+import numpy as np
+
+from plancklens import utils
+
+
+def test_stats():
+    rng = np.random.default_rng(0)
+    size = 6
+    V = 1e3 + rng.standard_normal((50, size)) @ rng.standard_normal((size, size))  # large mean, correlated
+    cov = np.cov(V, rowvar=False)
+    blocks = [np.arange(0, 2), np.arange(2, 6)]
+
+    s_add = utils.stats(size)
+    for v in V:
+        s_add.add(v)
+    s_many = utils.stats(size)
+    s_many.add_many(V[:20])
+    s_many.add_many(V[20:])
+    s_merge = utils.stats(size).merge(utils.stats(size))  # empty merges are no-ops
+    for i in range(0, 50, 7):
+        other = utils.stats(size)
+        other.add_many(V[i:i + 7])
+        s_merge.merge(other)
+    for s in [s_add, s_many, s_merge]:
+        assert s.N == 50
+        assert np.allclose(s.mean(), np.mean(V, axis=0), rtol=1e-14)
+        assert np.allclose(s.cov(), cov, rtol=1e-10, atol=1e-12 * np.max(np.abs(cov)))
+        assert np.allclose(s.var(), np.diag(cov), rtol=1e-10)
+
+    s_diag = utils.stats(size, docov='diag')
+    s_diag.add_many(V)
+    assert np.allclose(s_diag.var(), np.diag(cov), rtol=1e-10)
+    s_blocks = utils.stats(size, docov=blocks)
+    for i in range(0, 50, 10):
+        s_blocks.add_many(V[i:i + 10])
+    for b in blocks:
+        assert np.allclose(s_blocks.cov()[np.ix_(b, b)], cov[np.ix_(b, b)], rtol=1e-10)
+
+    # instances pickled with the raw sums are still readable
+    s_old = utils.stats(size)
+    state = {'N': 50, 'size': size, 'xcoord': None, 'docov': True,
+             'sum': np.sum(V, axis=0), 'mom': np.dot(V.T, V)}
+    s_old.__setstate__(state)
+    assert np.allclose(s_old.cov(), cov, rtol=1e-6)
+    assert np.allclose(pk.loads(pk.dumps(s_add)).cov(), s_add.cov())
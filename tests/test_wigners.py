@@ -0,0 +1,30 @@
+from __future__ import print_function
+
+import numpy as np
+
+from plancklens import utils_spin as uspin
+
+
+def _get_cls(rng, n, lmax):
+    return rng.standard_normal((n, lmax + 1)) * np.exp(-np.arange(lmax + 1) / 100.)
+
+def test_wignerc_grouped():
+    rng = np.random.default_rng(2)
+    cla, clb, clc = _get_cls(rng, 3, 120)
+    cld = _get_cls(rng, 1, 80)[0]
+    jobs = [(cla, clb, 0, 0, 0, 0),
+            (cla, clb, 2, 2, -2, -2),
+            (cla, clc, 2, 2, -2, -2),  # shares the first leg transform
+            (clc, cla, 2, -2, 0, 1),
+            (cld, cla, 1, 1, 1, -1),   # different lmax
+            (cla, clb, 0, 0, 0, 0),    # duplicate job
+            (cla + 1j * clc, clb, 2, 2, -2, -2),  # complex input
+            (cla, np.zeros(121), 0, 0, 0, 0)]  # vanishing
+    for lmax_out in [150, 250]:
+        rets = uspin.wignerc_grouped(jobs, lmax_out=lmax_out)
+        assert len(rets) == len(jobs)
+        for job, ret in zip(jobs, rets):
+            ref = uspin.wignerc(*job, lmax_out=lmax_out)
+            assert ret.shape == ref.shape and ret.dtype == ref.dtype
+            assert np.allclose(ret, ref, rtol=0., atol=1e-12 * max(np.max(np.abs(ref)), 1e-300))
+    assert len(uspin.wignerc_grouped([], lmax_out=10)) == 0